@@ -1,67 +1,134 @@
 from SceneObjects import *
+import render_stats
+
+# Relative costs used by the surface area heuristic (SAH)
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+BOX_PADDING = 0.1
+# Batched FlatBVH walks (see ray_packets)
+PACKET_SIZE = 8  # consecutive rays tested against boxes as one; 1 = every ray on its own
+PACKET_SPREAD = 0.2  # most the direction components of a packet's rays may differ by
+PACKET_LEVELS = 8  # tree levels the numpy walk takes packets down before going on ray by ray
+
+
+def triangle_bounds(objects_list):
+    """Min corners, max corners and centroids of Triangles as (n,3) arrays"""
+    pts = np.array([[(t.A.x, t.A.y, t.A.z), (t.B.x, t.B.y, t.B.z), (t.C.x, t.C.y, t.C.z)] for t in objects_list])
+    return pts.min(axis=1), pts.max(axis=1), (pts[:, 0] + pts[:, 1] + pts[:, 2]) / 3
+
+
+def surface_area(min_point, max_point):
+    """Surface area of boxes given as (..., 3) min/max arrays (empty boxes count as 0)"""
+    extent = np.maximum(max_point - min_point, 0)
+    return 2 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+
+def split_median(indices, centroids, axis):
+    """Original split: sort on one axis and halve the list"""
+    ordered = indices[np.argsort(centroids[indices, axis], kind="stable")]
+    mid_point = len(ordered) // 2
+    return ordered[:mid_point], ordered[mid_point:]
+
+
+def split_sah(indices, bounds_min, bounds_max, centroids, n_bins=12):
+    """Binned surface area heuristic: buckets the centroids into n_bins slabs along each axis and picks the
+    bucket boundary with the lowest estimated cost. Returns (left indices, right indices, cost)"""
+    cent = centroids[indices]
+    box_min, box_max = bounds_min[indices], bounds_max[indices]
+    c_min, c_extent = cent.min(axis=0), cent.max(axis=0) - cent.min(axis=0)
+    parent_area = max(surface_area(box_min.min(axis=0), box_max.max(axis=0)), 1e-12)
+    if not (c_extent > 0).any():
+        # Every centroid in the same spot; nothing to gain, so just halve the list
+        mid_point = len(indices) // 2
+        return indices[:mid_point], indices[mid_point:], np.inf
+
+    # Bin on all three axes at once: row = axis, column = bin
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bins = np.clip(((cent - c_min) / c_extent * n_bins).astype(np.int64), 0, n_bins - 1)
+    slots = (bins + np.arange(3) * n_bins).reshape(-1)
+    counts = np.bincount(slots, minlength=3 * n_bins).reshape(3, n_bins)
+    bin_min = np.full((3 * n_bins, 3), np.inf)
+    bin_max = np.full((3 * n_bins, 3), -np.inf)
+    np.minimum.at(bin_min, slots, np.repeat(box_min, 3, axis=0))
+    np.maximum.at(bin_max, slots, np.repeat(box_max, 3, axis=0))
+    bin_min, bin_max = bin_min.reshape(3, n_bins, 3), bin_max.reshape(3, n_bins, 3)
+
+    # Split k puts bins 0..k on the left and k+1.. on the right
+    left_count = np.cumsum(counts, axis=1)[:, :-1]
+    right_count = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    left_area = surface_area(np.minimum.accumulate(bin_min, axis=1)[:, :-1],
+                             np.maximum.accumulate(bin_max, axis=1)[:, :-1])
+    right_area = surface_area(np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, ::-1][:, 1:],
+                              np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, ::-1][:, 1:])
+    cost = TRAVERSAL_COST + INTERSECTION_COST * (left_area * left_count + right_area * right_count) / parent_area
+    cost[(left_count == 0) | (right_count == 0) | (c_extent[:, None] <= 0)] = np.inf
+
+    axis, split = np.unravel_index(np.argmin(cost), cost.shape)
+    if not np.isfinite(cost[axis, split]):
+        mid_point = len(indices) // 2
+        return indices[:mid_point], indices[mid_point:], np.inf
+    on_left = bins[:, axis] <= split
+    return indices[on_left], indices[~on_left], cost[axis, split]
 
 
 class BoundingBox:
     """Holds a min and max position vector of an Axis-Aligned Bounding Box (AABB)"""
 
-    def __init__(self, objects_list, axis=0):
-        """Recursively defines contained bounding volumes"""
+    def __init__(self, objects_list, axis=0, leaf_size=4, method="sah", n_bins=12):
+        """Builds the whole tree of contained bounding volumes. The triangles' bounds and centroids are put
+        into arrays once; nodes are split with a binned surface area heuristic (method="sah") or with the
+        original sort-on-alternating-axes-and-halve split (method="median"), until at most leaf_size are left"""
+        self._reset()
+
+        triangles = [obj for obj in objects_list if type(obj) == Triangle]
+        if len(triangles) != len(objects_list):
+            print("Warning: BoundingBox not usable with non-Triangles yet")
+        if len(triangles) == 0:
+            print(f"Warning: BoundingBox not programmed to deal with {len(triangles)} items. ")
+            return
+        if method not in ("sah", "median"):
+            print(f"Warning: Unknown BoundingBox build method {method}; using sah")
+            method = "sah"
+
+        bounds_min, bounds_max, centroids = triangle_bounds(triangles)
+        self._build(triangles, np.arange(len(triangles)), bounds_min, bounds_max, centroids,
+                    axis, max(leaf_size, 1), method, n_bins)
+
+    def _reset(self):
         self.left_box = None
         self.right_box = None
-        self.object_contained = None
+        self.objects_contained = None
         self.min_point = None
         self.max_point = None
         self.object_count = 0
-        if len(objects_list) == 1:
-            if type(objects_list[0]) == Triangle:
-                tri = objects_list[0]
-                self.min_point = Vec3(min(tri.A.x, tri.B.x, tri.C.x) - 0.1,
-                                      min(tri.A.y, tri.B.y, tri.C.y) - 0.1,
-                                      min(tri.A.z, tri.B.z, tri.C.z) - 0.1)
-                self.max_point = Vec3(max(tri.A.x, tri.B.x, tri.C.x) + 0.1,
-                                      max(tri.A.y, tri.B.y, tri.C.y) + 0.1,
-                                      max(tri.A.z, tri.B.z, tri.C.z) + 0.1)
-                self.object_contained = tri
-                # print(f"Bounding box for {self.object_contained}")
-                self.object_count = 1
-            else:
-                print("Warning: BoundingBox not usable with non-Triangles yet")
-        elif len(objects_list) > 1:
+
+    def _build(self, objects_list, indices, bounds_min, bounds_max, centroids, axis, leaf_size, method, n_bins):
+        self.min_point = Vec3(bounds_min[indices].min(axis=0) - BOX_PADDING)
+        self.max_point = Vec3(bounds_max[indices].max(axis=0) + BOX_PADDING)
+        self.object_count = len(indices)
+
+        if len(indices) <= leaf_size:
+            self.objects_contained = [objects_list[i] for i in indices]
+            return
+
+        if method == "median":
             """Based on Shirley and Marschner Hierarchical Bounding Volumes"""
-            if axis == 0:
-                new_list = sorted(objects_list, key=lambda t: (t.A.x + t.B.x + t.C.x) / 3, reverse=False)
-            elif axis == 1:
-                new_list = sorted(objects_list, key=lambda t: (t.A.y + t.B.y + t.C.y) / 3, reverse=False)
-            elif axis == 2:
-                new_list = sorted(objects_list, key=lambda t: (t.A.z + t.B.z + t.C.z) / 3, reverse=False)
-            else:
-                print(f"Error in Bounding box for {objects_list}")
-                new_list = objects_list
-
-            first = new_list[0].A
-            xmin, xmax, ymin, ymax, zmin, zmax = first.x, first.x, first.y, first.y, first.z, first.z
-            for tri in new_list:
-                for pt in (tri.A, tri.B, tri.C):
-                    if pt.x < xmin: xmin = pt.x
-                    if pt.x > xmax: xmax = pt.x
-                    if pt.y < ymin: ymin = pt.y
-                    if pt.y > ymax: ymax = pt.y
-                    if pt.z < zmin: zmin = pt.z
-                    if pt.x > xmax: zmax = pt.z
-
-            self.min_point = Vec3(xmin - 0.1, ymin - 0.1, zmin - 0.1)
-            self.max_point = Vec3(xmax + 0.1, ymax + 0.1, zmax + 0.1)
-
-            mid_point = len(new_list)//2
-            self.left_box = BoundingBox(new_list[:mid_point], axis=(axis + 1) % 3)
-            self.right_box = BoundingBox(new_list[mid_point:], axis=(axis + 1) % 3)
-            self.object_count = self.left_box.object_count + self.right_box.object_count
+            left, right = split_median(indices, centroids, axis)
         else:
-            print(f"Warning: BoundingBox not programmed to deal with {len(objects_list)} items. ")
+            left, right, _ = split_sah(indices, bounds_min, bounds_max, centroids, n_bins)
 
-    def intersect(self, ray_to_test):
+        # Children are built from the same arrays, so skip __init__
+        self.left_box, self.right_box = BoundingBox.__new__(BoundingBox), BoundingBox.__new__(BoundingBox)
+        for child, child_indices in ((self.left_box, left), (self.right_box, right)):
+            child._reset()
+            child._build(objects_list, child_indices, bounds_min, bounds_max, centroids,
+                         (axis + 1) % 3, leaf_size, method, n_bins)
+
+    def hit_box(self, ray_to_test):
         """Based on https://www.scratchapixel.com/lessons/3d-basic-rendering/minimal-ray-tracer-rendering-simple-shapes/ray-box-intersection
-        Returns either False or the object_hit (Triangle)"""
+        True if the ray's line passes through this box"""
+        if render_stats.enabled:
+            render_stats.count("box_tests")
         r_dir = ray_to_test.direction
         r_ori = ray_to_test.origin
 
@@ -102,13 +169,21 @@ class BoundingBox:
         #     t_min = t_z_min
         # if t_z_max < t_max:
         #     t_max = t_z_max
+        return True
+
+    def intersect(self, ray_to_test):
+        """Returns either False or the object_hit (Triangle)"""
+        if not self.hit_box(ray_to_test):
+            return False
 
         # Return some form of True statement now
-        if self.object_contained is not None:
-            if self.object_contained.intersect(ray_to_test):
-                return self.object_contained
-            else:
-                return False
+        if self.objects_contained is not None:
+            obj_hit = False
+            # Ray's nearest hit distance will update, so the last one hit is the nearest
+            for obj in self.objects_contained:
+                if obj.intersect(ray_to_test):
+                    obj_hit = obj
+            return obj_hit
         else:
             obj_hit, left_hit, right_hit = None, None, None
             # Ray's nearest hit distance will update, so can check in succession
@@ -125,10 +200,58 @@ class BoundingBox:
             else:
                 return False
 
+    def occluded(self, ray_to_test):
+        """Any-hit version of intersect for shadow rays: True as soon as one object blocks the ray before its
+        nearest_hit_distance (which is left as is), without looking for the nearest"""
+        return self.occluder(ray_to_test) is not None
+
+    def occluder(self, ray_to_test):
+        """occluded, returning the object that blocks the ray or None"""
+        if not self.hit_box(ray_to_test):
+            return None
+        if self.objects_contained is not None:
+            for obj in self.objects_contained:
+                blocker = obj.occluder(ray_to_test)
+                if blocker is not None:
+                    return blocker
+            return None
+        blocker = None if self.left_box is None else self.left_box.occluder(ray_to_test)
+        if blocker is None and self.right_box is not None:
+            blocker = self.right_box.occluder(ray_to_test)
+        return blocker
+
 
     def __repr__(self):
         return f"BoundingBox obj: Vmin={self.min_point}, Vmax={self.max_point}"
 
+    def get_stats(self):
+        """Tree quality: depth, node/leaf counts, objects per leaf and SAH cost (relative to the root's area)"""
+        root_area = surface_area(np.array([self.min_point.x, self.min_point.y, self.min_point.z]),
+                                 np.array([self.max_point.x, self.max_point.y, self.max_point.z]))
+        nodes, depth, sah_cost, leaf_sizes = 0, 0, 0.0, []
+        stack = [(self, 1)]
+        while stack:
+            box, level = stack.pop()
+            nodes += 1
+            depth = max(depth, level)
+            area = surface_area(np.array([box.min_point.x, box.min_point.y, box.min_point.z]),
+                                np.array([box.max_point.x, box.max_point.y, box.max_point.z])) / root_area
+            if box.objects_contained is not None:
+                leaf_sizes.append(len(box.objects_contained))
+                sah_cost += area * len(box.objects_contained) * INTERSECTION_COST
+            else:
+                sah_cost += area * TRAVERSAL_COST
+                stack += [(child, level + 1) for child in (box.left_box, box.right_box) if child is not None]
+        return {"objects": self.object_count, "nodes": nodes, "leaves": len(leaf_sizes), "depth": depth,
+                "min_leaf_objects": min(leaf_sizes), "max_leaf_objects": max(leaf_sizes),
+                "mean_leaf_objects": sum(leaf_sizes) / len(leaf_sizes), "sah_cost": sah_cost}
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"{self}: {stats['objects']} objects, {stats['nodes']} nodes, depth {stats['depth']}, "
+              f"{stats['leaves']} leaves holding {stats['min_leaf_objects']}-{stats['max_leaf_objects']} "
+              f"(mean {round(stats['mean_leaf_objects'], 2)}) objects, SAH cost {round(stats['sah_cost'], 2)}")
+
     def get_depth(self):
         level = max(DFS_count(self.left_box), DFS_count(self.right_box))
         print(f"{self} is {level} levels deep")
@@ -138,7 +261,7 @@ def DFS_count(box):
     left, right = 0, 0
     if box is None:
         return 0
-    if box.object_contained is not None:
+    if box.objects_contained is not None:
         # Base Case
         return 1
     if box.left_box is not None:
@@ -148,3 +271,422 @@ def DFS_count(box):
     curr_level = max(left, right)
     return curr_level
 
+
+# One row per node of a FlatBVH
+BVH_NODE = np.dtype([("min", np.float64, 3), ("max", np.float64, 3), ("offset", np.int32), ("count", np.int32)])
+
+
+def slab_entry(min_point, max_point, origins, inv_directions):
+    """Vectorized slab test; returns (entry t, exit t) per ray, the box is hit where entry <= exit and exit >= 0"""
+    if render_stats.enabled:
+        render_stats.count("box_tests", len(origins))
+    t_0 = (min_point - origins) * inv_directions
+    t_1 = (max_point - origins) * inv_directions
+    return np.minimum(t_0, t_1).max(axis=-1), np.maximum(t_0, t_1).min(axis=-1)
+
+
+def inverse_directions(directions):
+    """1/d per component, with a huge stand-in for 0 so slab tests never see inf * 0"""
+    safe = np.where(directions == 0, 1e-300, directions)
+    return 1.0 / safe
+
+
+def ray_packets(origins, directions, inv_directions, t_max):
+    """Groups rays into packets of PACKET_SIZE consecutive rays (neighbouring pixels, for camera rays and the
+    shadow rays from where they hit). A group whose rays point different ways along an axis, or whose direction
+    components differ by more than PACKET_SPREAD, is split into packets of one ray, which packet_slab_entry tests
+    exactly like slab_entry. Returns (first ray, ray count, origin min, origin max, 1/d min, 1/d max, reach min,
+    reach max) per packet; reach is a box (padded by BOX_PADDING) around every ray from its origin to its t_max,
+    which is what culls shadow rays: they all end at the light, but start too far apart for the slab test"""
+    starts = np.arange(0, len(origins), PACKET_SIZE)
+    sizes = np.diff(np.append(starts, len(origins)))
+    if not len(origins):
+        return (starts, sizes) + (origins,) * 6
+    low, high = np.minimum.reduceat(directions, starts), np.maximum.reduceat(directions, starts)
+    coherent = (((low >= 0) | (high < 0)).all(axis=1) & ((high - low).max(axis=1) <= PACKET_SPREAD) & (sizes > 1))
+    single = np.nonzero(~np.repeat(coherent, sizes))[0]
+    ends = origins + directions * t_max[:, None]
+
+    def bounds(values, reduce):
+        return np.concatenate((reduce.reduceat(values, starts)[coherent], values[single]))
+    return (np.concatenate((starts[coherent], single)), np.concatenate((sizes[coherent], np.ones_like(single))),
+            bounds(origins, np.minimum), bounds(origins, np.maximum), bounds(inv_directions, np.minimum),
+            bounds(inv_directions, np.maximum), bounds(np.minimum(origins, ends), np.minimum) - BOX_PADDING,
+            bounds(np.maximum(origins, ends), np.maximum) + BOX_PADDING)
+
+
+def packet_slab_entry(min_point, max_point, origin_min, origin_max, inv_min, inv_max):
+    """slab_entry for packets: (a t no ray of the packet enters the box before, a t every ray has left it by),
+    for rays with origins and 1/d in the given ranges. Interval arithmetic, which rounding can't undercut: a box
+    a packet misses is missed by all of its rays"""
+    if render_stats.enabled:
+        render_stats.count("box_tests", len(min_point))
+    corners = [(bound - origin) * inverse for bound in (min_point, max_point) for origin in (origin_min, origin_max)
+               for inverse in (inv_min, inv_max)]
+    return np.minimum.reduce(corners).max(axis=-1), np.maximum.reduce(corners).min(axis=-1)
+
+
+class FlatBVH:
+    """Linearized BVH: all nodes live in one structured array (BVH_NODE) in depth-first order, so a node's left
+    child is always the next node. Interior nodes keep their right child's index in offset (count 0); leaves
+    cover prim_indices[offset:offset + count]. Built with the same splits as BoundingBox"""
+
+    def __init__(self, bounds_min, bounds_max, centroids=None, leaf_size=4, method="sah", n_bins=12):
+        if centroids is None:
+            centroids = (bounds_min + bounds_max) / 2
+        leaf_size = max(leaf_size, 1)
+        nodes, order = [], []
+        # (primitive indices, node waiting for this as its right child, axis for the median split)
+        stack = [(np.arange(len(bounds_min)), -1, 0)]
+        while stack:
+            indices, parent, axis = stack.pop()
+            index = len(nodes)
+            if parent >= 0:
+                nodes[parent][2] = index
+            node = [bounds_min[indices].min(axis=0), bounds_max[indices].max(axis=0), -1, 0]
+            nodes.append(node)
+            if len(indices) <= leaf_size:
+                node[2], node[3] = len(order), len(indices)
+                order.extend(indices)
+                continue
+            if method == "median":
+                left, right = split_median(indices, centroids, axis)
+            else:
+                left, right, _ = split_sah(indices, bounds_min, bounds_max, centroids, n_bins)
+            stack.append((right, index, (axis + 1) % 3))
+            stack.append((left, -1, (axis + 1) % 3))
+
+        self.nodes = np.zeros(len(nodes), dtype=BVH_NODE)
+        self.nodes["min"] = [node[0] for node in nodes]
+        self.nodes["max"] = [node[1] for node in nodes]
+        self.nodes["offset"] = [node[2] for node in nodes]
+        self.nodes["count"] = [node[3] for node in nodes]
+        self.prim_indices = np.array(order, dtype=np.int64)
+        self._node_list = None
+        self._node_fields = None  # see node_fields
+        self._levels = None  # for refit
+
+    @classmethod
+    def from_arrays(cls, nodes, prim_indices, node_fields=None):
+        """Wraps already built node/primitive arrays (no copy); node_fields, if given, is what node_fields returns
+        (e.g. stored with the nodes, see mesh_store)"""
+        bvh = cls.__new__(cls)
+        bvh.nodes, bvh.prim_indices = nodes, prim_indices
+        bvh._node_list = bvh._levels = None
+        bvh._node_fields = node_fields
+        return bvh
+
+    def node_fields(self):
+        """(min, max, offset, count) of every node as separate contiguous arrays, offsets and counts as int64.
+        Made on first use and kept; the batched traversals (candidate_pairs, kernels.py) read these"""
+        if self._node_fields is None:
+            self._node_fields = (np.ascontiguousarray(self.nodes["min"]), np.ascontiguousarray(self.nodes["max"]),
+                                 self.nodes["offset"].astype(np.int64), self.nodes["count"].astype(np.int64))
+        return self._node_fields
+
+    def _nodes_as_tuples(self):
+        # Per-ray traversal reads plain tuples; indexing the structured array one field at a time is far slower.
+        # Built on first use, so trees only used for batched tracing never make them
+        if self._node_list is None:
+            self._node_list = list(zip(*self.nodes["min"].T.tolist(), *self.nodes["max"].T.tolist(),
+                                       self.nodes["offset"].tolist(), self.nodes["count"].tolist()))
+        return self._node_list
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return f"FlatBVH obj: {len(self.nodes)} nodes over {len(self.prim_indices)} primitives"
+
+    def _node_depths(self):
+        depth = np.zeros(len(self.nodes), dtype=np.int64)
+        depth[0] = 1
+        # Children always come after their parent
+        for index in np.nonzero(self.nodes["count"] == 0)[0]:
+            depth[index + 1] = depth[self.nodes["offset"][index]] = depth[index] + 1
+        return depth
+
+    def refit(self, bounds_min, bounds_max):
+        """Recomputes every node's box from new primitive bounds (same primitives, moved), keeping the tree:
+        leaves from their primitives, then interior nodes from their children, deepest first, one level at a time.
+        Linear in the nodes, but the boxes get looser as primitives move away from where the tree was built;
+        sah_cost tells how much"""
+        if not self.nodes.flags.writeable:  # e.g. memory-mapped from scene_cache
+            self.nodes = self.nodes.copy()
+        if self._levels is None:
+            depth = self._node_depths()
+            interior = np.nonzero(self.nodes["count"] == 0)[0]
+            self._levels = (np.nonzero(self.nodes["count"] > 0)[0],
+                            [interior[depth[interior] == level] for level in range(depth.max(), 0, -1)])
+        leaves, levels = self._levels
+        # Leaves come in the order of their primitive ranges, which follow on from each other
+        offsets = self.nodes["offset"][leaves]
+        node_min, node_max = self.nodes["min"], self.nodes["max"]
+        node_min[leaves] = np.minimum.reduceat(bounds_min[self.prim_indices], offsets)
+        node_max[leaves] = np.maximum.reduceat(bounds_max[self.prim_indices], offsets)
+        for level in levels:
+            right = self.nodes["offset"][level]
+            node_min[level] = np.minimum(node_min[level + 1], node_min[right])
+            node_max[level] = np.maximum(node_max[level + 1], node_max[right])
+        self._node_list = self._node_fields = None
+
+    def sah_cost(self):
+        """SAH cost of the tree, relative to its root box (so it doesn't change with the scene's scale)"""
+        root_area = surface_area(self.nodes["min"][0], self.nodes["max"][0])
+        areas = surface_area(self.nodes["min"], self.nodes["max"]) / root_area
+        counts = self.nodes["count"]
+        leaves = counts > 0
+        return float((areas[leaves] * counts[leaves]).sum() * INTERSECTION_COST +
+                     areas[~leaves].sum() * TRAVERSAL_COST)
+
+    @staticmethod
+    def _entry_function(ray_to_test):
+        """Slab test specialised to one ray: entry(node tuple) gives the distance at which the ray enters the
+        node's box, or None if it misses"""
+        o, d = ray_to_test.origin, ray_to_test.direction
+        ox, oy, oz = o.x, o.y, o.z
+        ix, iy, iz = (1.0 / c if c != 0 else 1e300 for c in (d.x, d.y, d.z))
+        # Which corner each slab is entered from, by the sign of the direction (min is 0-2, max is 3-5)
+        nx, ny, nz = (0 if i >= 0 else 3 for i in (ix, iy, iz))
+        fx, fy, fz = 3 - nx, 4 - ny, 5 - nz
+        ny, nz = ny + 1, nz + 2
+
+        def entry(node):
+            t_near = (node[nx] - ox) * ix
+            t_far = (node[fx] - ox) * ix
+            t_y = (node[ny] - oy) * iy
+            if t_y > t_near:
+                t_near = t_y
+            t_y = (node[fy] - oy) * iy
+            if t_y < t_far:
+                t_far = t_y
+            t_z = (node[nz] - oz) * iz
+            if t_z > t_near:
+                t_near = t_z
+            t_z = (node[fz] - oz) * iz
+            if t_z < t_far:
+                t_far = t_z
+            if t_near > t_far or t_far < 0:
+                return None
+            return t_near
+        return render_stats.counted("box_tests", entry) if render_stats.enabled else entry
+
+    def intersect(self, ray_to_test, leaf_intersect):
+        """Closest-hit traversal with an explicit stack: the nearer child is visited first and nodes entered past
+        ray_to_test.nearest_hit_distance are skipped. leaf_intersect(first, count, ray) tests one leaf's range and
+        returns something truthy on a hit (after updating the ray); the last such result is returned, else False"""
+        entry = self._entry_function(ray_to_test)
+        node_list = self._nodes_as_tuples()
+
+        root_entry = entry(node_list[0])
+        if root_entry is None:
+            return False
+        obj_hit = False
+        stack = [(root_entry, 0)]
+        while stack:
+            t_entry, index = stack.pop()
+            if t_entry > ray_to_test.nearest_hit_distance:
+                continue
+            node = node_list[index]
+            if node[7] > 0:
+                new_hit = leaf_intersect(node[6], node[7], ray_to_test)
+                if new_hit is not None and new_hit is not False:
+                    obj_hit = new_hit
+                continue
+            left, right = index + 1, node[6]
+            left_entry, right_entry = entry(node_list[left]), entry(node_list[right])
+            # Push the farther child first so the nearer one is popped next
+            if left_entry is not None and right_entry is not None:
+                if left_entry <= right_entry:
+                    stack.append((right_entry, right))
+                    stack.append((left_entry, left))
+                else:
+                    stack.append((left_entry, left))
+                    stack.append((right_entry, right))
+            elif left_entry is not None:
+                stack.append((left_entry, left))
+            elif right_entry is not None:
+                stack.append((right_entry, right))
+        return obj_hit
+
+    def occluded(self, ray_to_test, leaf_occluded):
+        """Any-hit traversal for shadow rays: stops at the first leaf where leaf_occluded(first, count, ray) returns
+        something other than None (what blocks the ray) and returns that; None if nothing does.
+        Child order doesn't matter here, so there is no sorting"""
+        entry = self._entry_function(ray_to_test)
+        node_list = self._nodes_as_tuples()
+        t_limit = ray_to_test.nearest_hit_distance
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            node = node_list[index]
+            t_entry = entry(node)
+            if t_entry is None or t_entry > t_limit:
+                continue
+            if node[7] > 0:
+                blocker = leaf_occluded(node[6], node[7], ray_to_test)
+                if blocker is not None:
+                    return blocker
+                continue
+            stack.append(node[6])
+            stack.append(index + 1)
+        return None
+
+    def candidate_pairs(self, origins, directions, t_max):
+        """Walks many rays down the tree together, one level at a time. Returns (ray index, primitive slot) for every
+        leaf primitive whose box a ray enters before its t_max; slots index prim_indices.
+        The first PACKET_LEVELS levels are walked by packets of rays (ray_packets), so nodes near the root are
+        tested once per packet instead of once per ray; then every ray of a packet goes on by itself"""
+        inv_directions = inverse_directions(directions)
+        node_min, node_max, offset, count = self.node_fields()
+
+        first, size, origin_min, origin_max, inv_min, inv_max, reach_min, reach_max = \
+            ray_packets(origins, directions, inv_directions, t_max)
+        pair_packet = np.arange(len(first))
+        pair_node = np.zeros(len(first), dtype=np.int64)
+        leaf_packets, leaf_nodes = [pair_packet[:0]], [pair_node[:0]]
+        for _ in range(PACKET_LEVELS):
+            if not pair_packet.size:
+                break
+            t_near, t_far = packet_slab_entry(node_min[pair_node], node_max[pair_node], origin_min[pair_packet],
+                                              origin_max[pair_packet], inv_min[pair_packet], inv_max[pair_packet])
+            hit = ((t_near <= t_far) & (t_far >= 0) & (node_min[pair_node] <= reach_max[pair_packet]).all(axis=1) &
+                   (node_max[pair_node] >= reach_min[pair_packet]).all(axis=1))
+            pair_packet, pair_node = pair_packet[hit], pair_node[hit]
+            at_leaf = count[pair_node] > 0
+            leaf_packets.append(pair_packet[at_leaf])
+            leaf_nodes.append(pair_node[at_leaf])
+            pair_packet, pair_node = pair_packet[~at_leaf], pair_node[~at_leaf]
+            pair_packet = np.concatenate((pair_packet, pair_packet))
+            pair_node = np.concatenate((pair_node + 1, offset[pair_node]))
+
+        def rays_of(pair_packet, pair_node):
+            counts = size[pair_packet]
+            starts = np.cumsum(counts) - counts
+            return np.repeat(first[pair_packet] - starts, counts) + np.arange(counts.sum()), np.repeat(pair_node, counts)
+
+        # Leaves packets reached still need each ray's own test, like the nodes below PACKET_LEVELS
+        leaf_rays, leaf_nodes = rays_of(np.concatenate(leaf_packets), np.concatenate(leaf_nodes))
+        t_near, t_far = slab_entry(node_min[leaf_nodes], node_max[leaf_nodes], origins[leaf_rays],
+                                   inv_directions[leaf_rays])
+        hit = (t_near <= t_far) & (t_far >= 0) & (t_near <= t_max[leaf_rays])
+        leaf_rays, leaf_nodes = [leaf_rays[hit]], [leaf_nodes[hit]]
+        pair_ray, pair_node = rays_of(pair_packet, pair_node)
+        while pair_ray.size:
+            t_near, t_far = slab_entry(node_min[pair_node], node_max[pair_node],
+                                       origins[pair_ray], inv_directions[pair_ray])
+            hit = (t_near <= t_far) & (t_far >= 0) & (t_near <= t_max[pair_ray])
+            pair_ray, pair_node = pair_ray[hit], pair_node[hit]
+            at_leaf = count[pair_node] > 0
+            leaf_rays.append(pair_ray[at_leaf])
+            leaf_nodes.append(pair_node[at_leaf])
+            pair_ray, pair_node = pair_ray[~at_leaf], pair_node[~at_leaf]
+            pair_ray = np.concatenate((pair_ray, pair_ray))
+            pair_node = np.concatenate((pair_node + 1, offset[pair_node]))
+
+        pair_ray, pair_node = np.concatenate(leaf_rays), np.concatenate(leaf_nodes)
+        counts = count[pair_node]
+        starts = np.cumsum(counts) - counts
+        slots = np.repeat(offset[pair_node] - starts, counts) + np.arange(counts.sum())
+        return np.repeat(pair_ray, counts), slots
+
+    def primitive_rays(self, origins, directions, t_max):
+        """(primitive index, indices of the rays reaching its leaf) for every primitive some ray reaches,
+        in primitive order"""
+        pair_ray, slot = self.candidate_pairs(origins, directions, t_max)
+        pair_primitive = self.prim_indices[slot]
+        order = np.argsort(pair_primitive, kind="stable")
+        pair_ray, pair_primitive = pair_ray[order], pair_primitive[order]
+        primitives, starts = np.unique(pair_primitive, return_index=True)
+        return zip(primitives.tolist(), np.split(pair_ray, starts[1:]))
+
+    def get_stats(self):
+        """Same report as BoundingBox.get_stats"""
+        counts = self.nodes["count"]
+        leaves = counts > 0
+        depth = self._node_depths()
+        return {"objects": int(counts.sum()), "nodes": len(self.nodes), "leaves": int(leaves.sum()),
+                "depth": int(depth.max()), "min_leaf_objects": int(counts[leaves].min()),
+                "max_leaf_objects": int(counts[leaves].max()), "mean_leaf_objects": float(counts[leaves].mean()),
+                "sah_cost": self.sah_cost()}
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"{self}: {stats['objects']} objects, {stats['nodes']} nodes, depth {stats['depth']}, "
+              f"{stats['leaves']} leaves holding {stats['min_leaf_objects']}-{stats['max_leaf_objects']} "
+              f"(mean {round(stats['mean_leaf_objects'], 2)}) objects, SAH cost {round(stats['sah_cost'], 2)}")
+
+
+def object_bounds(obj):
+    """(min corner, max corner) arrays of anything SceneBVH holds"""
+    if isinstance(obj, Sphere):
+        center = np.array([obj.pos.x, obj.pos.y, obj.pos.z])
+        return center - obj.radius, center + obj.radius
+    if isinstance(obj, Triangle):
+        bounds_min, bounds_max, _ = triangle_bounds([obj])
+        return bounds_min[0], bounds_max[0]
+    if type(obj) == BoundingBox:
+        return (np.array([obj.min_point.x, obj.min_point.y, obj.min_point.z]),
+                np.array([obj.max_point.x, obj.max_point.y, obj.max_point.z]))
+    return obj.bounds()  # TriangleMesh, MeshInstance, InstanceGroup, SceneBVH
+
+
+class SceneBVH:
+    """Top-level BVH over a whole objects_list: Spheres, Triangles, BoundingBoxes, TriangleMeshes, MeshInstances,
+    InstanceGroups (anything object_bounds knows). Goes in objects_list in place of them, so ray_intersection and
+    shadow rays only test the objects whose boxes a ray passes through instead of every one of them.
+    Where two objects are hit at the same t, the later one in objects_list wins, as with triangles in
+    ray_intersection"""
+
+    def __init__(self, objects_list, leaf_size=1, method="sah"):
+        self.objects = list(objects_list)
+        bounds = [object_bounds(obj) for obj in self.objects]
+        self.bvh = FlatBVH(np.array([low for low, _ in bounds]), np.array([high for _, high in bounds]),
+                           leaf_size=leaf_size, method=method)
+        self._best_object = -1
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __repr__(self):
+        return f"SceneBVH: {len(self)} objects, {len(self.bvh)} nodes"
+
+    def bounds(self):
+        return self.bvh.nodes["min"][0], self.bvh.nodes["max"][0]
+
+    def refit(self):
+        """Refits the tree to where the objects are now (after moving meshes with TriangleMesh.pose)"""
+        bounds = [object_bounds(obj) for obj in self.objects]
+        self.bvh.refit(np.array([low for low, _ in bounds]), np.array([high for _, high in bounds]))
+
+    def intersect(self, ray_to_test):
+        """Like BoundingBox.intersect: the object hit or False"""
+        self._best_object = -1
+        return self.bvh.intersect(ray_to_test, self._intersect_leaf)
+
+    def _intersect_leaf(self, first, count, ray_to_test):
+        best = None
+        for index in self.bvh.prim_indices[first:first + count].tolist():
+            obj = self.objects[index]
+            nearest_hit_distance = ray_to_test.nearest_hit_distance
+            obj_hit = obj.intersect(ray_to_test)
+            if not obj_hit:
+                continue
+            if ray_to_test.nearest_hit_distance == nearest_hit_distance and index < self._best_object:
+                continue
+            # Spheres and Triangles just say whether they were hit; the others return what they hit
+            self._best_object, best = index, obj if obj_hit is True else obj_hit
+        return best
+
+    def occluded(self, ray_to_test):
+        return self.occluder(ray_to_test) is not None
+
+    def occluder(self, ray_to_test):
+        return self.bvh.occluded(ray_to_test, self._occluder_leaf)
+
+    def _occluder_leaf(self, first, count, ray_to_test):
+        for index in self.bvh.prim_indices[first:first + count].tolist():
+            blocker = self.objects[index].occluder(ray_to_test)
+            if blocker is not None:
+                return blocker
+        return None
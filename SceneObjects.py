@@ -1,11 +1,16 @@
-from vector import Vec3
+from vector import Vec3, from_floats
+import render_stats
+import kernels
 from copy import deepcopy
 from math import sqrt, trunc, pi
+import numpy as np
 
 
 class Triangle:
     """Tuple of 3 points (Vec3's)"""
     # TODO Add bounding box stuff
+    __slots__ = ("A", "B", "C", "normal", "diffuse", "reflectiveness", "shininess", "parent")
+
     def __init__(self, pt_a, pt_b, pt_c, input_normal=None, input_color=Vec3(255, 255, 255),
                  reflectiveness=0, shininess=8.0, parent=None):
         self.A = pt_a
@@ -53,6 +58,8 @@ class Triangle:
 
     def intersect(self, ray_to_test):
         """Based on Ray-Triangle Intersection algorithm in Shirley and Marschner, pg 77-81"""
+        if render_stats.enabled:
+            render_stats.count("triangle_tests")
         direction = ray_to_test.direction
 
         # Pre-check for normal pointed towards ray's origin
@@ -60,16 +67,15 @@ class Triangle:
             return False
 
         # Saving to variables to prevent coding too much
-        a_ = self.A.x - self.B.x
-        b_ = self.A.y - self.B.y
-        c_ = self.A.z - self.B.z
-        d_ = self.A.x - self.C.x
-        e_ = self.A.y - self.C.y
-        f_ = self.A.z - self.C.z
-        g_, h_, i_ = ray_to_test.direction.x, ray_to_test.direction.y, ray_to_test.direction.z
-        j_, k_, l_ = self.A.x - ray_to_test.origin.x, \
-                     self.A.y - ray_to_test.origin.y, \
-                     self.A.z - ray_to_test.origin.z
+        pt_a, pt_b, pt_c, origin = self.A, self.B, self.C, ray_to_test.origin
+        a_ = pt_a.x - pt_b.x
+        b_ = pt_a.y - pt_b.y
+        c_ = pt_a.z - pt_b.z
+        d_ = pt_a.x - pt_c.x
+        e_ = pt_a.y - pt_c.y
+        f_ = pt_a.z - pt_c.z
+        g_, h_, i_ = direction.x, direction.y, direction.z
+        j_, k_, l_ = pt_a.x - origin.x, pt_a.y - origin.y, pt_a.z - origin.z
 
         # Saving More variables
         ei_min_hf = e_ * i_ - h_ * f_
@@ -106,6 +112,456 @@ class Triangle:
         ray_to_test.nearest_hit_distance = t_of_hit
         return True
 
+    def occluded(self, ray_to_test):
+        """Any-hit test for shadow rays: whether intersect would hit, leaving nearest_hit_distance as is"""
+        nearest_hit_distance = ray_to_test.nearest_hit_distance
+        blocked = self.intersect(ray_to_test)
+        ray_to_test.nearest_hit_distance = nearest_hit_distance
+        return blocked
+
+    def occluder(self, ray_to_test):
+        """What blocks the shadow ray (this object) or None, like the occluder of the containers"""
+        return self if self.occluded(ray_to_test) else None
+
+
+def _dot(a, b):
+    """Row-wise dot product, summed in the same order as Vec3.dot"""
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+
+def triangle_hits(origins, directions, pt_a, edge_ab, edge_ac, normal, t_current, initial_offset=0.0001):
+    """Vectorized Triangle.intersect; origins/directions and the triangle arrays broadcast against each other.
+    edge_ab is A - B and edge_ac is A - C, as in Triangle.intersect. Returns (hit mask, t of hit)"""
+    if kernels.backend == "numba" and origins.ndim == 2 and (pt_a.ndim == 1 or pt_a.shape == origins.shape):
+        if render_stats.enabled:
+            render_stats.count("triangle_tests", len(origins))
+        return kernels.triangle_hits(origins, directions, pt_a, edge_ab, edge_ac, normal, t_current, initial_offset)
+    a_, b_, c_ = edge_ab[..., 0], edge_ab[..., 1], edge_ab[..., 2]
+    d_, e_, f_ = edge_ac[..., 0], edge_ac[..., 1], edge_ac[..., 2]
+    g_, h_, i_ = directions[..., 0], directions[..., 1], directions[..., 2]
+    j_ = pt_a[..., 0] - origins[..., 0]
+    k_ = pt_a[..., 1] - origins[..., 1]
+    l_ = pt_a[..., 2] - origins[..., 2]
+
+    ei_min_hf = e_ * i_ - h_ * f_
+    gf_min_di = g_ * f_ - d_ * i_
+    dh_min_eg = d_ * h_ - e_ * g_
+    ak_min_jb = a_ * k_ - j_ * b_
+    jc_min_al = j_ * c_ - a_ * l_
+    bl_min_kc = b_ * l_ - k_ * c_
+
+    m_denominator = a_ * ei_min_hf + b_ * gf_min_di + c_ * dh_min_eg
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_of_hit = -(f_ * ak_min_jb + e_ * jc_min_al + d_ * bl_min_kc) / m_denominator
+        gamma = (i_ * ak_min_jb + h_ * jc_min_al + g_ * bl_min_kc) / m_denominator
+        beta = (j_ * ei_min_hf + k_ * gf_min_di + l_ * dh_min_eg) / m_denominator
+    alpha = 1 - gamma - beta
+
+    hit = _dot(normal, directions) <= 0
+    hit &= m_denominator != 0.0
+    hit &= (t_of_hit >= initial_offset) & (t_of_hit <= t_current)
+    hit &= (gamma >= 0) & (gamma <= 1)
+    hit &= (beta >= 0) & (beta <= 1)
+    hit &= (alpha >= 0) & (alpha <= 1)
+    if render_stats.enabled:
+        render_stats.count("triangle_tests", hit.size)
+    return hit, t_of_hit
+
+
+# Everything TriangleMesh.to_arrays hands out besides the BVH
+MESH_ARRAYS = ("A", "B", "C", "edge_ab", "edge_ac", "normals", "material_ids", "diffuse", "reflectiveness",
+               "shininess")
+
+
+class TriangleMesh:
+    """Many triangles stored as contiguous arrays (one row per face) instead of one Triangle per face.
+    Edges A-B and A-C are precomputed; colors etc. live in a small material table indexed by material_ids"""
+
+    def __init__(self, pt_a, pt_b, pt_c, normals=None, material_ids=None, input_color=Vec3(255, 255, 255),
+                 reflectiveness=0, shininess=8.0, parent=None):
+        self.A = np.array(pt_a, dtype=np.float64)
+        self.B = np.array(pt_b, dtype=np.float64)
+        self.C = np.array(pt_c, dtype=np.float64)
+        self.parent = parent
+        self.bvh = None
+        self.rest_pose = None  # (A, B, C, normals) that pose() transforms, set by its first call
+        self.store_path = None  # the mesh_store its arrays are memory-mapped from, set by mesh_store.open_store
+
+        if normals is not None:
+            self.normals = np.array(normals, dtype=np.float64)
+        else:
+            self.calc_normals()
+
+        self.set_material(input_color, reflectiveness, shininess)
+        if material_ids is not None:
+            self.material_ids = np.array(material_ids, dtype=np.int32)
+        self.update()
+
+    def __len__(self):
+        return len(self.A)
+
+    def __repr__(self):
+        return f"TriangleMesh: {len(self)} faces, {len(self.diffuse)} materials, parent = {self.parent}"
+
+    def update(self):
+        """Recomputes the precomputed edges; call after changing A, B or C. Drops the BVH (call build_bvh again)"""
+        self.edge_ab = self.A - self.B
+        self.edge_ac = self.A - self.C
+        self.bvh = None
+        self._face_list = None
+
+    def pose(self, transform_matrix):
+        """Puts the mesh where a 4x4 matrix (rotation, uniform scale, translation) takes its rest pose: the faces
+        as they were the first time pose was called. Unlike transform, faces stay in order and the BVH is refit
+        (BHV_BBox.FlatBVH.refit) instead of dropped, so animations only pay for a linear pass per frame.
+        Normals are rotated rather than recalculated, so flipped ones stay flipped"""
+        if self.rest_pose is None:
+            self.rest_pose = (self.A, self.B, self.C, self.normals)
+        rest_a, rest_b, rest_c, rest_normals = self.rest_pose
+        rotation, translation = transform_matrix[:3, :3], transform_matrix[:3, 3]
+        self.A = rest_a.dot(rotation.T) + translation
+        self.B = rest_b.dot(rotation.T) + translation
+        self.C = rest_c.dot(rotation.T) + translation
+        normals = rest_normals.dot(rotation.T)
+        self.normals = normals / np.sqrt(_dot(normals, normals))[:, None]
+        self.edge_ab = self.A - self.B
+        self.edge_ac = self.A - self.C
+        self._face_list = None
+        if self.bvh is not None:
+            self.bvh.refit(np.minimum(np.minimum(self.A, self.B), self.C),
+                           np.maximum(np.maximum(self.A, self.B), self.C))
+
+    def calc_normals(self):
+        """Same as Triangle.calc_normal for every face"""
+        vec_ab = self.B - self.A
+        vec_ac = self.C - self.A
+        cross_vec = np.empty_like(vec_ab)
+        cross_vec[:, 0] = vec_ab[:, 1] * vec_ac[:, 2] - vec_ab[:, 2] * vec_ac[:, 1]
+        cross_vec[:, 1] = vec_ab[:, 2] * vec_ac[:, 0] - vec_ab[:, 0] * vec_ac[:, 2]
+        cross_vec[:, 2] = vec_ab[:, 0] * vec_ac[:, 1] - vec_ab[:, 1] * vec_ac[:, 0]
+        self.normals = cross_vec / np.sqrt(_dot(cross_vec, cross_vec))[:, None]
+
+    def set_material(self, input_color, reflectiveness=0, shininess=8.0):
+        """Gives every face the same single material"""
+        self.diffuse = np.array([[input_color.x, input_color.y, input_color.z]])
+        self.reflectiveness = np.array([float(reflectiveness)])
+        self.shininess = np.array([float(shininess)])
+        self.material_ids = np.zeros(len(self.A), dtype=np.int32)
+
+    def transform(self, transform_matrix):
+        """Applies a 4x4 matrix to every vertex and recalculates the normals"""
+        rotation, translation = transform_matrix[:3, :3], transform_matrix[:3, 3]
+        self.A = self.A.dot(rotation.T) + translation
+        self.B = self.B.dot(rotation.T) + translation
+        self.C = self.C.dot(rotation.T) + translation
+        self.calc_normals()
+        self.update()
+
+    def move(self, scale=1.0, offset=Vec3()):
+        """Scales every vertex about the origin, then translates by offset"""
+        offset = np.array([offset.x, offset.y, offset.z])
+        self.A = self.A * scale + offset
+        self.B = self.B * scale + offset
+        self.C = self.C * scale + offset
+        self.update()
+
+    def flip_normals(self):
+        self.normals = -1 * self.normals
+        self._face_list = None
+
+    def copy(self):
+        return deepcopy(self)
+
+    @staticmethod
+    def merge(meshes):
+        """One mesh holding the faces of all meshes (materials kept per face); parent taken from the first"""
+        material_offsets = np.cumsum([0] + [len(mesh.diffuse) for mesh in meshes[:-1]])
+        merged = TriangleMesh(np.concatenate([mesh.A for mesh in meshes]),
+                              np.concatenate([mesh.B for mesh in meshes]),
+                              np.concatenate([mesh.C for mesh in meshes]),
+                              normals=np.concatenate([mesh.normals for mesh in meshes]),
+                              parent=meshes[0].parent)
+        merged.diffuse = np.concatenate([mesh.diffuse for mesh in meshes])
+        merged.reflectiveness = np.concatenate([mesh.reflectiveness for mesh in meshes])
+        merged.shininess = np.concatenate([mesh.shininess for mesh in meshes])
+        merged.material_ids = np.concatenate([mesh.material_ids + offset
+                                              for mesh, offset in zip(meshes, material_offsets)]).astype(np.int32)
+        return merged
+
+    def bounds(self):
+        """(min corner, max corner) of all faces as arrays"""
+        if self.store_path is not None:
+            # The root box is the same, and doesn't read every face in from disk
+            return np.array(self.bvh.nodes["min"][0]), np.array(self.bvh.nodes["max"][0])
+        return (np.minimum(np.minimum(self.A, self.B), self.C).min(axis=0),
+                np.maximum(np.maximum(self.A, self.B), self.C).max(axis=0))
+
+    def build_bvh(self, leaf_size=4, method="sah", n_bins=12):
+        """Builds a FlatBVH over the faces and reorders the faces to match it, so every leaf is a contiguous
+        range of faces. Build after moving/transforming the mesh"""
+        from BHV_BBox import FlatBVH
+        bvh = FlatBVH(np.minimum(np.minimum(self.A, self.B), self.C), np.maximum(np.maximum(self.A, self.B), self.C),
+                      centroids=(self.A + self.B + self.C) / 3, leaf_size=leaf_size, method=method, n_bins=n_bins)
+        order = bvh.prim_indices
+        self.A, self.B, self.C = self.A[order], self.B[order], self.C[order]
+        self.normals, self.material_ids = self.normals[order], self.material_ids[order]
+        if self.rest_pose is not None:
+            self.rest_pose = tuple(array[order] for array in self.rest_pose)
+        self.update()
+        bvh.prim_indices = np.arange(len(order))
+        self.bvh = bvh
+        return bvh
+
+    def _faces_as_tuples(self):
+        # BVH leaves are tested one ray at a time in plain Python, where per-face tuples beat small array slices.
+        # Built on first use, so meshes only used for batched tracing never make them
+        self._check_per_ray()
+        if self._face_list is None:
+            self._face_list = list(zip(*self.A.T.tolist(), *self.edge_ab.T.tolist(), *self.edge_ac.T.tolist(),
+                                       *self.normals.T.tolist()))
+        return self._face_list
+
+    def _check_per_ray(self):
+        if self.store_path is not None:
+            # The tuples of _faces_as_tuples and FlatBVH._nodes_as_tuples would read the whole store into memory
+            raise ValueError(f"The mesh stored at {self.store_path} can only be traced batched, not one ray at a time")
+
+    def to_arrays(self):
+        """Every array of the mesh (and its BVH) by name, for from_arrays"""
+        arrays = {name: getattr(self, name) for name in MESH_ARRAYS}
+        if self.bvh is not None:
+            arrays["bvh_nodes"], arrays["bvh_prim_indices"] = self.bvh.nodes, self.bvh.prim_indices
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, parent=None):
+        """Wraps arrays from to_arrays (e.g. views of shared memory) without copying them"""
+        from BHV_BBox import FlatBVH
+        mesh = cls.__new__(cls)
+        for name in MESH_ARRAYS:
+            setattr(mesh, name, arrays[name])
+        mesh.parent = parent
+        mesh.bvh = None
+        mesh.rest_pose = None
+        mesh.store_path = None
+        if "bvh_nodes" in arrays:
+            mesh.bvh = FlatBVH.from_arrays(arrays["bvh_nodes"], arrays["bvh_prim_indices"])
+        mesh._face_list = None
+        return mesh
+
+    def face(self, index):
+        return MeshFace(self, index)
+
+    def intersect_face(self, index, ray_to_test):
+        """Triangle.intersect for a single face"""
+        o, d = ray_to_test.origin, ray_to_test.direction
+        hit, t_of_hit = triangle_hits(np.array([o.x, o.y, o.z]), np.array([d.x, d.y, d.z]), self.A[index],
+                                      self.edge_ab[index], self.edge_ac[index], self.normals[index],
+                                      ray_to_test.nearest_hit_distance, ray_to_test.initial_offset)
+        if not hit:
+            return False
+        ray_to_test.nearest_hit_distance = float(t_of_hit)
+        return True
+
+    def intersect(self, ray_to_test):
+        """Like BoundingBox, returns the face hit (MeshFace) or False. Walks the BVH if one was built,
+        otherwise tests every face at once"""
+        if self.bvh is not None:
+            self._check_per_ray()
+            # A later leaf only takes an equal t from a higher face, the same tie rule as without the BVH
+            self._best_face = -1
+            index = self.bvh.intersect(ray_to_test, self._intersect_leaf)
+            return False if index is False else MeshFace(self, index)
+        o, d = ray_to_test.origin, ray_to_test.direction
+        hit, t_of_hit = triangle_hits(np.array([o.x, o.y, o.z]), np.array([d.x, d.y, d.z]), self.A,
+                                      self.edge_ab, self.edge_ac, self.normals,
+                                      ray_to_test.nearest_hit_distance, ray_to_test.initial_offset)
+        if not hit.any():
+            return False
+        index = _nearest_face(np.where(hit, t_of_hit, np.inf))
+        ray_to_test.nearest_hit_distance = float(t_of_hit[index])
+        return MeshFace(self, index)
+
+    def occluded(self, ray_to_test):
+        """Any-hit test for shadow rays: True if some face blocks the ray before its nearest_hit_distance
+        (left as is). With a BVH, stops at the first blocking leaf"""
+        return self.occluder(ray_to_test) is not None
+
+    def occluder(self, ray_to_test):
+        """occluded, returning the face that blocks the ray (MeshFace) or None"""
+        if self.bvh is not None:
+            self._check_per_ray()
+            return self.bvh.occluded(ray_to_test, self._occluder_leaf)
+        o, d = ray_to_test.origin, ray_to_test.direction
+        hit, _ = triangle_hits(np.array([o.x, o.y, o.z]), np.array([d.x, d.y, d.z]), self.A,
+                               self.edge_ab, self.edge_ac, self.normals,
+                               ray_to_test.nearest_hit_distance, ray_to_test.initial_offset)
+        return MeshFace(self, np.argmax(hit)) if hit.any() else None
+
+    def _occluder_leaf(self, first, count, ray_to_test):
+        index = self._intersect_leaf(first, count, ray_to_test, any_hit=True)
+        return None if index is None else MeshFace(self, index)
+
+    def _intersect_leaf(self, first, count, ray_to_test, any_hit=False):
+        """triangle_hits for the faces of one BVH leaf, in plain floats; returns the index of the face hit or None
+        (any_hit: the first face hit, without touching the ray)"""
+        if render_stats.enabled:
+            render_stats.count("triangle_tests", count)
+        o, d = ray_to_test.origin, ray_to_test.direction
+        g_, h_, i_ = d.x, d.y, d.z
+        initial_offset = ray_to_test.initial_offset
+        best = None
+        face_list = self._faces_as_tuples()
+        for index in range(first, first + count):
+            ax, ay, az, a_, b_, c_, d_, e_, f_, nx, ny, nz = face_list[index]
+            if nx * g_ + ny * h_ + nz * i_ > 0:
+                continue
+            j_, k_, l_ = ax - o.x, ay - o.y, az - o.z
+            ei_min_hf = e_ * i_ - h_ * f_
+            gf_min_di = g_ * f_ - d_ * i_
+            dh_min_eg = d_ * h_ - e_ * g_
+            m_denominator = a_ * ei_min_hf + b_ * gf_min_di + c_ * dh_min_eg
+            if m_denominator == 0.0:
+                continue
+            ak_min_jb = a_ * k_ - j_ * b_
+            jc_min_al = j_ * c_ - a_ * l_
+            bl_min_kc = b_ * l_ - k_ * c_
+            t_of_hit = -(f_ * ak_min_jb + e_ * jc_min_al + d_ * bl_min_kc) / m_denominator
+            if not initial_offset <= t_of_hit <= ray_to_test.nearest_hit_distance:
+                continue
+            gamma = (i_ * ak_min_jb + h_ * jc_min_al + g_ * bl_min_kc) / m_denominator
+            if not 0 <= gamma <= 1:
+                continue
+            beta = (j_ * ei_min_hf + k_ * gf_min_di + l_ * dh_min_eg) / m_denominator
+            if not 0 <= beta <= 1 or not 0 <= 1 - gamma - beta <= 1:
+                continue
+            if any_hit:
+                return index
+            if t_of_hit == ray_to_test.nearest_hit_distance and index < self._best_face:
+                continue
+            ray_to_test.nearest_hit_distance = t_of_hit
+            self._best_face = best = index
+        return best
+
+    def intersect_batch(self, origins, directions, t_max=None, initial_offset=0.0001, max_tests=1 << 21):
+        """Tests (N,3) rays against the faces; returns (t of nearest hit, face index or -1) per ray.
+        t_max (per ray) works like Ray.nearest_hit_distance; rays that miss keep it as their t"""
+        count = len(origins)
+        t = np.full(count, 1e20) if t_max is None else np.array(t_max, dtype=np.float64)
+        faces = np.full(count, -1, dtype=np.int64)
+        if self.bvh is not None and kernels.backend == "numba":
+            box_tests, triangle_tests = kernels.mesh_intersect(self, origins, directions, t, faces, initial_offset)
+            if render_stats.enabled:
+                render_stats.count("box_tests", box_tests)
+                render_stats.count("triangle_tests", triangle_tests)
+            return t, faces
+        if self.bvh is not None:
+            return self._intersect_batch_bvh(origins, directions, t, faces, initial_offset)
+        chunk = max(1, max_tests // max(len(self), 1))
+        for start in range(0, count, chunk):
+            stop = min(start + chunk, count)
+            hit, t_of_hit = triangle_hits(origins[start:stop, None], directions[start:stop, None], self.A,
+                                          self.edge_ab, self.edge_ac, self.normals, t[start:stop, None],
+                                          initial_offset)
+            rows = np.nonzero(hit.any(axis=1))[0]
+            if rows.size == 0:
+                continue
+            index = _nearest_face(np.where(hit[rows], t_of_hit[rows], np.inf))
+            t[start + rows] = t_of_hit[rows, index]
+            faces[start + rows] = index
+        return t, faces
+
+    def occluded_batch(self, origins, directions, t_max, initial_offset=0.0001, max_tests=1 << 21):
+        """Batched occluded: True where some face blocks the ray before t_max"""
+        return self.occluder_batch(origins, directions, t_max, initial_offset, max_tests) >= 0
+
+    def occluder_batch(self, origins, directions, t_max, initial_offset=0.0001, max_tests=1 << 21):
+        """Batched occluder: the index of a face blocking the ray before t_max, or -1"""
+        if self.bvh is not None and kernels.backend == "numba":
+            faces, box_tests, triangle_tests = kernels.mesh_occluder(self, origins, directions, t_max, initial_offset)
+            if render_stats.enabled:
+                render_stats.count("box_tests", box_tests)
+                render_stats.count("triangle_tests", triangle_tests)
+            return faces
+        faces = np.full(len(origins), -1, dtype=np.int64)
+        if self.bvh is not None:
+            pair_ray, pair_face = self.bvh.candidate_pairs(origins, directions, t_max)
+            hit, _ = triangle_hits(origins[pair_ray], directions[pair_ray], self.A[pair_face],
+                                   self.edge_ab[pair_face], self.edge_ac[pair_face], self.normals[pair_face],
+                                   t_max[pair_ray], initial_offset)
+            faces[pair_ray[hit]] = pair_face[hit]
+            return faces
+        chunk = max(1, max_tests // max(len(self), 1))
+        for start in range(0, len(origins), chunk):
+            stop = min(start + chunk, len(origins))
+            hit, _ = triangle_hits(origins[start:stop, None], directions[start:stop, None], self.A, self.edge_ab,
+                                   self.edge_ac, self.normals, t_max[start:stop, None], initial_offset)
+            faces[start:stop] = np.where(hit.any(axis=1), np.argmax(hit, axis=1), -1)
+        return faces
+
+    def _intersect_batch_bvh(self, origins, directions, t, faces, initial_offset):
+        """Only tests the (ray, face) pairs whose leaves the rays reach"""
+        pair_ray, pair_face = self.bvh.candidate_pairs(origins, directions, t)
+        hit, t_of_hit = triangle_hits(origins[pair_ray], directions[pair_ray], self.A[pair_face],
+                                      self.edge_ab[pair_face], self.edge_ac[pair_face], self.normals[pair_face],
+                                      t[pair_ray], initial_offset)
+        pair_ray, pair_face, t_of_hit = pair_ray[hit], pair_face[hit], t_of_hit[hit]
+        # Nearest per ray, ties to the higher face: sort by ray, then t, then descending face
+        order = np.lexsort((-pair_face, t_of_hit, pair_ray))
+        pair_ray, pair_face, t_of_hit = pair_ray[order], pair_face[order], t_of_hit[order]
+        first = np.ones(len(pair_ray), dtype=bool)
+        first[1:] = pair_ray[1:] != pair_ray[:-1]
+        t[pair_ray[first]] = t_of_hit[first]
+        faces[pair_ray[first]] = pair_face[first]
+        return t, faces
+
+
+def _nearest_face(t_of_hit):
+    """Index of the smallest t along the last axis; ties go to the later face, as when testing Triangles in order"""
+    last = t_of_hit.shape[-1] - 1
+    return last - np.argmin(t_of_hit[..., ::-1], axis=-1)
+
+
+class MeshFace:
+    """A single face of a TriangleMesh, handed out as the object hit (behaves like a Triangle)"""
+    def __init__(self, mesh, index):
+        self.mesh = mesh
+        self.index = int(index)
+
+    @property
+    def parent(self):
+        return self.mesh.parent
+
+    @property
+    def reflectiveness(self):
+        return float(self.mesh.reflectiveness[self.mesh.material_ids[self.index]])
+
+    @property
+    def shininess(self):
+        return float(self.mesh.shininess[self.mesh.material_ids[self.index]])
+
+    def get_color(self, point_hit=None):
+        return from_floats(*self.mesh.diffuse[self.mesh.material_ids[self.index]].tolist())
+
+    def get_normal(self, pos=None):
+        return from_floats(*self.mesh.normals[self.index].tolist())
+
+    def intersect(self, ray_to_test):
+        return self.mesh.intersect_face(self.index, ray_to_test)
+
+    def occluded(self, ray_to_test):
+        nearest_hit_distance = ray_to_test.nearest_hit_distance
+        blocked = self.intersect(ray_to_test)
+        ray_to_test.nearest_hit_distance = nearest_hit_distance
+        return blocked
+
+    def occluder(self, ray_to_test):
+        """What blocks the shadow ray (this object) or None, like the occluder of the containers"""
+        return self if self.occluded(ray_to_test) else None
+
+    def __repr__(self):
+        return f"Face {self.index} of {self.mesh}"
+
 
 class Sphere:
     def __init__(self, pos, radius, color=Vec3(255, 255, 255), reflectiveness=0, shininess=8.0, parent=None):
@@ -127,23 +583,29 @@ class Sphere:
 
     def intersect(self, ray_to_test):
         """Based on Ray-Sphere Intersection algorithm in Shirley and Marschner, pg 76-77"""
+        if render_stats.enabled:
+            render_stats.count("sphere_tests")
         # Put in terms like the book uses
         e = ray_to_test.origin  # Vec 3
         d = ray_to_test.direction  #  Vec3
         c = self.pos  # Vec3
         r = self.radius # Float
-        e_min_c = e - c # Vec3
+        # e - c and the dot products as plain floats, same arithmetic as the Vec3 versions
+        e_min_c_x, e_min_c_y, e_min_c_z = e.x - c.x, e.y - c.y, e.z - c.z
+        d_dot_e_min_c = d.x * e_min_c_x + d.y * e_min_c_y + d.z * e_min_c_z
+        d_dot_d = d.x * d.x + d.y * d.y + d.z * d.z
 
-        discriminant = pow((d.dot(e_min_c)),2) - d.dot(d)*((e_min_c).dot(e_min_c) - pow(r, 2))
+        discriminant = pow(d_dot_e_min_c, 2) - d_dot_d*((e_min_c_x * e_min_c_x + e_min_c_y * e_min_c_y +
+                                                         e_min_c_z * e_min_c_z) - pow(r, 2))
         if discriminant < 0:
             return False  # no real solution
         elif -0.0000001 < discriminant < 0.0000001:
-            t_of_hit = -d.dot(e_min_c)/d.dot(d)
+            t_of_hit = -d_dot_e_min_c/d_dot_d
             if t_of_hit < ray_to_test.nearest_hit_distance:
                 ray_to_test.nearest_hit_distance = t_of_hit
                 return True
         else:
-            rest_of_equ = -d.dot(e_min_c) / d.dot(d)
+            rest_of_equ = -d_dot_e_min_c / d_dot_d
             sqrt_disc = sqrt(discriminant)
             smaller_t = rest_of_equ - sqrt_disc
             larger_t = rest_of_equ + sqrt_disc
@@ -156,6 +618,17 @@ class Sphere:
             else:
                 return False
 
+    def occluded(self, ray_to_test):
+        """Any-hit test for shadow rays: whether intersect would hit, leaving nearest_hit_distance as is"""
+        nearest_hit_distance = ray_to_test.nearest_hit_distance
+        blocked = self.intersect(ray_to_test)
+        ray_to_test.nearest_hit_distance = nearest_hit_distance
+        return bool(blocked)
+
+    def occluder(self, ray_to_test):
+        """What blocks the shadow ray (this object) or None, like the occluder of the containers"""
+        return self if self.occluded(ray_to_test) else None
+
 
 class CheckeredSphere(Sphere):
     def get_color(self, point_hit):
@@ -0,0 +1,103 @@
+import time
+import numpy as np
+from vector import Vec3
+from batch_trace import BatchScene, pixel_rays, _mix, SILH_THICKNESS
+from gbuffer_render import trace_gbuffer, gbuffer_edges, silhouette_width, _neighbours
+from raster_visibility import RasterVisibility
+
+"""Adaptive antialiasing for the batched tracer.
+ray_trace(multiple=True) spends four jittered samples on every pixel, flat background and cel-shaded bands
+included. Here every pixel first gets one sample through its center. Only pixels whose color differs from a
+neighbour's by more than contrast (any channel, 0-255), or that border another object or a depth jump, get more:
+the sample count doubles each round, up to max_samples, and a pixel drops out as soon as its samples agree
+to within contrast. Samples sit on a per-pixel rotated R2 sequence, so they are spread over the pixel and
+the same for any batching."""
+
+# Plastic constant steps of the R2 low discrepancy sequence
+R2_STEP = (0.7548776662466927, 0.5698402909980532)
+
+
+def sample_offsets(keys, sample_index):
+    """Sub-pixel (x, y) offsets in [-0.5, 0.5) of sample sample_index (> 0) of the pixels with the given keys"""
+    rotation = _mix(keys)
+    start = np.stack(((rotation >> np.uint64(11)).astype(np.float64) * 2.0 ** -53,
+                      (_mix(rotation) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53), axis=-1)
+    return (start + sample_index[:, None] * np.array(R2_STEP)) % 1.0 - 0.5
+
+
+def needs_samples(colors, ids, depth, contrast, depth_jump):
+    """Pixels whose color differs from a neighbour's (8-neighbourhood) by more than contrast in any channel,
+    or whose neighbour is on another object or more than depth_jump (relative) nearer or farther"""
+    refine = np.zeros(ids.shape, dtype=bool)
+    for _, _, other_colors in _neighbours(colors, -1, 1):
+        refine |= (np.abs(other_colors - colors) > contrast).any(axis=-1)
+    for _, _, other_ids in _neighbours(ids, -1, 1):
+        refine |= other_ids != ids
+    if depth_jump is not None:
+        for _, _, other_depth in _neighbours(depth, -1, 1):
+            refine |= np.abs(other_depth - depth) > depth_jump * np.minimum(other_depth, depth)
+    return refine
+
+
+def render_scene_adaptive(scene, width, height, eye_location, max_bounces=1, cel_shaded=False, image_data=None,
+                          max_samples=8, contrast=16.0, depth_jump=0.1, silhouettes=False,
+                          silh_thickness=SILH_THICKNESS, rows_per_batch=16, seed=0, pixels_per_batch=4096,
+                          rasterize=False):
+    """render_adaptive for an already built BatchScene"""
+    if image_data is None:
+        image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    start_time = time.time()
+    primary = RasterVisibility(scene, eye_location) if rasterize else None
+    colors, ids, depth, _ = trace_gbuffer(scene, width, height, eye_location, max_bounces, cel_shaded,
+                                          rows_per_batch, seed, primary)
+    edges = np.zeros((height, width), dtype=bool)
+    if silhouettes:
+        edges = gbuffer_edges(ids, edge_width=silhouette_width(eye_location, silh_thickness))
+
+    i, j = np.nonzero(needs_samples(colors, ids, depth, contrast, depth_jump) & ~edges)
+    color_sum, low, high = colors[i, j], colors[i, j], colors[i, j]
+    samples = 1
+    pixel_keys = (i * width + j).astype(np.uint64) + np.uint64(seed) * np.uint64(width * height)
+    refined, extra_rays = len(i), 0
+    while samples < max_samples and len(i):
+        new_samples = min(samples, max_samples - samples)
+        sample_index = np.repeat(np.arange(samples, samples + new_samples)[None], len(i), axis=0).reshape(-1)
+        ray_i, ray_j = np.repeat(i, new_samples), np.repeat(j, new_samples)
+        ray_keys = np.repeat(pixel_keys, new_samples)
+        new_colors = np.empty((len(ray_i), 3))
+        for batch_start in range(0, len(ray_i), pixels_per_batch):
+            batch = slice(batch_start, batch_start + pixels_per_batch)
+            origins, directions, _ = pixel_rays(width, height, eye_location, ray_i[batch], ray_j[batch], seed,
+                                                offsets=sample_offsets(ray_keys[batch], sample_index[batch]))
+            keys = _mix(ray_keys[batch] * np.uint64(max_samples) + sample_index[batch].astype(np.uint64))
+            new_colors[batch] = scene.trace(origins, directions, keys, num_bounces=0, max_bounces=max_bounces,
+                                            cel_shaded=cel_shaded, primary=primary)
+        extra_rays += len(ray_i)
+        new_colors = new_colors.reshape(len(i), new_samples, 3)
+        color_sum = color_sum + new_colors.sum(axis=1)
+        low, high = np.minimum(low, new_colors.min(axis=1)), np.maximum(high, new_colors.max(axis=1))
+        samples += new_samples
+        colors[i, j] = color_sum / samples
+
+        # Pixels whose samples all agree are done
+        varied = (high - low > contrast).any(axis=-1)
+        i, j, pixel_keys = i[varied], j[varied], pixel_keys[varied]
+        color_sum, low, high = color_sum[varied], low[varied], high[varied]
+
+    colors[edges] = 0.0
+    image_data[...] = colors.astype(np.uint8)
+    print(f"Adaptive sampling refined {refined} of {width * height} pixels with {extra_rays} extra rays after "
+          f"{round(time.time() - start_time, 3)} seconds")
+    return image_data
+
+
+def render_adaptive(objects_list, lights_list, width, height, eye_location, background_color=Vec3(0, 0, 0),
+                    max_bounces=1, cel_shaded=False, image_data=None, max_samples=8, contrast=16.0, depth_jump=0.1,
+                    silhouettes=False, silh_thickness=SILH_THICKNESS, rows_per_batch=16, seed=0, rasterize=False):
+    """Batched render with one sample per pixel, plus up to max_samples where neighbouring pixels differ
+    by more than contrast (colors) or depth_jump (relative depths). silhouettes draws G-buffer edges
+    (gbuffer_render) on top. rasterize as in render_batched"""
+    scene = BatchScene(objects_list, lights_list, background_color)
+    return render_scene_adaptive(scene, width, height, eye_location, max_bounces, cel_shaded, image_data,
+                                 max_samples, contrast, depth_jump, silhouettes, silh_thickness, rows_per_batch, seed,
+                                 rasterize=rasterize)
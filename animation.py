@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+import time
+from math import pi
+import numpy as np
+import transformations
+from vector import Vec3
+from SceneObjects import TriangleMesh
+from BHV_BBox import SceneBVH
+from batch_trace import BatchScene, render_scene_batched
+from parallel_render import render_parallel
+from image_output import open_stream
+from render_jobs import DEFAULTS, RenderSession
+import render_stats
+
+"""Turntables and simple animations rendered as numbered frames in one process.
+Rerunning main.py per frame re-parses the .obj, transforms it and builds every tree from scratch. Here the scene is
+set up once, and each frame only moves the animated TriangleMeshes (TriangleMesh.pose: same faces in the same
+order) and refits their BVHs bottom-up, plus any SceneBVH above them, which is linear in the nodes. Refit boxes
+get looser as faces move away from where the tree was built, so a mesh's tree is rebuilt once its SAH cost
+(FlatBVH.sah_cost) is rebuild_ratio times what it was after the last build.
+
+    python animation.py --frames 36 --size 256 --output "turntable/frame_{frame:04d}.png"
+
+turns the Links of render_jobs' default scene (main.py's) once around over 36 frames."""
+
+REBUILD_RATIO = 1.5
+
+
+def turntable(mesh, frames, degrees=360.0, axis=(0, 1, 0)):
+    """A motion for Animation: turns mesh by degrees over frames frames, about an axis through the center of its
+    box (where it is now)"""
+    low, high = mesh.bounds()
+    center = (low + high) / 2
+    return lambda frame: transformations.rotation_matrix(degrees * pi / 180 * frame / frames, axis, point=center)
+
+
+class Animation:
+    """A scene where some TriangleMeshes move: motions is a list of (mesh, motion), where motion(frame) is the 4x4
+    matrix that takes the mesh from where it is now to where it is in that frame. One BatchScene serves every frame;
+    set_frame poses the meshes, refits (or, when they've got too loose, rebuilds) their trees and refits every
+    SceneBVH in objects_list"""
+
+    def __init__(self, objects_list, lights_list, motions, background_color=Vec3(0, 0, 0), leaf_size=4,
+                 method="sah", rebuild_ratio=REBUILD_RATIO):
+        self.objects_list, self.lights_list, self.background_color = objects_list, lights_list, background_color
+        self.motions = motions
+        self.leaf_size, self.method, self.rebuild_ratio = leaf_size, method, rebuild_ratio
+        for mesh, _ in motions:
+            if mesh.bvh is None:
+                mesh.build_bvh(leaf_size, method)
+        self.built_costs = [mesh.bvh.sah_cost() for mesh, _ in motions]
+        self.scene_bvhs = [obj for obj in objects_list if type(obj) == SceneBVH]
+        self.scene = BatchScene(objects_list, lights_list, background_color)
+        self.frame = None
+        self.rebuilds = 0
+
+    def set_frame(self, frame):
+        for index, (mesh, motion) in enumerate(self.motions):
+            mesh.pose(motion(frame))
+            if mesh.bvh.sah_cost() > self.rebuild_ratio * self.built_costs[index]:
+                with render_stats.stage("build"):
+                    mesh.build_bvh(self.leaf_size, self.method)
+                self.built_costs[index] = mesh.bvh.sah_cost()
+                self.rebuilds += 1
+        for scene_bvh in self.scene_bvhs:
+            scene_bvh.refit()
+        self.scene.update_meshes()
+        self.frame = frame
+
+
+def render_animation(animation, frames, width, height, eye_location, output="frame_{frame:04d}.png", max_bounces=1,
+                     multiple=False, cel_shaded=False, workers=1, seed=0):
+    """Renders every frame in frames to output (formatted with frame=the frame number), streaming the rows to the
+    file as they finish. workers other than 1 renders each frame with render_parallel, which packs its own scene
+    from the posed objects every frame. Returns {frame: (output path, refit seconds, render seconds)}"""
+    results = {}
+    for frame in frames:
+        start_time = time.time()
+        with render_stats.stage("refit"):
+            animation.set_frame(frame)
+        refit_time = time.time() - start_time
+
+        start_time = time.time()
+        path = output.format(frame=frame)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+        with open_stream(path, width, height) as stream:
+            if workers == 1:
+                render_scene_batched(animation.scene, width, height, eye_location, max_bounces=max_bounces,
+                                     multiple=multiple, cel_shaded=cel_shaded, image_data=image_data, seed=seed,
+                                     row_writer=stream)
+            else:
+                render_parallel(animation.objects_list, animation.lights_list, width, height, eye_location,
+                                background_color=animation.background_color, max_bounces=max_bounces,
+                                multiple=multiple, cel_shaded=cel_shaded, image_data=image_data, workers=workers,
+                                seed=seed, row_writer=stream)
+        render_time = time.time() - start_time
+        render_stats.add_time("trace", render_time)
+        results[frame] = (path, refit_time, render_time)
+        print(f"Frame {frame}: refit {round(refit_time, 3)} seconds, rendered in {round(render_time, 3)} seconds, "
+              f"saved to {path}")
+    print(f"Rebuilt BVHs {animation.rebuilds} times over {len(results)} frames")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a turntable of the Links in main.py's scene as numbered "
+                                                 "frames")
+    parser.add_argument("--frames", type=int, default=36)
+    parser.add_argument("--degrees", type=float, default=360.0, help="turn over all the frames")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--depth", type=int, default=DEFAULTS["depth"])
+    parser.add_argument("--flat", action="store_true", help="no cel-shading or silhouettes")
+    parser.add_argument("--workers", type=int, default=1, help="processes per frame (0 = one per CPU)")
+    parser.add_argument("--output", default="turntable/frame_{frame:04d}.png", help=".png or .ppm, with {frame}")
+    parser.add_argument("--stats", metavar="JSON", help="collect render_stats for all frames and save them here")
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        render_stats.enable()
+    settings = dict(DEFAULTS, size=args.size)
+    session = RenderSession()
+    _, objects_list = session.objects_for(settings)
+    links = [obj for obj in objects_list if type(obj) == TriangleMesh]
+    animation = Animation(objects_list, session.lights_for(settings),
+                          [(mesh, turntable(mesh, args.frames, args.degrees)) for mesh in links],
+                          Vec3(*settings["background"]), settings["bvh_leaf_size"], settings["bvh_method"])
+    render_animation(animation, range(args.frames), args.size, args.size,
+                     Vec3(0, 0, -args.size * settings["eye_distance"]), args.output, max_bounces=args.depth,
+                     multiple=not args.flat, cel_shaded=not args.flat, workers=args.workers or None)
+    if args.stats:
+        render_stats.print_summary()
+        render_stats.save_json(args.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
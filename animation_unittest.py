@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+from vector import Vec3
+from SceneObjects import Sphere
+from BHV_BBox import SceneBVH
+from batch_trace import BatchScene, SCENE_BVH_MIN_OBJECTS, render_scene_batched
+from animation import Animation, render_animation, turntable
+from batch_trace_unittest import small_scene
+from mesh_unittest import random_mesh
+
+SIZE = 24
+FRAMES = 8
+
+
+def animated_scene(mesh):
+    """small_scene with mesh in it, all in one SceneBVH big enough for BatchScene to keep as a tree"""
+    objects_list, lights_list = small_scene(SIZE)
+    objects_list += [mesh]
+    objects_list += [Sphere(Vec3(x, -SIZE, SIZE), 1.0) for x in range(SCENE_BVH_MIN_OBJECTS - len(objects_list))]
+    return [SceneBVH(objects_list)], lights_list
+
+
+def render(scene):
+    return render_scene_batched(scene, SIZE, SIZE, Vec3(0, 0, -SIZE * 1.5), max_bounces=3, multiple=True,
+                                cel_shaded=True)
+
+
+class TestAnimation(unittest.TestCase):
+
+    def setUp(self):
+        self.mesh = random_mesh(300)
+        self.motion = turntable(self.mesh, FRAMES)
+        self.objects_list, self.lights_list = animated_scene(self.mesh)
+
+    def rebuilt(self, frame):
+        """The image of frame from a scene built from scratch, the mesh posed before its BVH is built"""
+        mesh = random_mesh(300)
+        mesh.pose(self.motion(frame))
+        mesh.build_bvh()
+        objects_list, lights_list = animated_scene(mesh)
+        return render(BatchScene(objects_list, lights_list))
+
+    def test_refit_frames_match_rebuilt_scene(self):
+        animation = Animation(self.objects_list, self.lights_list, [(self.mesh, self.motion)],
+                              rebuild_ratio=float("inf"))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, "frames", "turn_{frame:02d}.png")
+            results = render_animation(animation, [1, 3], SIZE, SIZE, Vec3(0, 0, -SIZE * 1.5), output,
+                                       max_bounces=3, multiple=True, cel_shaded=True)
+            self.assertEqual(sorted(os.listdir(os.path.join(temp_dir, "frames"))), ["turn_01.png", "turn_03.png"])
+            self.assertEqual(results[3][0], output.format(frame=3))
+            self.assertEqual(animation.rebuilds, 0)
+            for frame in (1, 3):
+                np.testing.assert_array_equal(np.asarray(Image.open(results[frame][0])), self.rebuilt(frame))
+
+    def test_rebuilds_when_too_loose(self):
+        animation = Animation(self.objects_list, self.lights_list, [(self.mesh, self.motion)], rebuild_ratio=0.0)
+        bvh = self.mesh.bvh
+        animation.set_frame(2)
+        self.assertEqual(animation.rebuilds, 1)
+        self.assertIsNot(self.mesh.bvh, bvh)
+        np.testing.assert_array_equal(render(animation.scene), self.rebuilt(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,899 @@
+import time
+import numpy as np
+from vector import Vec3
+from SceneObjects import Triangle, Sphere, CheckeredSphere, TriangleMesh, triangle_hits, _dot
+from BHV_BBox import BoundingBox, FlatBVH, SceneBVH
+from instancing import MeshInstance, InstanceGroup
+from occluder_cache import OccluderCache, BATCH_BLOCKERS
+import kernels
+import render_stats
+
+"""Batched (NumPy) version of ray.ray_trace / ray_intersection / shade.
+Rays are held as (N,3) arrays and tested against every primitive in bulk; the math is the same
+as the per-ray code (same operation order), so the images match the per-pixel loop in main.py."""
+
+# Same values ray.ray_trace uses
+RAY_OFFSETS = ((0.25, 0.25), (-0.25, 0.25), (0.25, -0.25), (-0.25, -0.25))
+JITTER = 0.2
+SILH_THICKNESS = 4
+INITIAL_OFFSET = 0.0001  # Ray.initial_offset
+FAR_AWAY = 1e20  # Ray default nearest_hit_distance
+SCENE_BVH_MIN_OBJECTS = 16  # smaller SceneBVHs are unpacked into the plain sequence
+
+SPHERE, TRIANGLE, INSTANCE = 0, 1, 2  # INSTANCE: a face of a MeshInstance (no row in the columns)
+STORED = 3  # a face of a mesh_store mesh (no row either)
+STORED_FIRST = 1 << 40  # primitive id of the first stored face, past any instanced one
+
+
+def _normalize(v):
+    return v / np.sqrt(_dot(v, v))[:, None]
+
+
+def _mix(keys):
+    """SplitMix64 finaliser; turns ray keys into well spread random bits"""
+    z = keys + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _uniform(bits, low, high):
+    return low + (high - low) * ((bits >> np.uint64(11)).astype(np.float64) * 2.0 ** -53)
+
+
+def sphere_hits(origins, directions, center, radius, t_current):
+    """Vectorized Sphere.intersect; returns (hit mask, t of hit)"""
+    if render_stats.enabled:
+        render_stats.count("sphere_tests", len(origins))
+    if kernels.backend == "numba":
+        return kernels.sphere_hits(origins, directions, center, radius, t_current)
+    e_min_c = origins - center
+    d_dot_e_min_c = _dot(directions, e_min_c)
+    d_dot_d = _dot(directions, directions)
+    discriminant = d_dot_e_min_c ** 2 - d_dot_d * (_dot(e_min_c, e_min_c) - radius ** 2)
+    rest_of_equ = -d_dot_e_min_c / d_dot_d
+    with np.errstate(invalid="ignore"):
+        sqrt_disc = np.sqrt(discriminant)
+    smaller_t = rest_of_equ - sqrt_disc
+    larger_t = rest_of_equ + sqrt_disc
+
+    real = discriminant >= 0
+    tangent = real & (discriminant < 0.0000001)
+    hit_tangent = tangent & (rest_of_equ < t_current)
+    through = real & ~tangent
+    hit_smaller = through & (INITIAL_OFFSET < smaller_t) & (smaller_t < t_current)
+    hit_larger = through & ~hit_smaller & (INITIAL_OFFSET < larger_t) & (larger_t < t_current)
+
+    t_of_hit = np.where(hit_tangent, rest_of_equ, np.where(hit_smaller, smaller_t, larger_t))
+    return hit_tangent | hit_smaller | hit_larger, t_of_hit
+
+
+def box_hits(min_point, max_point, origins, directions):
+    """Vectorized BoundingBox slab test (no object test); bounds may be one box or one per ray"""
+    if render_stats.enabled:
+        render_stats.count("box_tests", len(origins))
+    hit = np.ones(len(origins), dtype=bool)
+    t_min = t_max = None
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for axis in range(3):
+            r_dir, r_ori = directions[:, axis], origins[:, axis]
+            near = (np.where(r_dir < 0, max_point[..., axis], min_point[..., axis]) - r_ori) / r_dir
+            far = (np.where(r_dir < 0, min_point[..., axis], max_point[..., axis]) - r_ori) / r_dir
+            near, far = np.where(near > far, far, near), np.where(near > far, near, far)
+            if axis == 0:
+                hit &= r_dir != 0
+                t_min, t_max = near, far
+                continue
+            hit &= ~((t_min > far) | (t_max < near))
+            t_min = np.where(near > t_min, near, t_min)
+            t_max = np.where(far < t_max, far, t_max)
+    return hit
+
+
+class BatchScene:
+    """Flattens objects_list into primitive arrays so rays can be tested in bulk.
+    Every Sphere/Triangle/mesh face gets a primitive id; BoundingBoxes are packed into node arrays.
+    A SceneBVH keeps its tree: rays are only tested against the objects whose leaves they reach.
+    Faces of MeshInstances get ids too, past primitive_count, but no rows: column() looks them up in the
+    instance's mesh, so instances still share their mesh's memory. Faces of meshes opened from a mesh_store are
+    numbered from STORED_FIRST and have no rows either, so they stay memory-mapped from the store"""
+
+    # Array attributes, as named by to_arrays
+    COLUMNS = ("kind", "diffuse", "reflectiveness", "shininess", "checkered", "parent_id",
+               "center", "radius", "pt_a", "edge_ab", "edge_ac", "normal")
+    LIGHTS = ("light_position", "light_color", "light_intensity", "background_color")
+    TREE = ("node_min", "node_max", "left", "right", "leaf_first", "leaf_count", "leaf_prims")
+    INSTANCES = ("instance_first", "instance_group", "group_first", "instance_parent_id")
+    STORED_MESHES = ("stored_first", "stored_parent_id")
+
+    def __init__(self, objects_list, lights_list, background_color=Vec3(0, 0, 0)):
+        self.primitive_count = 0
+        self._blocks = []  # per-primitive columns, one dict per object (or mesh)
+        self._parent_ids = {}
+        self.sequence = []  # (kind, payload) in objects_list order, so ties resolve like ray_intersection
+        self.instance_groups = []
+        self._instance_parents = []
+        self.stored_meshes = []
+        self._stored_parents = []
+        for obj in objects_list:
+            # Testing a handful of objects in bulk beats walking a tree over them
+            small_tree = type(obj) == SceneBVH and len(obj) < SCENE_BVH_MIN_OBJECTS
+            for entry in [self._add_object(child) for child in obj.objects] if small_tree else [self._add_object(obj)]:
+                if entry is None:
+                    continue
+                if entry[0] == "tris" and self.sequence and self.sequence[-1][0] == "tris":
+                    self.sequence[-1][1].extend(entry[1])
+                else:
+                    self.sequence.append(entry)
+
+        if not self._blocks:
+            self._new_block(0, None)
+        for column in self.COLUMNS:
+            setattr(self, column, np.concatenate([block[column] for block in self._blocks]))
+        del self._blocks
+        self._pack_instances(self._instance_parents)
+        del self._instance_parents
+        self._pack_stored(self._stored_parents)
+        del self._stored_parents
+
+        self.light_position = np.array([(l.position.x, l.position.y, l.position.z) for l in lights_list])
+        self.light_color = np.array([(l.color.x, l.color.y, l.color.z) for l in lights_list])
+        self.light_intensity = np.array([float(l.intensity) for l in lights_list])
+
+        self.background_color = np.array([background_color.x, background_color.y, background_color.z])
+        self.amb_intensity = abs(background_color) / abs(Vec3(255, 255, 255)) + 0.1
+        self.cel_limits = [abs(Vec3(1, 1, 1) * scale) for scale in (255, 0.4 * 255, 0.2 * 255, 0.05 * 255)]
+        self.occluder_cache = OccluderCache()
+        self.reset_ray_counts()
+
+    def reset_ray_counts(self):
+        """ray_counts tallies the rays traced since: primary and reflection rays per sample (a silhouette ray
+        and the color ray that follows it count once), and shadow rays per point and light"""
+        self.ray_counts = {"primary": 0, "shadow": 0, "reflection": 0}
+
+    def update_meshes(self, sequence=None):
+        """Copies the faces of every TriangleMesh into the columns again, after they've moved (TriangleMesh.pose)
+        or had their BVH rebuilt, which reorders them. Meshes must keep their number of faces"""
+        for kind, payload in self.sequence if sequence is None else sequence:
+            if kind == "scene_bvh":
+                self.update_meshes([entry for entry in payload[1] if entry is not None])
+            elif kind == "mesh" and payload[0] < STORED_FIRST:
+                first, mesh = payload
+                rows = slice(first, first + len(mesh))
+                self.diffuse[rows] = mesh.diffuse[mesh.material_ids]
+                self.reflectiveness[rows] = mesh.reflectiveness[mesh.material_ids]
+                self.shininess[rows] = mesh.shininess[mesh.material_ids]
+                self.pt_a[rows], self.edge_ab[rows], self.edge_ac[rows] = mesh.A, mesh.edge_ab, mesh.edge_ac
+                self.normal[rows] = mesh.normals
+
+    def to_arrays(self):
+        """Splits the scene into named arrays plus a small picklable layout, for from_arrays
+        (e.g. to put the arrays in shared memory for other processes)"""
+        arrays = {name: getattr(self, name) for name in self.COLUMNS + self.LIGHTS + self.INSTANCES +
+                  self.STORED_MESHES}
+        sequence = [self._entry_to_arrays(entry, f"{index}_", arrays) for index, entry in enumerate(self.sequence)]
+        layout = {"sequence": sequence, "primitive_count": self.primitive_count,
+                  "amb_intensity": self.amb_intensity, "cel_limits": self.cel_limits}
+        return arrays, layout
+
+    @classmethod
+    def from_arrays(cls, arrays, layout):
+        """Rebuilds a scene from to_arrays output without copying the arrays"""
+        scene = cls.__new__(cls)
+        for name in cls.COLUMNS + cls.LIGHTS + cls.INSTANCES + cls.STORED_MESHES:
+            setattr(scene, name, arrays[name])
+        scene.instance_groups = []
+        scene.stored_meshes = []
+        scene.sequence = [scene._entry_from_arrays(entry, arrays) for entry in layout["sequence"]]
+        scene.primitive_count = layout["primitive_count"]
+        scene.amb_intensity, scene.cel_limits = layout["amb_intensity"], layout["cel_limits"]
+        scene.occluder_cache = OccluderCache()
+        scene.reset_ray_counts()
+        return scene
+
+    def _entry_to_arrays(self, entry, prefix, arrays):
+        """Puts the arrays of one sequence entry into arrays (names starting with prefix); returns its layout"""
+        kind, payload = entry
+        if kind == "bvh":
+            arrays.update({prefix + name: array for name, array in zip(self.TREE, payload)})
+            return kind, prefix
+        if kind == "mesh" and payload[0] >= STORED_FIRST:
+            # Other processes map the same files instead of getting a copy of the faces
+            first, mesh = payload
+            return "stored_mesh", (mesh.store_path, first)
+        if kind == "mesh":
+            first, mesh = payload
+            arrays.update({prefix + name: array for name, array in mesh.to_arrays().items()})
+            return kind, (prefix, first)
+        if kind == "tris":
+            arrays[prefix + "pids"] = np.array(payload, dtype=np.int64)
+            return kind, prefix
+        if kind == "instances":
+            arrays.update({prefix + name: array for name, array in self.instance_groups[payload].to_arrays().items()})
+            return kind, (prefix, payload)
+        if kind == "scene_bvh":
+            bvh, entries = payload
+            arrays[prefix + "bvh_nodes"], arrays[prefix + "bvh_prim_indices"] = bvh.nodes, bvh.prim_indices
+            return kind, (prefix, [None if child is None else self._entry_to_arrays(child, f"{prefix}{index}_", arrays)
+                                   for index, child in enumerate(entries)])
+        return kind, payload
+
+    def _entry_from_arrays(self, entry, arrays):
+        """Inverse of _entry_to_arrays (instance groups are added in the same order they were saved in)"""
+        kind, payload = entry
+
+        def named(prefix):
+            return {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+        if kind == "bvh":
+            payload = tuple(arrays[payload + name] for name in self.TREE)
+        elif kind == "mesh":
+            prefix, first = payload
+            payload = (first, TriangleMesh.from_arrays(named(prefix)))
+        elif kind == "stored_mesh":
+            from mesh_store import open_store
+            path, first = payload
+            kind, payload = "mesh", (first, open_store(path))
+            self.stored_meshes.append(payload[1])
+        elif kind == "tris":
+            payload = arrays[payload + "pids"].tolist()
+        elif kind == "instances":
+            prefix, payload = payload
+            self.instance_groups.append(InstanceGroup.from_arrays(named(prefix)))
+        elif kind == "scene_bvh":
+            prefix, entries = payload
+            payload = (FlatBVH.from_arrays(arrays[prefix + "bvh_nodes"], arrays[prefix + "bvh_prim_indices"]),
+                       [None if child is None else self._entry_from_arrays(child, arrays) for child in entries])
+        return kind, payload
+
+    def _add_object(self, obj):
+        """Adds one entry of objects_list; returns its sequence entry (None if it can't be traced here)"""
+        if type(obj) == SceneBVH:
+            return "scene_bvh", (obj.bvh, [self._add_object(child) for child in obj.objects])
+        if type(obj) == InstanceGroup or type(obj) == MeshInstance:
+            group = obj if type(obj) == InstanceGroup else InstanceGroup([obj])
+            self._instance_parents += [self._parent_id(instance.parent) for instance in group.instances]
+            self.instance_groups.append(group)
+            return "instances", len(self.instance_groups) - 1
+        if type(obj) == BoundingBox:
+            return "bvh", self._pack_box(obj)
+        if type(obj) == TriangleMesh and obj.store_path is not None:
+            self._stored_parents.append(self._parent_id(obj.parent))
+            self.stored_meshes.append(obj)
+            return "mesh", (STORED_FIRST + sum(len(mesh) for mesh in self.stored_meshes[:-1]), obj)
+        if type(obj) == TriangleMesh:
+            return "mesh", (self._add_mesh(obj), obj)
+        if isinstance(obj, Triangle):
+            return "tris", [self._add(obj)]
+        if isinstance(obj, Sphere):
+            return "sphere", self._add(obj)
+        print(f"Warning: {type(obj).__name__} not usable in batched tracing yet")
+        return None
+
+    def _pack_instances(self, instance_parents):
+        """Numbers the faces of every instance from primitive_count on, instance by instance"""
+        sizes = [len(instance) for group in self.instance_groups for instance in group.instances]
+        self.instance_first = self.primitive_count + np.cumsum([0] + sizes[:-1], dtype=np.int64)[:len(sizes)]
+        group_sizes = [len(group) for group in self.instance_groups]
+        self.instance_group = np.repeat(np.arange(len(group_sizes)), group_sizes).astype(np.int64)
+        self.group_first = np.cumsum([0] + group_sizes[:-1], dtype=np.int64)[:len(group_sizes)]
+        self.instance_parent_id = np.array(instance_parents, dtype=np.int64)
+
+    def _pack_stored(self, stored_parents):
+        sizes = [len(mesh) for mesh in self.stored_meshes]
+        self.stored_first = STORED_FIRST + np.cumsum([0] + sizes[:-1], dtype=np.int64)[:len(sizes)]
+        self.stored_parent_id = np.array(stored_parents, dtype=np.int64)
+
+    def column(self, name, pids):
+        """Column name (see COLUMNS) at primitive ids pids (any shape), faces of instances and stored meshes
+        included"""
+        if not self.instance_groups and not self.stored_meshes:
+            return getattr(self, name)[pids]
+        column = getattr(self, name)
+        flat = np.asarray(pids).reshape(-1)
+        values = np.empty((len(flat),) + column.shape[1:], dtype=column.dtype)
+        stored = flat >= STORED_FIRST
+        instanced = (flat >= self.primitive_count) & ~stored
+        in_rows = ~(instanced | stored)
+        values[in_rows] = column[flat[in_rows]]
+        if stored.any():
+            rows = np.nonzero(stored)[0]
+            values[rows] = self._stored_column(name, flat[rows])
+        if instanced.any():
+            rows = np.nonzero(instanced)[0]
+            instance = np.searchsorted(self.instance_first, flat[rows], side="right") - 1
+            faces = flat[rows] - self.instance_first[instance]
+            if name == "kind":
+                values[rows] = INSTANCE
+            elif name == "checkered":
+                values[rows] = False
+            elif name == "parent_id":
+                values[rows] = self.instance_parent_id[instance]
+            else:
+                group = self.instance_group[instance]
+                for index in np.unique(group).tolist():
+                    in_group = group == index
+                    values[rows[in_group]] = self.instance_groups[index].face_column(
+                        name, instance[in_group] - self.group_first[index], faces[in_group])
+        return values.reshape(np.shape(pids) + column.shape[1:])
+
+    def _stored_faces(self, pids):
+        """(index into stored_meshes, face) of stored face ids"""
+        stored = np.searchsorted(self.stored_first, pids, side="right") - 1
+        return stored, pids - self.stored_first[stored]
+
+    def _stored_column(self, name, pids):
+        """column() for faces of stored meshes"""
+        stored, faces = self._stored_faces(pids)
+        if name == "kind":
+            return STORED
+        if name == "checkered":
+            return False
+        if name == "parent_id":
+            return self.stored_parent_id[stored]
+        if name == "center":
+            return 0.0
+        if name == "radius":
+            return 1.0
+        values = np.empty((len(pids),) + getattr(self, name).shape[1:])
+        for index in np.unique(stored).tolist():
+            rows = np.nonzero(stored == index)[0]
+            mesh, face = self.stored_meshes[index], faces[rows]
+            if name in ("diffuse", "reflectiveness", "shininess"):
+                values[rows] = getattr(mesh, name)[mesh.material_ids[face]]
+            else:
+                values[rows] = {"pt_a": mesh.A, "edge_ab": mesh.edge_ab, "edge_ac": mesh.edge_ac,
+                                "normal": mesh.normals}[name][face]
+        return values
+
+    def _stored_face_hits(self, pids, origins, directions, t_current):
+        """primitive_hits for faces of stored meshes"""
+        hit, t_hit = np.zeros(len(pids), dtype=bool), np.full(len(pids), FAR_AWAY)
+        stored, faces = self._stored_faces(pids)
+        for index in np.unique(stored).tolist():
+            rows = np.nonzero(stored == index)[0]
+            mesh, face = self.stored_meshes[index], faces[rows]
+            hit[rows], t_hit[rows] = triangle_hits(origins[rows], directions[rows], mesh.A[face], mesh.edge_ab[face],
+                                                   mesh.edge_ac[face], mesh.normals[face], t_current[rows])
+        return hit, t_hit
+
+    def _instance_face_hits(self, pids, origins, directions, t_current):
+        """primitive_hits for faces of instances"""
+        hit, t_hit = np.zeros(len(pids), dtype=bool), np.full(len(pids), FAR_AWAY)
+        instance = np.searchsorted(self.instance_first, pids, side="right") - 1
+        faces = pids - self.instance_first[instance]
+        group = self.instance_group[instance]
+        for index in np.unique(group).tolist():
+            rows = np.nonzero(group == index)[0]
+            hit[rows], t_hit[rows] = self.instance_groups[index].face_hits(
+                instance[rows] - self.group_first[index], faces[rows], origins[rows], directions[rows],
+                t_current[rows])
+        return hit, t_hit
+
+    def _parent_id(self, parent):
+        # ray_trace compares parents by identity
+        return self._parent_ids.setdefault(id(parent), len(self._parent_ids))
+
+    def _new_block(self, count, parent):
+        block = {"kind": np.full(count, TRIANGLE, dtype=np.int8), "diffuse": np.zeros((count, 3)),
+                 "reflectiveness": np.zeros(count), "shininess": np.zeros(count),
+                 "checkered": np.zeros(count, dtype=bool),
+                 "parent_id": np.full(count, self._parent_id(parent), dtype=np.int64),
+                 "center": np.zeros((count, 3)), "radius": np.ones(count), "pt_a": np.zeros((count, 3)),
+                 "edge_ab": np.zeros((count, 3)), "edge_ac": np.zeros((count, 3)), "normal": np.zeros((count, 3))}
+        self._blocks.append(block)
+        self.primitive_count += count
+        return block
+
+    def _add(self, obj):
+        """Adds a Sphere or Triangle; returns its primitive id"""
+        block = self._new_block(1, obj.parent)
+        block["diffuse"][0] = (obj.diffuse.x, obj.diffuse.y, obj.diffuse.z)
+        block["reflectiveness"][0] = obj.reflectiveness
+        block["shininess"][0] = obj.shininess
+        if isinstance(obj, Triangle):
+            a, b, c, n = obj.A, obj.B, obj.C, obj.normal
+            block["pt_a"][0] = (a.x, a.y, a.z)
+            block["edge_ab"][0] = (a.x - b.x, a.y - b.y, a.z - b.z)
+            block["edge_ac"][0] = (a.x - c.x, a.y - c.y, a.z - c.z)
+            block["normal"][0] = (n.x, n.y, n.z)
+        else:
+            block["kind"][0] = SPHERE
+            block["checkered"][0] = isinstance(obj, CheckeredSphere)
+            block["center"][0] = (obj.pos.x, obj.pos.y, obj.pos.z)
+            block["radius"][0] = obj.radius
+        return self.primitive_count - 1
+
+    def _add_mesh(self, mesh):
+        """Adds every face of a TriangleMesh; returns the primitive id of face 0"""
+        first = self.primitive_count
+        block = self._new_block(len(mesh), mesh.parent)
+        block["diffuse"] = mesh.diffuse[mesh.material_ids]
+        block["reflectiveness"] = mesh.reflectiveness[mesh.material_ids]
+        block["shininess"] = mesh.shininess[mesh.material_ids]
+        block["pt_a"], block["edge_ab"], block["edge_ac"], block["normal"] = mesh.A, mesh.edge_ab, mesh.edge_ac, mesh.normals
+        return first
+
+    def _pack_box(self, box):
+        """Flattens a BoundingBox tree into arrays, nodes and leaf objects numbered in visiting order"""
+        node_min, node_max, left, right, leaf_first, leaf_count, leaf_prims = [], [], [], [], [], [], []
+
+        def visit(node):
+            index = len(node_min)
+            node_min.append((node.min_point.x, node.min_point.y, node.min_point.z))
+            node_max.append((node.max_point.x, node.max_point.y, node.max_point.z))
+            left.append(-1)
+            right.append(-1)
+            leaf_first.append(len(leaf_prims))
+            leaf_count.append(0)
+            if node.objects_contained is not None:
+                leaf_prims.extend(self._add(obj) for obj in node.objects_contained)
+                leaf_count[index] = len(node.objects_contained)
+            if node.left_box is not None:
+                left[index] = visit(node.left_box)
+            if node.right_box is not None:
+                right[index] = visit(node.right_box)
+            return index
+
+        visit(box)
+        return (np.array(node_min), np.array(node_max), np.array(left), np.array(right),
+                np.array(leaf_first), np.array(leaf_count), np.array(leaf_prims, dtype=np.int64))
+
+    def primitive_hits(self, pids, origins, directions, t_current):
+        """Tests ray i against primitive pids[i]; returns (hit mask, t of hit)"""
+        hit = np.zeros(len(pids), dtype=bool)
+        t_hit = np.full(len(pids), FAR_AWAY)
+        kinds = self.column("kind", pids)
+        for kind in (SPHERE, TRIANGLE, INSTANCE, STORED):
+            ids = np.nonzero(kinds == kind)[0]
+            if ids.size == 0:
+                continue
+            p = pids[ids]
+            if kind == STORED:
+                hit[ids], t_hit[ids] = self._stored_face_hits(p, origins[ids], directions[ids], t_current[ids])
+            elif kind == INSTANCE:
+                hit[ids], t_hit[ids] = self._instance_face_hits(p, origins[ids], directions[ids], t_current[ids])
+            elif kind == TRIANGLE:
+                hit[ids], t_hit[ids] = triangle_hits(origins[ids], directions[ids], self.pt_a[p], self.edge_ab[p],
+                                                     self.edge_ac[p], self.normal[p], t_current[ids])
+            else:
+                hit[ids], t_hit[ids] = sphere_hits(origins[ids], directions[ids], self.center[p], self.radius[p],
+                                                   t_current[ids])
+        return hit, t_hit
+
+    def intersect_primitive(self, pid, ids, origins, directions, t, prim):
+        """Tests rays[ids] against one primitive, updating t and prim where it is nearer"""
+        o, d = origins[ids], directions[ids]
+        if self.kind[pid] == TRIANGLE:
+            hit, t_hit = triangle_hits(o, d, self.pt_a[pid], self.edge_ab[pid], self.edge_ac[pid],
+                                       self.normal[pid], t[ids])
+        else:
+            hit, t_hit = sphere_hits(o, d, self.center[pid], self.radius[pid], t[ids])
+        ids = ids[hit]
+        t[ids] = t_hit[hit]
+        prim[ids] = pid
+
+    def _tree_pairs(self, tree, origins, directions):
+        """Walks all rays down a packed tree one level at a time, carrying (ray, node) pairs.
+        Returns (ray, leaf slot, primitive id) for every object in every leaf reached"""
+        node_min, node_max, left, right, leaf_first, leaf_count, leaf_prims = tree
+        pair_ray = np.arange(len(origins))
+        pair_node = np.zeros(len(origins), dtype=np.int64)
+        leaf_rays, leaf_nodes = [pair_ray[:0]], [pair_node[:0]]
+        while pair_ray.size:
+            hit = box_hits(node_min[pair_node], node_max[pair_node], origins[pair_ray], directions[pair_ray])
+            pair_ray, pair_node = pair_ray[hit], pair_node[hit]
+            at_leaf = leaf_count[pair_node] > 0
+            leaf_rays.append(pair_ray[at_leaf])
+            leaf_nodes.append(pair_node[at_leaf])
+            pair_ray, pair_node = pair_ray[~at_leaf], pair_node[~at_leaf]
+            has_left, has_right = left[pair_node] >= 0, right[pair_node] >= 0
+            pair_ray = np.concatenate((pair_ray[has_left], pair_ray[has_right]))
+            pair_node = np.concatenate((left[pair_node[has_left]], right[pair_node[has_right]]))
+
+        # One (ray, object) pair for every object in every leaf reached
+        pair_ray, pair_node = np.concatenate(leaf_rays), np.concatenate(leaf_nodes)
+        counts = leaf_count[pair_node]
+        starts = np.cumsum(counts) - counts
+        pair_ray = np.repeat(pair_ray, counts)
+        slot = np.repeat(leaf_first[pair_node] - starts, counts) + np.arange(counts.sum())
+        return pair_ray, slot, leaf_prims[slot]
+
+    def _intersect_tree(self, tree, origins, directions, t, prim):
+        pair_ray, slot, pids = self._tree_pairs(tree, origins, directions)
+        hit, t_hit = self.primitive_hits(pids, origins[pair_ray], directions[pair_ray], t[pair_ray])
+        pair_ray, slot, pids, t_hit = pair_ray[hit], slot[hit], pids[hit], t_hit[hit]
+        # Visiting objects in order keeps the nearest hit, with ties going to the later object
+        order = np.lexsort((-slot, t_hit, pair_ray))
+        pair_ray, first = np.unique(pair_ray[order], return_index=True)
+        t[pair_ray] = t_hit[order][first]
+        prim[pair_ray] = pids[order][first]
+
+    def intersect(self, origins, directions, t_max=None):
+        """Batched ray_intersection; returns (t of nearest hit, primitive id or -1) per ray"""
+        t = np.full(len(origins), FAR_AWAY) if t_max is None else np.array(t_max, dtype=np.float64)
+        prim = np.full(len(origins), -1, dtype=np.int64)
+        for entry in self.sequence:
+            self._intersect_entry(entry, origins, directions, t, prim)
+        if render_stats.enabled:
+            render_stats.count("intersections", len(origins))
+            render_stats.count("hits", np.count_nonzero(prim >= 0))
+        return t, prim
+
+    def occluded(self, origins, directions, t_max):
+        """Batched any-hit query for shadow rays: True where something blocks the ray before t_max"""
+        return self.occluders(origins, directions, t_max) >= 0
+
+    def occluders(self, origins, directions, t_max):
+        """The primitive id of something blocking the ray before t_max, or -1.
+        A ray drops out as soon as it is blocked, so later objects only see the rays still unblocked"""
+        blockers = np.full(len(origins), -1, dtype=np.int64)
+        ids = np.arange(len(origins))
+        for entry in self.sequence:
+            if ids.size == 0:
+                break
+            found = self._occluder_entry(entry, origins[ids], directions[ids], t_max[ids])
+            hit = found >= 0
+            blockers[ids[hit]] = found[hit]
+            ids = ids[~hit]
+        return blockers
+
+    def occluded_cached(self, light, origins, directions, t_max):
+        """occluded for shadow rays toward light (its index), testing the primitives that blocked the most of the
+        last batch's rays first; the rest of the scene only sees the rays they don't block"""
+        blockers = np.full(len(origins), -1, dtype=np.int64)
+        ids = np.arange(len(origins))
+        cached = self.occluder_cache.blockers.get(light)
+        if cached is not None:
+            for pid in cached:
+                hit = self.primitive_hits(np.full(len(ids), pid), origins[ids], directions[ids], t_max[ids])[0]
+                blockers[ids[hit]] = pid
+                ids = ids[~hit]
+            self.occluder_cache.record(len(origins), len(origins) - len(ids))
+        blockers[ids] = self.occluders(origins[ids], directions[ids], t_max[ids])
+        pids, counts = np.unique(blockers[blockers >= 0], return_counts=True)
+        if pids.size:
+            self.occluder_cache.blockers[light] = pids[np.argsort(-counts, kind="stable")[:BATCH_BLOCKERS]]
+        return blockers >= 0
+
+    def _intersect_entry(self, entry, origins, directions, t, prim):
+        """Tests the rays against one sequence entry, updating t and prim where it is nearer"""
+        kind, payload = entry
+        if kind == "bvh":
+            self._intersect_tree(payload, origins, directions, t, prim)
+        elif kind == "mesh":
+            first, mesh = payload
+            t_mesh, faces = mesh.intersect_batch(origins, directions, t_max=t)
+            hit = faces >= 0
+            t[hit] = t_mesh[hit]
+            prim[hit] = first + faces[hit]
+        elif kind == "instances":
+            t_group, instance, faces = self.instance_groups[payload].intersect_batch(origins, directions, t_max=t)
+            hit = instance >= 0
+            t[hit] = t_group[hit]
+            prim[hit] = self.instance_first[self.group_first[payload] + instance[hit]] + faces[hit]
+        elif kind == "scene_bvh":
+            bvh, entries = payload
+            # Objects in order, so an equal t from a later one replaces the earlier, as in the plain sequence
+            for index, rays in bvh.primitive_rays(origins, directions, t):
+                if entries[index] is not None:
+                    t_rays, prim_rays = t[rays], prim[rays]
+                    self._intersect_entry(entries[index], origins[rays], directions[rays], t_rays, prim_rays)
+                    t[rays], prim[rays] = t_rays, prim_rays
+        else:
+            all_ids = np.arange(len(origins))
+            for pid in (payload if kind == "tris" else [payload]):
+                self.intersect_primitive(pid, all_ids, origins, directions, t, prim)
+
+    def _occluder_entry(self, entry, origins, directions, t_max):
+        """The primitive id of something in one sequence entry that blocks the ray before t_max, or -1"""
+        kind, payload = entry
+        blockers = np.full(len(origins), -1, dtype=np.int64)
+        if kind == "bvh":
+            pair_ray, _, pids = self._tree_pairs(payload, origins, directions)
+            hit = self.primitive_hits(pids, origins[pair_ray], directions[pair_ray], t_max[pair_ray])[0]
+            blockers[pair_ray[hit]] = pids[hit]
+        elif kind == "mesh":
+            first, mesh = payload
+            faces = mesh.occluder_batch(origins, directions, t_max)
+            hit = faces >= 0
+            blockers[hit] = first + faces[hit]
+        elif kind == "instances":
+            instance, faces = self.instance_groups[payload].occluder_batch(origins, directions, t_max)
+            hit = instance >= 0
+            blockers[hit] = self.instance_first[self.group_first[payload] + instance[hit]] + faces[hit]
+        elif kind == "scene_bvh":
+            bvh, entries = payload
+            for index, rays in bvh.primitive_rays(origins, directions, t_max):
+                rays = rays[blockers[rays] < 0]
+                if rays.size and entries[index] is not None:
+                    blockers[rays] = self._occluder_entry(entries[index], origins[rays], directions[rays], t_max[rays])
+        else:
+            for pid in (payload if kind == "tris" else [payload]):
+                hit = self.primitive_hits(np.full(len(origins), pid), origins, directions, t_max)[0]
+                blockers[hit] = pid
+        return blockers
+
+    def intersect_pairs(self, origins, directions, pids, t, prim):
+        """Tests ray i against primitive pids[i] only (pids < 0 are skipped)"""
+        ids = np.nonzero(pids >= 0)[0]
+        hit, t_hit = self.primitive_hits(pids[ids], origins[ids], directions[ids], t[ids])
+        ids = ids[hit]
+        t[ids] = t_hit[hit]
+        prim[ids] = pids[ids]
+
+    def get_color(self, pids, points):
+        """Batched get_color (CheckeredSphere pattern included)"""
+        colors = self.column("diffuse", pids)
+        checkered = self.column("checkered", pids)
+        if checkered.any():
+            scale = self.radius[pids[checkered]] / 9999
+            pts = points[checkered]
+            checker = (np.trunc(pts[:, 0] / scale * 10) % 2 == np.trunc(pts[:, 2] / scale * 10) % 2)[:, None] * 1.0
+            diffuse = colors[checkered]
+            colors[checkered] = checker * diffuse + (1 - checker) * (255.0 - diffuse)
+        return colors
+
+    def get_normal(self, pids, points):
+        normals = self.column("normal", pids)
+        spheres = self.column("kind", pids) == SPHERE
+        if spheres.any():
+            p = pids[spheres]
+            normals[spheres] = (points[spheres] - self.center[p]) / self.radius[p][:, None]
+        return normals
+
+    def shade(self, points, pids, directions, cel_shaded=False):
+        """Batched ray.shade; directions are the directions of the rays that reached the points"""
+        colors = self.get_color(pids, points)
+        if len(self.light_position) == 0:
+            print("No lights for shading")
+            return colors
+
+        ambient_color = colors * self.amb_intensity
+        diffuse_color, specular_color = np.zeros_like(colors), np.zeros_like(colors)
+        in_shadow = np.zeros(len(points), dtype=bool)
+        normals = self.get_normal(pids, points)
+        e_vec = directions * -1
+
+        for light, (position, light_color, intensity) in enumerate(zip(self.light_position, self.light_color,
+                                                                       self.light_intensity)):
+            shadow_dir = position - points
+            distance = np.sqrt(_dot(shadow_dir, shadow_dir))
+            shadow_ray_dir = _normalize(shadow_dir)
+            # Points already in shadow of an earlier light don't need another shadow ray
+            lit = np.nonzero(~in_shadow)[0]
+            self.ray_counts["shadow"] += len(lit)
+            if render_stats.enabled:
+                render_stats.count("shadow_rays", len(lit))
+            in_shadow[lit] = self.occluded_cached(light, points[lit], shadow_ray_dir[lit], distance[lit])
+
+            l_vec = _normalize(shadow_ray_dir)
+            if kernels.backend == "numba":
+                kernels.shade_light(colors, normals, e_vec, l_vec, self.column("shininess", pids), intensity,
+                                    light_color, diffuse_color, specular_color)
+                continue
+            l_dot_n = _dot(l_vec, normals)
+            diffuse_color += colors * intensity * np.maximum(l_dot_n, 0)[:, None]
+            r_vec = normals * (2 * l_dot_n)[:, None] - l_vec
+            e_dot_r = np.maximum(_dot(e_vec, r_vec), 0)
+            specular_color += light_color * intensity * np.power(e_dot_r, self.column("shininess", pids))[:, None]
+
+        total_color = ambient_color + diffuse_color + specular_color
+
+        if cel_shaded:
+            magnitude = np.sqrt(_dot(total_color, total_color))
+            white, light_band, mid_band, dark_band = self.cel_limits
+            scale = np.select([magnitude > light_band, magnitude > mid_band, magnitude > dark_band],
+                              [0.8, 0.5, 0.3], 0.0)[:, None]
+            total_color = np.where((magnitude > white)[:, None], 255.0, colors * scale)
+        else:
+            total_color = np.where(total_color > 255, 255.0, total_color)
+
+        return np.where(in_shadow[:, None], ambient_color / 2, total_color)
+
+    def trace(self, origins, directions, keys, num_bounces, max_bounces=1, multiple=False, cel_shaded=False,
+              first_hits=None, min_weight=0.0, primary=None):
+        """Batched ray_trace for rays given as arrays (directions already normalized).
+        keys seed the per-ray jitter, so a ray gets the same samples no matter how rays are batched.
+        first_hits: (t, primitive id) from an earlier intersect of these same rays, to skip redoing it
+        (not with multiple, where the rays are offset first).
+        primary: something whose intersect(origins, directions) stands in for this scene's on the first pass's
+        rays, e.g. a raster_visibility.RasterVisibility for rays from its eye.
+        Runs as a wavefront instead of recursing: each pass takes all the rays of one bounce together (intersect,
+        shade, spawn reflections), then the colors are resolved back up to these rays, deepest bounce first,
+        blended the same way ray_trace's recursion blends them. Reflection rays carry their weight in the first
+        ray's color; those below min_weight aren't traced and count as the color of the point they leave from"""
+        levels = []
+        weights = np.ones(len(origins))
+        while True:
+            colors, spawned = self._bounce(origins, directions, keys, num_bounces, max_bounces, multiple, cel_shaded,
+                                           first_hits, primary)
+            levels.append((colors, spawned))
+            if spawned is None:
+                break
+            weights = np.repeat(weights[spawned["rows"]], spawned["samples"]) * spawned["r"][:, 0] / spawned["samples"]
+            origins, directions, keys = spawned["origins"], spawned["directions"], spawned["keys"]
+            if min_weight > 0:
+                spawned["kept"] = kept = weights >= min_weight
+                weights, origins, directions, keys = weights[kept], origins[kept], directions[kept], keys[kept]
+            # The recursion in ray_trace doesn't pass cel_shaded on to reflections
+            num_bounces, multiple, cel_shaded, first_hits = num_bounces + 1, spawned["multiple"], False, None
+            primary = None
+
+        reflected = None
+        for colors, spawned in reversed(levels):
+            if spawned is not None:
+                self._resolve(colors, spawned, reflected)
+            reflected = colors
+        return reflected
+
+    def _bounce(self, origins, directions, keys, num_bounces, max_bounces, multiple, cel_shaded, first_hits=None,
+                primary=None):
+        """One wavefront pass: colors of the rays that don't reflect, plus (if any do) what the next pass needs,
+        None otherwise"""
+        count = len(origins)
+        colors = np.tile(self.background_color, (count, 1))
+        if count == 0:
+            return colors, None
+
+        # Really don't need bounces after first few
+        if multiple and num_bounces > 3:
+            multiple = False
+
+        if multiple:
+            samples = len(RAY_OFFSETS)
+            offsets = np.array([(x_off, y_off, 0.0) for (x_off, y_off) in RAY_OFFSETS])
+            sample_keys = _mix(keys[:, None] * np.uint64(samples) + np.arange(samples, dtype=np.uint64))
+            jitter_bits_y = _mix(sample_keys)
+            color_offsets = np.empty((count, samples, 3))
+            color_offsets[..., 0] = offsets[:, 0] + _uniform(sample_keys, -JITTER, JITTER)
+            color_offsets[..., 1] = offsets[:, 1] + _uniform(jitter_bits_y, -JITTER, JITTER)
+            color_offsets[..., 2] = 0.0
+            # Don't jitter silhouette rays, gives dotty appearance
+            sil_dirs = _normalize((directions[:, None] + offsets / 500 * SILH_THICKNESS).reshape(-1, 3))
+            color_dirs = _normalize((directions[:, None] + color_offsets / 500).reshape(-1, 3))
+            sample_origins = np.repeat(origins, samples, axis=0)
+            sample_keys = sample_keys.reshape(-1)
+        else:
+            samples = 1
+            sil_dirs = color_dirs = directions
+            sample_origins = origins
+            sample_keys = _mix(keys)
+
+        self.ray_counts["primary" if num_bounces == 0 else "reflection"] += len(sample_origins)
+        if render_stats.enabled:
+            render_stats.record_depth(num_bounces, count)
+        if first_hits is None or multiple:
+            sil_t, sil_prim = (self if primary is None else primary).intersect(sample_origins, sil_dirs)
+        else:
+            sil_t, sil_prim = first_hits
+        sil_prim = sil_prim.reshape(count, samples)
+        first_hit = sil_prim[:, 0]
+
+        is_background = (sil_prim < 0).all(axis=1)
+        is_edge = ~is_background & (sil_prim < 0).any(axis=1)
+        is_edge |= ~is_background & (self.column("parent_id", np.maximum(sil_prim, 0)) != self.column("parent_id", np.maximum(first_hit, 0))[:, None]).any(axis=1)
+        colors[is_edge] = 0.0
+        if render_stats.enabled:
+            render_stats.count("silhouette_early_outs", np.count_nonzero(is_edge))
+
+        # Color rays only need to be checked against the objects the silhouette rays hit
+        if multiple:
+            color_t = np.full(count * samples, FAR_AWAY)
+            color_prim = np.full(count * samples, -1, dtype=np.int64)
+            for sample in range(samples):
+                self.intersect_pairs(sample_origins, color_dirs, np.repeat(sil_prim[:, sample], samples),
+                                     color_t, color_prim)
+        else:
+            color_t = sil_t
+
+        active = np.nonzero(~is_background & ~is_edge)[0]
+        obj_hit = first_hit[active]
+        rays = (active[:, None] * samples + np.arange(samples)).reshape(-1)
+        ray_t, ray_dirs, ray_origins = color_t[rays], color_dirs[rays], sample_origins[rays]
+        ray_objs = np.repeat(obj_hit, samples)
+
+        # only reflect off of things "reasonably" close
+        valid = ray_t < 1e18
+        points = ray_origins + ray_t[:, None] * ray_dirs
+        normals = self.get_normal(ray_objs, points)
+        dir_dot_n = _dot(ray_dirs, normals)
+        valid &= ~(dir_dot_n > 0)
+        valid = valid.reshape(-1, samples)
+
+        reflective = (self.column("reflectiveness", obj_hit) != 0) & (num_bounces + 1 <= max_bounces)
+        # Non-reflective objects return the first color ray's shade; reflective ones need every ray
+        ok = np.where(reflective, valid.all(axis=1), valid[:, 0])
+        used = (ok[:, None] & (reflective[:, None] | (np.arange(samples) == 0))).reshape(-1)
+
+        shaded = np.zeros((len(rays), 3))
+        with render_stats.stage("shade"):
+            shaded[used] = self.shade(points[used], ray_objs[used], ray_dirs[used], cel_shaded=cel_shaded)
+
+        result = shaded.reshape(-1, samples, 3)[:, 0].copy()
+        result[~ok] = self.background_color
+        colors[active] = result
+        bouncing = np.nonzero(ok & reflective)[0]
+        if bouncing.size == 0:
+            return colors, None
+
+        # Reflective hits are filled in by _resolve, once their reflections are done
+        bounce_rays = (bouncing[:, None] * samples + np.arange(samples)).reshape(-1)
+        n = normals[bounce_rays]
+        d = ray_dirs[bounce_rays]
+        reflected_dirs = _normalize(d + n * (2 * -dir_dot_n[bounce_rays])[:, None])
+        r = self.column("reflectiveness", np.repeat(obj_hit[bouncing], samples))[:, None]
+        return colors, {"rows": active[bouncing], "samples": samples, "multiple": multiple, "r": r,
+                        "shaded": shaded[bounce_rays], "origins": points[bounce_rays], "directions": reflected_dirs,
+                        "keys": sample_keys[rays][bounce_rays], "kept": None}
+
+    @staticmethod
+    def _resolve(colors, spawned, reflected):
+        """Blends the colors of the rays spawned by a pass into the colors of the rays that spawned them"""
+        if spawned["kept"] is not None:
+            traced, reflected = reflected, spawned["shaded"].copy()
+            reflected[spawned["kept"]] = traced
+        samples, r = spawned["samples"], spawned["r"]
+        blended = ((1 - r) * spawned["shaded"] + r * reflected).reshape(-1, samples, 3)
+        sum_color = np.zeros((len(spawned["rows"]), 3))
+        for sample in range(samples):
+            sum_color = sum_color + blended[:, sample]
+        colors[spawned["rows"]] = sum_color / samples
+
+
+def camera_rays(width, height, eye_location, row_start=0, row_stop=None, seed=0, col_start=0, col_stop=None):
+    """Origins, directions and jitter keys of the primary rays for image rows [row_start, row_stop)
+    (and columns [col_start, col_stop))"""
+    row_stop = height if row_stop is None else row_stop
+    col_stop = width if col_stop is None else col_stop
+    i, j = np.mgrid[row_start:row_stop, col_start:col_stop]
+    return pixel_rays(width, height, eye_location, i.reshape(-1), j.reshape(-1), seed)
+
+
+def pixel_rays(width, height, eye_location, i, j, seed=0, offsets=None):
+    """camera_rays for any pixels, given as arrays of rows i and columns j.
+    offsets: (x, y) per ray, moving it off the pixel center (in pixels, +y is up)"""
+    eye = np.array([eye_location.x, eye_location.y, eye_location.z])
+    sample_points = np.empty((len(i), 3))
+    sample_points[:, 0] = -width / 2 + j + 0.5
+    sample_points[:, 1] = height / 2 - i + 0.5
+    sample_points[:, 2] = 0.0
+    if offsets is not None:
+        sample_points[:, :2] += offsets
+    origins = np.tile(eye, (len(i), 1))
+    keys = _mix((i * width + j).astype(np.uint64) + np.uint64(seed) * np.uint64(width * height))
+    return origins, _normalize(sample_points - eye), keys
+
+
+def render_batched(objects_list, lights_list, width, height, eye_location, background_color=Vec3(0, 0, 0),
+                   max_bounces=1, multiple=False, cel_shaded=False, image_data=None, rows_per_batch=16, seed=0,
+                   min_weight=0.0, row_writer=None, rasterize=False):
+    """Renders the whole frame into image_data (allocated if not given), rows_per_batch rows at a time
+    (min_weight: see BatchScene.trace). Each finished band of rows is also passed to row_writer.write_rows,
+    e.g. an image_output stream, if given. rasterize finds what the camera rays hit first with
+    raster_visibility (same image)"""
+    scene = BatchScene(objects_list, lights_list, background_color)
+    return render_scene_batched(scene, width, height, eye_location, max_bounces, multiple, cel_shaded, image_data,
+                                rows_per_batch, seed, min_weight, row_writer, rasterize)
+
+
+def render_scene_batched(scene, width, height, eye_location, max_bounces=1, multiple=False, cel_shaded=False,
+                         image_data=None, rows_per_batch=16, seed=0, min_weight=0.0, row_writer=None,
+                         rasterize=False):
+    """render_batched for an already built BatchScene"""
+    if image_data is None:
+        image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    primary = None
+    if rasterize:
+        from raster_visibility import RasterVisibility
+        primary = RasterVisibility(scene, eye_location)
+    start_time = time.time()
+    for row_start in range(0, height, rows_per_batch):
+        row_stop = min(row_start + rows_per_batch, height)
+        origins, directions, keys = camera_rays(width, height, eye_location, row_start, row_stop, seed)
+        colors = scene.trace(origins, directions, keys, num_bounces=0, max_bounces=max_bounces,
+                             multiple=multiple, cel_shaded=cel_shaded, min_weight=min_weight, primary=primary)
+        image_data[row_start:row_stop] = colors.reshape(row_stop - row_start, width, 3).astype(np.uint8)
+        if row_writer is not None:
+            row_writer.write_rows(image_data[row_start:row_stop])
+        print("Finished with row", row_stop - 1, "after ", round(time.time() - start_time, 3), "seconds.")
+    return image_data
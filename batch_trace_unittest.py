@@ -0,0 +1,263 @@
+import unittest
+from math import pi
+import numpy as np
+import ray
+import batch_trace
+import render_stats
+from parallel_render import render_parallel
+from progressive_render import render_progressive, pass_pixels
+from gbuffer_render import render_gbuffer, gbuffer_edges, trace_gbuffer
+from adaptive_render import render_adaptive, needs_samples
+from raster_visibility import RasterVisibility
+from ray import Ray, ray_trace
+from vector import Vec3
+from SceneObjects import PointLight, Sphere
+from occluder_cache import OccluderCache
+from geometry_loading import checkered_sph_only, spheres_for_link, test_spheres, transform_objects, transformations
+from cube import cube_load
+from BHV_BBox import BoundingBox
+from mesh_unittest import random_mesh
+
+
+def small_scene(size):
+    objects_list = checkered_sph_only(size, reflectiveness=0.4)
+    cube = cube_load(reflectiveness=0.5)
+    scale = size / 4
+    transform_mat = transformations.compose_matrix(scale=(scale, scale, scale), angles=(-30 * pi / 180, 0, 0),
+                                                   translate=(-size / 3, size / 3, size / 2))
+    transform_objects(cube, transform_matrix=transform_mat)
+    objects_list += [BoundingBox(cube)]
+    objects_list += spheres_for_link(size) + test_spheres(size)
+    lights_list = [PointLight(position=Vec3(size, size, -size * 1.5), color=Vec3(255, 255, 255), intensity=1.0)]
+    return objects_list, lights_list
+
+
+def render_args(size):
+    """The camera and options the render comparisons share, for render_*(objects_list, lights_list, **kwargs)"""
+    return dict(width=size, height=size, eye_location=Vec3(0, 0, -size * 1.5), background_color=Vec3(30, 30, 30),
+                max_bounces=3, multiple=True, cel_shaded=True)
+
+
+def render_per_pixel(objects_list, lights_list, size, depth, multiple, cel_shaded):
+    image_data = np.zeros(shape=(size, size, 3), dtype=np.uint8)
+    eye_location = Vec3(0, 0, -size * 1.5)
+    shadow_cache = OccluderCache()
+    for i in range(size):
+        for j in range(size):
+            curr_ray = Ray(eye_location, Vec3(-size / 2 + j + 0.5, size / 2 - i + 0.5, 0) - eye_location)
+            color = ray_trace(objects_list, num_bounces=0, max_bounces=depth, background_color=Vec3(30, 30, 30),
+                              list_of_lights=lights_list, multiple=multiple, ray_given=curr_ray,
+                              cel_shaded=cel_shaded, shadow_cache=shadow_cache)
+            image_data[i, j] = [color.x, color.y, color.z]
+    return image_data
+
+
+class TestBatchedRendering(unittest.TestCase):
+
+    def setUp(self):
+        # Jitter is random per ray in ray_trace, so turn it off in both to compare pixels
+        self.uniform, self.jitter = ray.uniform, batch_trace.JITTER
+        ray.uniform = lambda low, high: 0.0
+        batch_trace.JITTER = 0.0
+
+    def tearDown(self):
+        ray.uniform, batch_trace.JITTER = self.uniform, self.jitter
+
+    def check_matches_per_pixel(self, multiple, cel_shaded):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        expected = render_per_pixel(objects_list, lights_list, size, 3, multiple, cel_shaded)
+        image_data = batch_trace.render_batched(objects_list, lights_list, size, size, Vec3(0, 0, -size * 1.5),
+                                                background_color=Vec3(30, 30, 30), max_bounces=3,
+                                                multiple=multiple, cel_shaded=cel_shaded, rows_per_batch=5)
+        np.testing.assert_array_equal(image_data, expected)
+
+    def test_single_ray_matches(self):
+        self.check_matches_per_pixel(multiple=False, cel_shaded=False)
+
+    def test_cel_shaded_silhouettes_match(self):
+        self.check_matches_per_pixel(multiple=True, cel_shaded=True)
+
+
+    def test_shadow_cache_per_render(self):
+        # The same light in two scenes one after the other: what blocked it in the first mustn't shadow the second
+        size = 12
+        objects_list, lights_list = small_scene(size)
+        blocker = Sphere(pos=lights_list[0].position, radius=size / 4)  # around the light, shadowing everything
+        shadowed = render_per_pixel(objects_list + [blocker], lights_list, size, 3, False, False)
+        unshadowed = render_per_pixel(objects_list, lights_list, size, 3, False, False)
+        self.assertTrue((shadowed != unshadowed).any())
+        np.testing.assert_array_equal(unshadowed, batch_trace.render_batched(
+            objects_list, lights_list, size, size, Vec3(0, 0, -size * 1.5), background_color=Vec3(30, 30, 30),
+            max_bounces=3))
+
+    def test_min_weight_skips_faint_reflections(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        scene = batch_trace.BatchScene(objects_list, lights_list, Vec3(30, 30, 30))
+        origins, directions, keys = batch_trace.camera_rays(size, size, Vec3(0, 0, -size * 1.5))
+        reflections = []
+        for min_weight in (0.0, 1e-6, 0.1):
+            scene.reset_ray_counts()
+            colors = scene.trace(origins, directions, keys, 0, max_bounces=5, min_weight=min_weight)
+            reflections.append(scene.ray_counts["reflection"])
+            if min_weight == 0.0:
+                expected = colors
+            elif min_weight < 1e-3:
+                np.testing.assert_array_equal(colors, expected)
+        self.assertEqual(reflections[0], reflections[1])
+        self.assertLess(reflections[2], reflections[0])
+
+    def test_stats_match_per_pixel(self):
+        size = 12
+        objects_list, lights_list = small_scene(size)
+        render_stats.enable()
+        try:
+            render_per_pixel(objects_list, lights_list, size, 3, False, False)
+            expected = render_stats.summary()
+            render_stats.reset()
+            batch_trace.render_batched(objects_list, lights_list, size, size, Vec3(0, 0, -size * 1.5),
+                                       background_color=Vec3(30, 30, 30), max_bounces=3)
+            stats = render_stats.summary()
+        finally:
+            render_stats.disable()
+        self.assertEqual(stats["depth_histogram"], expected["depth_histogram"])
+        self.assertEqual(stats["counters"]["shadow_rays"], expected["counters"]["shadow_rays"])
+        self.assertGreater(stats["counters"]["box_tests"], 0)
+        self.assertGreater(stats["counters"]["triangle_tests"], 0)
+        self.assertIn("shade", stats["stage_times"])
+        self.assertIn("shade", expected["stage_times"])
+
+    def test_occluder_cache(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        scene = batch_trace.BatchScene(objects_list, lights_list, Vec3(30, 30, 30))
+        origins, directions, keys = batch_trace.camera_rays(size, size, Vec3(0, 0, -size * 1.5))
+        t, prim = scene.intersect(origins, directions)
+        points = origins[prim >= 0] + directions[prim >= 0] * t[prim >= 0, None]
+        shadow_dir = scene.light_position[0] - points
+        distance = np.sqrt((shadow_dir ** 2).sum(axis=1))
+        expected = scene.occluded(points, shadow_dir / distance[:, None], distance)
+        self.assertTrue(expected.any())
+        for _ in range(2):
+            np.testing.assert_array_equal(
+                scene.occluded_cached(0, points, shadow_dir / distance[:, None], distance), expected)
+        self.assertEqual(scene.occluder_cache.tests, len(points))
+        self.assertGreater(scene.occluder_cache.hits, 0)
+
+
+class TestGBufferRendering(unittest.TestCase):
+
+    def test_edge_width(self):
+        ids = np.zeros((4, 8), dtype=np.int64)
+        ids[:, 4:] = 1
+        self.assertEqual(np.nonzero(gbuffer_edges(ids, edge_width=1)[0])[0].tolist(), [3])
+        self.assertEqual(np.nonzero(gbuffer_edges(ids, edge_width=2)[0])[0].tolist(), [3, 4])
+        self.assertEqual(np.nonzero(gbuffer_edges(ids, edge_width=3)[0])[0].tolist(), [2, 3, 4])
+
+    def test_matches_single_ray_off_edges(self):
+        size = 24
+        objects_list, lights_list = small_scene(size)
+        eye_location = Vec3(0, 0, -size * 1.5)
+        expected = batch_trace.render_batched(objects_list, lights_list, size, size, eye_location,
+                                              background_color=Vec3(30, 30, 30), max_bounces=3, cel_shaded=True)
+        image_data = render_gbuffer(objects_list, lights_list, size, size, eye_location,
+                                    background_color=Vec3(30, 30, 30), max_bounces=3, cel_shaded=True,
+                                    refine_edges=False)
+        edges = (image_data != expected).any(axis=-1)
+        self.assertTrue(edges.any())
+        self.assertTrue((image_data[edges] == 0).all())
+
+
+class TestRasterVisibility(unittest.TestCase):
+
+    def test_matches_intersect(self):
+        size = 32
+        objects_list, _ = small_scene(size)
+        mesh = random_mesh(300)
+        mesh.build_bvh(leaf_size=4)
+        scene = batch_trace.BatchScene(objects_list + [mesh], [])
+        eye_location = Vec3(0, 0, -size * 1.5)
+        raster = RasterVisibility(scene, eye_location)
+        origins, directions, _ = batch_trace.camera_rays(size, size, eye_location)
+        # and the offset silhouette rays of multiple=True, which miss the pixel centers
+        offsets = np.array([(x_off, y_off, 0.0) for x_off, y_off in batch_trace.RAY_OFFSETS])
+        silhouette_dirs = batch_trace._normalize((directions[:, None] + offsets / 500 * 4).reshape(-1, 3))
+        for origins, directions in ((origins, directions), (np.repeat(origins, 4, axis=0), silhouette_dirs)):
+            t, prim = scene.intersect(origins, directions)
+            raster_t, raster_prim = raster.intersect(origins, directions)
+            np.testing.assert_array_equal(raster_prim, prim)
+            np.testing.assert_array_equal(raster_t, t)
+            self.assertTrue((raster.candidates(directions) == prim).mean() > 0.9)
+
+    def test_renders_match(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        kwargs = render_args(size)
+        expected = batch_trace.render_batched(objects_list, lights_list, **kwargs)
+        np.testing.assert_array_equal(batch_trace.render_batched(objects_list, lights_list, **kwargs, rasterize=True),
+                                      expected)
+        np.testing.assert_array_equal(render_parallel(objects_list, lights_list, **kwargs, workers=2, rasterize=True),
+                                      expected)
+        np.testing.assert_array_equal(render_progressive(objects_list, lights_list, **kwargs, rasterize=True),
+                                      expected)
+        del kwargs["multiple"]
+        for render in (render_gbuffer, render_adaptive):
+            np.testing.assert_array_equal(render(objects_list, lights_list, **kwargs, rasterize=True),
+                                          render(objects_list, lights_list, **kwargs))
+
+
+class TestAdaptiveRendering(unittest.TestCase):
+
+    def test_only_refines_where_neighbours_differ(self):
+        size = 24
+        objects_list, lights_list = small_scene(size)
+        eye_location = Vec3(0, 0, -size * 1.5)
+        single = batch_trace.render_batched(objects_list, lights_list, size, size, eye_location,
+                                            background_color=Vec3(30, 30, 30), max_bounces=3, cel_shaded=True)
+        scene = batch_trace.BatchScene(objects_list, lights_list, Vec3(30, 30, 30))
+        colors, ids, depth, _ = trace_gbuffer(scene, size, size, eye_location, max_bounces=3, cel_shaded=True)
+        refine = needs_samples(colors, ids, depth, contrast=16.0, depth_jump=0.1)
+        self.assertTrue(refine.any() and not refine.all())
+
+        for max_samples in (1, 8):
+            image_data = render_adaptive(objects_list, lights_list, size, size, eye_location,
+                                         background_color=Vec3(30, 30, 30), max_bounces=3, cel_shaded=True,
+                                         max_samples=max_samples, contrast=16.0, depth_jump=0.1)
+            np.testing.assert_array_equal(image_data[~refine], single[~refine])
+        self.assertFalse((image_data[refine] == single[refine]).all())
+
+
+class TestParallelRendering(unittest.TestCase):
+
+    def test_matches_serial(self):
+        # Jitter stays on: it is keyed per pixel, so tiles and processes don't change it
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        kwargs = render_args(size)
+        expected = batch_trace.render_batched(objects_list, lights_list, **kwargs)
+        np.testing.assert_array_equal(render_parallel(objects_list, lights_list, **kwargs, workers=2, tile_size=5),
+                                      expected)
+
+
+class TestProgressiveRendering(unittest.TestCase):
+
+    def test_passes_cover_every_pixel_once(self):
+        counts = np.zeros((13, 10), dtype=int)
+        steps = (8, 4, 2, 1)
+        for index, step in enumerate(steps):
+            i, j = pass_pixels(10, 13, step, steps[:index])
+            np.add.at(counts, (i, j), 1)
+        self.assertTrue((counts == 1).all())
+
+    def test_matches_serial(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        kwargs = render_args(size)
+        expected = batch_trace.render_batched(objects_list, lights_list, **kwargs)
+        np.testing.assert_array_equal(render_progressive(objects_list, lights_list, **kwargs, steps=(6, 3),
+                                                         pixels_per_batch=20), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from functools import partial
+from math import pi
+import numpy as np
+import transformations
+from vector import Vec3
+from SceneObjects import PointLight
+from BHV_BBox import BoundingBox
+from cube import cube_load
+from geometry_loading import checkered_sph_only, test_spheres, spheres_for_link, transform_objects, \
+    load_toon_link_meshes
+from batch_trace import BatchScene, camera_rays
+from gbuffer_render import render_scene_gbuffer
+from adaptive_render import render_scene_adaptive
+import kernels
+
+"""Render throughput benchmarks, replacing the interactive Vec3/Ray loop in timing_testing.py.
+Fixed scenes (set up the way main.py does) are rendered with the batched tracer at a few sizes, with
+cel-shading and silhouettes off and on. Every case reports load, BVH build and render times, ray counts and
+rays/sec as JSON; given a baseline from an earlier run, cases that got slower (or render a different image)
+are flagged.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json  # exits with 1 if anything regressed"""
+
+BENCHMARK_VERSION = 1  # bump when the scenes change, so old baselines aren't compared against
+SIZES = (64, 128)
+STYLES = {"plain": {"cel_shaded": False, "multiple": False},
+          "cel_silhouette": {"cel_shaded": True, "multiple": True},
+          "cel_gbuffer": {"cel_shaded": True, "gbuffer": True},  # silhouettes from gbuffer_render
+          "cel_adaptive": {"cel_shaded": True, "adaptive": 8}}  # the same, antialiased by adaptive_render
+DEPTH = 5
+VIEWING_ANGLE = 30
+BACKGROUND_COLOR = Vec3(30, 30, 30)
+ROWS_PER_BATCH = 16
+TOLERANCE = 0.1  # fraction of the baseline's rays/sec a case may lose before it counts as a regression
+
+
+def _timed(timings, name, build):
+    start_time = time.perf_counter()
+    result = build()
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - start_time
+    return result
+
+
+def spheres_scene(size, timings):
+    return _timed(timings, "load", lambda: checkered_sph_only(size, viewing_angle=VIEWING_ANGLE, reflectiveness=0.4) +
+                  test_spheres(size, viewing_angle=VIEWING_ANGLE))
+
+
+def cube_scene(size, timings):
+    """main.py's cube (in a BoundingBox) on the checkered floor"""
+    def load():
+        cube = cube_load(reflectiveness=0.5)
+        rot_mat1 = transformations.compose_matrix(angles=(0, 0, -90 * pi / 180))
+        rot_mat2 = transformations.compose_matrix(angles=(0, 65 * pi / 180, 0))
+        scale = size / 4
+        transform_mat = transformations.compose_matrix(scale=(scale, scale, scale),
+                                                       angles=(-VIEWING_ANGLE * pi / 180, 0, 0),
+                                                       translate=(-size/3, size / 3, size/2)).dot(rot_mat2.dot(rot_mat1))
+        transform_objects(cube, transform_matrix=transform_mat)
+        return checkered_sph_only(size, viewing_angle=VIEWING_ANGLE, reflectiveness=0.4), cube
+
+    objects_list, cube = _timed(timings, "load", load)
+    return objects_list + [_timed(timings, "bvh_build", lambda: BoundingBox(cube))]
+
+
+def link_scene(size, timings, copies=1, reflectiveness=0.0):
+    """main.py's Link mesh (copies=2 adds the second, smaller one) with its sphere, on the checkered floor"""
+    placements = [(size / 35, (0, 1.2 * -size / 3, 0), (67*1.2, 158*1.2, 78*1.2)),
+                  (size / 50, (1.5 * size / 4, -size / 10, size / 4), (67*1.4, 79*1.4, 140*1.4))][:copies]
+    link_meshes = _timed(timings, "load", lambda: load_toon_link_meshes((15, 180, 0), placements, reflectiveness))
+    _timed(timings, "bvh_build", link_meshes.build_bvh)
+    return (checkered_sph_only(size, viewing_angle=VIEWING_ANGLE, reflectiveness=0.4) + [link_meshes] +
+            spheres_for_link(size, viewing_angle=VIEWING_ANGLE))
+
+
+SCENES = {"spheres": spheres_scene,
+          "cube_bvh": cube_scene,
+          "link": link_scene,
+          "two_links_reflective": partial(link_scene, copies=2, reflectiveness=0.3)}
+
+
+def case_name(case):
+    return f"{case['scene']}/{case['size']}/{case['style']}"
+
+
+def render_case(scene, size, style, seed=0):
+    """Renders scene (a BatchScene) at size x size; returns (render seconds, image)"""
+    image_data = np.zeros(shape=(size, size, 3), dtype=np.uint8)
+    eye_location = Vec3(0, 0, -size * 1.5)
+    start_time = time.perf_counter()
+    if STYLES[style].get("gbuffer"):
+        render_scene_gbuffer(scene, size, size, eye_location, max_bounces=DEPTH, image_data=image_data,
+                             cel_shaded=STYLES[style]["cel_shaded"], rows_per_batch=ROWS_PER_BATCH, seed=seed)
+        return time.perf_counter() - start_time, image_data
+    if STYLES[style].get("adaptive"):
+        render_scene_adaptive(scene, size, size, eye_location, max_bounces=DEPTH, image_data=image_data,
+                              cel_shaded=STYLES[style]["cel_shaded"], max_samples=STYLES[style]["adaptive"],
+                              silhouettes=True, rows_per_batch=ROWS_PER_BATCH, seed=seed)
+        return time.perf_counter() - start_time, image_data
+    for row_start in range(0, size, ROWS_PER_BATCH):
+        row_stop = min(row_start + ROWS_PER_BATCH, size)
+        origins, directions, keys = camera_rays(size, size, eye_location, row_start, row_stop, seed)
+        colors = scene.trace(origins, directions, keys, num_bounces=0, max_bounces=DEPTH, **STYLES[style])
+        image_data[row_start:row_stop] = colors.reshape(row_stop - row_start, size, 3).astype(np.uint8)
+    return time.perf_counter() - start_time, image_data
+
+
+def run_suite(scenes=tuple(SCENES), sizes=SIZES, styles=tuple(STYLES), repeat=3):
+    """One result dict per (scene, size, style). The scene is set up once per size and every style is rendered
+    repeat times; the fastest render is reported"""
+    cases = []
+    for scene_name in scenes:
+        for size in sizes:
+            timings = {"load": 0.0, "bvh_build": 0.0}
+            # The loaders report progress on stdout; keep it for the summary
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                objects_list = SCENES[scene_name](size, timings)
+                lights_list = [PointLight(position=Vec3(size, size, -size * 1.5),
+                                          color=Vec3(255, 255, 255), intensity=1.0)]
+                scene = _timed(timings, "pack", lambda: BatchScene(objects_list, lights_list, BACKGROUND_COLOR))
+            for style in styles:
+                render_time = None
+                for _ in range(repeat):
+                    scene.reset_ray_counts()
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        elapsed, image_data = render_case(scene, size, style)
+                    render_time = elapsed if render_time is None else min(render_time, elapsed)
+                rays = dict(scene.ray_counts)
+                cases.append({"scene": scene_name, "size": size, "style": style,
+                              "load_time": timings["load"], "bvh_build_time": timings["bvh_build"],
+                              "pack_time": timings["pack"], "render_time": render_time,
+                              "rays": rays, "rays_per_sec": sum(rays.values()) / render_time,
+                              "image_sha256": hashlib.sha256(image_data.tobytes()).hexdigest()})
+                print(f"{case_name(cases[-1]):40} {render_time:8.3f}s {cases[-1]['rays_per_sec']:12.0f} rays/s")
+    return {"version": BENCHMARK_VERSION,
+            "machine": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count(), "kernels": kernels.backend},
+            "cases": cases}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Messages for every case of results that lost more than tolerance of the baseline's rays/sec,
+    or renders a different image than it did for the baseline"""
+    if baseline.get("version") != results["version"]:
+        return [f"Baseline is from benchmark version {baseline.get('version')}, not {results['version']}"]
+    baseline_cases = {case_name(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = baseline_cases.get(case_name(case))
+        if old is None:
+            continue
+        change = case["rays_per_sec"] / old["rays_per_sec"] - 1
+        if change < -tolerance:
+            regressions.append(f"{case_name(case)}: {case['rays_per_sec']:.0f} rays/s, "
+                               f"{-change:.0%} slower than the baseline's {old['rays_per_sec']:.0f}")
+        if case["image_sha256"] != old["image_sha256"]:
+            regressions.append(f"{case_name(case)}: image differs from the baseline's")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render throughput benchmarks")
+    parser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES))
+    parser.add_argument("--styles", nargs="+", choices=list(STYLES), default=list(STYLES))
+    parser.add_argument("--repeat", type=int, default=3, help="renders per case; the fastest counts")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.scenes, args.sizes, args.styles, max(args.repeat, 1))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            return 1
+        print("No regressions against", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
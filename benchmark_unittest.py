@@ -0,0 +1,33 @@
+import contextlib
+import io
+import unittest
+from benchmark import run_suite, compare
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.results = run_suite(scenes=["spheres"], sizes=[8], repeat=1)
+
+    def test_cases_and_ray_counts(self):
+        self.assertEqual([case["style"] for case in self.results["cases"]],
+                         ["plain", "cel_silhouette", "cel_gbuffer", "cel_adaptive"])
+        plain, silhouette = self.results["cases"][:2]
+        self.assertEqual(plain["rays"]["primary"], 8 * 8)
+        self.assertEqual(silhouette["rays"]["primary"], 8 * 8 * 4)
+        self.assertGreater(plain["rays"]["shadow"], 0)
+        self.assertGreater(plain["rays_per_sec"], 0)
+
+    def test_compare_flags_slowdowns_and_image_changes(self):
+        self.assertEqual(compare(self.results, self.results), [])
+        slower = {**self.results, "cases": [dict(case, rays_per_sec=case["rays_per_sec"] / 2)
+                                            for case in self.results["cases"]]}
+        self.assertEqual(len(compare(slower, self.results)), 4)
+        changed = {**self.results, "cases": [dict(case, image_sha256="0") for case in self.results["cases"]]}
+        self.assertEqual(len(compare(changed, self.results)), 4)
+        self.assertEqual(len(compare(self.results, {"version": 0})), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
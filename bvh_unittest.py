@@ -0,0 +1,204 @@
+import unittest
+import numpy as np
+import transformations
+import BHV_BBox
+import kernels
+from ray import Ray, ray_intersection
+from vector import Vec3
+from SceneObjects import Triangle, TriangleMesh, Sphere, PointLight
+from BHV_BBox import BoundingBox, SceneBVH
+from batch_trace import BatchScene
+
+
+def random_triangles(count, seed=7):
+    rng = np.random.default_rng(seed)
+    # Clumped like a model, so the splits matter
+    centers = np.concatenate((rng.normal(-8, 2, (count // 2, 3)), rng.normal(6, 4, (count - count // 2, 3))))
+    return [Triangle(Vec3(c + rng.uniform(-1, 1, 3)), Vec3(c + rng.uniform(-1, 1, 3)), Vec3(c + rng.uniform(-1, 1, 3)))
+            for c in centers]
+
+
+def random_rays(count, seed=11):
+    rng = np.random.default_rng(seed)
+    return [(Vec3(rng.uniform(-20, 20, 3)), Vec3(rng.uniform(-1, 1, 3))) for _ in range(count)]
+
+
+class TestBoundingBox(unittest.TestCase):
+
+    def setUp(self):
+        self.triangles = random_triangles(300)
+
+    def check_hits_match_list(self, box):
+        for origin, direction in random_rays(300):
+            list_ray, box_ray = Ray(origin, direction), Ray(origin, direction)
+            list_hit = ray_intersection(list_ray, self.triangles)
+            self.assertIs(ray_intersection(box_ray, [box]), list_hit)
+            self.assertEqual(box_ray.nearest_hit_distance, list_ray.nearest_hit_distance)
+
+    def test_sah_hits_match_list(self):
+        self.check_hits_match_list(BoundingBox(self.triangles, leaf_size=4, method="sah"))
+
+    def test_median_hits_match_list(self):
+        self.check_hits_match_list(BoundingBox(self.triangles, leaf_size=1, method="median"))
+
+    def test_occluded_matches_intersect(self):
+        box = BoundingBox(self.triangles, leaf_size=4)
+        for origin, direction in random_rays(300):
+            shadow_ray, closest_ray = Ray(origin, direction, 15.0), Ray(origin, direction, 15.0)
+            self.assertEqual(box.occluded(shadow_ray), box.intersect(closest_ray) is not False)
+            self.assertEqual(shadow_ray.nearest_hit_distance, 15.0)
+
+    def test_stats(self):
+        sah = BoundingBox(self.triangles, leaf_size=4).get_stats()
+        median = BoundingBox(self.triangles, leaf_size=4, method="median").get_stats()
+        self.assertEqual(sah["objects"], 300)
+        self.assertLessEqual(sah["max_leaf_objects"], 4)
+        self.assertEqual(sah["nodes"], 2 * sah["leaves"] - 1)
+        self.assertLess(sah["sah_cost"], median["sah_cost"])
+
+
+class TestFlatBVH(unittest.TestCase):
+
+    def setUp(self):
+        triangles = random_triangles(300)
+        self.mesh = TriangleMesh([(t.A.x, t.A.y, t.A.z) for t in triangles], [(t.B.x, t.B.y, t.B.z) for t in triangles],
+                                 [(t.C.x, t.C.y, t.C.z) for t in triangles])
+        self.bvh_mesh = self.mesh.copy()
+        self.bvh_mesh.build_bvh(leaf_size=4)
+        rays = [Ray(origin, direction) for origin, direction in random_rays(300)]
+        self.origins = np.array([(r.origin.x, r.origin.y, r.origin.z) for r in rays])
+        self.directions = np.array([(r.direction.x, r.direction.y, r.direction.z) for r in rays])
+
+    def test_single_rays_match_all_faces(self):
+        for origin, direction in zip(self.origins, self.directions):
+            mesh_ray, bvh_ray = Ray(Vec3(origin), Vec3(direction)), Ray(Vec3(origin), Vec3(direction))
+            mesh_hit, bvh_hit = self.mesh.intersect(mesh_ray), self.bvh_mesh.intersect(bvh_ray)
+            self.assertEqual(bvh_ray.nearest_hit_distance, mesh_ray.nearest_hit_distance)
+            if mesh_hit is not False:
+                np.testing.assert_array_equal(self.bvh_mesh.A[bvh_hit.index], self.mesh.A[mesh_hit.index])
+
+    def test_batch_matches_single_rays(self):
+        t, faces = self.bvh_mesh.intersect_batch(self.origins, self.directions)
+        self.assertTrue((faces >= 0).any())
+        for origin, direction, t_hit, face in zip(self.origins, self.directions, t, faces):
+            bvh_ray = Ray(Vec3(origin), Vec3(direction))
+            bvh_ray.direction = Vec3(direction)  # skip normalizing twice
+            bvh_hit = self.bvh_mesh.intersect(bvh_ray)
+            self.assertEqual(face, -1 if bvh_hit is False else bvh_hit.index)
+            self.assertEqual(t_hit, bvh_ray.nearest_hit_distance)
+
+    def test_occluded_matches_intersect(self):
+        t_max = np.full(len(self.origins), 15.0)
+        blocked = self.bvh_mesh.occluded_batch(self.origins, self.directions, t_max)
+        np.testing.assert_array_equal(blocked, self.mesh.occluded_batch(self.origins, self.directions, t_max))
+        self.assertTrue(blocked.any() and not blocked.all())
+        for origin, direction, batch_blocked in zip(self.origins, self.directions, blocked):
+            shadow_ray, closest_ray = Ray(Vec3(origin), Vec3(direction), 15.0), Ray(Vec3(origin), Vec3(direction), 15.0)
+            self.assertEqual(self.bvh_mesh.occluded(shadow_ray), self.bvh_mesh.intersect(closest_ray) is not False)
+            self.assertEqual(self.bvh_mesh.occluded(shadow_ray), batch_blocked)
+            self.assertEqual(shadow_ray.nearest_hit_distance, 15.0)
+
+    def test_layout(self):
+        bvh = self.bvh_mesh.bvh
+        stats = bvh.get_stats()
+        self.assertEqual(stats["objects"], 300)
+        self.assertEqual(stats["nodes"], 2 * stats["leaves"] - 1)
+        self.assertLessEqual(stats["max_leaf_objects"], 4)
+        # Leaves cover every face exactly once, in order
+        leaves = bvh.nodes[bvh.nodes["count"] > 0]
+        leaves = leaves[np.argsort(leaves["offset"])]
+        np.testing.assert_array_equal(leaves["offset"][1:], (leaves["offset"] + leaves["count"])[:-1])
+
+    def trace_fan(self):
+        """(t, faces, shadowed) of a fan of rays from one point, like camera rays, and of shadow rays from where
+        they hit toward a light"""
+        x, y = np.meshgrid(np.linspace(-0.45, 0.45, 60), np.linspace(-0.45, 0.45, 60))
+        directions = np.column_stack((x.ravel(), y.ravel(), np.ones(x.size)))
+        directions /= np.sqrt((directions ** 2).sum(axis=1))[:, None]
+        t, faces = self.bvh_mesh.intersect_batch(np.tile([-1.0, -1.0, -25.0], (len(directions), 1)), directions)
+        hits = np.array([-1.0, -1.0, -25.0]) + directions[faces >= 0] * t[faces >= 0, None]
+        to_light = np.array([30.0, 40.0, -30.0]) - hits
+        distances = np.sqrt((to_light ** 2).sum(axis=1))
+        return t, faces, self.bvh_mesh.occluded_batch(hits, to_light / distances[:, None], distances)
+
+    def test_packets_match_single_rays(self):
+        backend, packet_size = kernels.backend, BHV_BBox.PACKET_SIZE
+        results = []
+        try:
+            for name in kernels.BACKENDS if kernels.numba_installed else ("numpy",):
+                kernels.use(name)
+                for BHV_BBox.PACKET_SIZE in (1, packet_size):
+                    results.append(self.trace_fan())
+        finally:
+            kernels.use(backend)
+            BHV_BBox.PACKET_SIZE = packet_size
+        self.assertTrue((results[0][1] >= 0).sum() > 100 and results[0][2].any() and not results[0][2].all())
+        for t, faces, blocked in results[1:]:
+            np.testing.assert_array_equal(t, results[0][0])
+            np.testing.assert_array_equal(faces, results[0][1])
+            np.testing.assert_array_equal(blocked, results[0][2])
+
+    def test_refit_after_pose(self):
+        self.test_single_rays_match_all_faces()  # so the per-ray node tuples exist before the refit
+        built_cost = self.bvh_mesh.bvh.sah_cost()
+        pose = transformations.compose_matrix(angles=(0.3, 1.1, 0), translate=(2, 0, -3))
+        self.mesh.pose(pose)
+        self.bvh_mesh.pose(pose)
+        nodes = self.bvh_mesh.bvh.nodes
+        corners = np.stack((self.bvh_mesh.A, self.bvh_mesh.B, self.bvh_mesh.C), axis=1)
+        for index, (low, high, offset, count) in enumerate(nodes.tolist()):
+            if count:
+                np.testing.assert_array_equal(low, corners[offset:offset + count].min(axis=(0, 1)))
+                np.testing.assert_array_equal(high, corners[offset:offset + count].max(axis=(0, 1)))
+            else:
+                np.testing.assert_array_equal(low, np.minimum(nodes["min"][index + 1], nodes["min"][offset]))
+                np.testing.assert_array_equal(high, np.maximum(nodes["max"][index + 1], nodes["max"][offset]))
+        self.assertGreater(self.bvh_mesh.bvh.sah_cost(), built_cost)
+        self.test_single_rays_match_all_faces()
+        self.test_batch_matches_single_rays()
+
+
+class TestSceneBVH(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        triangles = random_triangles(60)
+        mesh = TriangleMesh([(t.A.x, t.A.y, t.A.z) for t in triangles[:30]], [(t.B.x, t.B.y, t.B.z) for t in triangles[:30]],
+                            [(t.C.x, t.C.y, t.C.z) for t in triangles[:30]])
+        mesh.build_bvh(leaf_size=4)
+        spheres = [Sphere(Vec3(rng.uniform(-15, 15, 3)), rng.uniform(0.5, 2)) for _ in range(30)]
+        self.objects = spheres[:15] + [mesh] + triangles[30:40] + [BoundingBox(triangles[40:])] + spheres[15:]
+        self.scene_bvh = SceneBVH(self.objects, leaf_size=2)
+
+    def test_hits_match_list(self):
+        for origin, direction in random_rays(300):
+            list_ray, bvh_ray = Ray(origin, direction), Ray(origin, direction)
+            list_hit = ray_intersection(list_ray, self.objects)
+            self.assertIs(ray_intersection(bvh_ray, [self.scene_bvh]), list_hit)
+            self.assertEqual(bvh_ray.nearest_hit_distance, list_ray.nearest_hit_distance)
+            shadow_ray = Ray(origin, direction, 15.0)
+            self.assertEqual(self.scene_bvh.occluded(shadow_ray), list_ray.nearest_hit_distance < 15.0)
+            # The blocker found blocks the ray on its own, as ray.shade's shadow_cache relies on
+            blocker = self.scene_bvh.occluder(shadow_ray)
+            self.assertEqual(blocker is not None, list_ray.nearest_hit_distance < 15.0)
+            self.assertTrue(blocker is None or blocker.occluded(shadow_ray))
+
+    def test_batch_scene_matches_list(self):
+        lights = [PointLight(position=Vec3(20, 20, -30), color=Vec3(255, 255, 255), intensity=1.0)]
+        rays = [Ray(origin, direction) for origin, direction in random_rays(300)]
+        origins = np.array([(r.origin.x, r.origin.y, r.origin.z) for r in rays])
+        directions = np.array([(r.direction.x, r.direction.y, r.direction.z) for r in rays])
+        list_t, list_prim = BatchScene(self.objects, lights, Vec3(0, 0, 0)).intersect(origins, directions)
+        scene = BatchScene([self.scene_bvh], lights, Vec3(0, 0, 0))
+        self.assertEqual(scene.sequence[0][0], "scene_bvh")
+        rebuilt = BatchScene.from_arrays(*scene.to_arrays())
+        for tested in (scene, rebuilt):
+            t, prim = tested.intersect(origins, directions)
+            np.testing.assert_array_equal(t, list_t)
+            np.testing.assert_array_equal(prim, list_prim)
+            np.testing.assert_array_equal(tested.occluded(origins, directions, np.full(len(rays), 15.0)),
+                                          list_t < 15.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
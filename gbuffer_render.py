@@ -0,0 +1,123 @@
+import time
+import numpy as np
+from vector import Vec3
+from batch_trace import BatchScene, camera_rays, pixel_rays, RAY_OFFSETS, SILH_THICKNESS, FAR_AWAY
+from raster_visibility import RasterVisibility
+
+"""Silhouette edges from a G-buffer instead of extra rays.
+ray_trace(multiple=True) fires four offset silhouette rays and four jittered color rays per pixel and draws a
+black edge where the silhouette rays hit different objects. Here each pixel traces one ray, which also fills an
+object id / depth / normal buffer; edges are then found in image space, by comparing every pixel with its
+neighbours as far away as the silhouette rays would have spread (set by silh_thickness, like ray_trace's).
+Only the pixels just outside the edges get the eight rays again, so the outline still comes out antialiased."""
+
+
+def silhouette_width(eye_location, silh_thickness=SILH_THICKNESS):
+    """Width in pixels of the edges ray_trace's silhouette rays draw: they land this far apart on the
+    image plane (z = 0). At least 1"""
+    spread = 2 * max(abs(x_off) for x_off, _ in RAY_OFFSETS) / 500 * silh_thickness * abs(eye_location.z)
+    return max(1, int(round(spread)))
+
+
+def _neighbours(array, low, high):
+    """(dy, dx, array shifted by dy, dx) for every offset in [low, high] but (0, 0); the border is repeated
+    past the edges of the image"""
+    height, width = array.shape[:2]
+    pad = max(-low, high)
+    padded = np.pad(array, [(pad, pad), (pad, pad)] + [(0, 0)] * (array.ndim - 2), mode="edge")
+    for dy in range(low, high + 1):
+        for dx in range(low, high + 1):
+            if dy or dx:
+                yield dy, dx, padded[pad + dy:pad + dy + height, pad + dx:pad + dx + width]
+
+
+def gbuffer_edges(ids, depth=None, normals=None, edge_width=1, depth_jump=None, crease_cos=None):
+    """Edge mask of a G-buffer: where the object id (-1 for the background) changes, a band edge_width pixels wide.
+    depth_jump also marks pixels next to one on the same object more than that fraction nearer or farther,
+    crease_cos those whose normals meet at a cosine below it"""
+    edges = np.zeros(ids.shape, dtype=bool)
+    # A pixel is in the band if a pixel this side of the change, or past it, differs
+    for _, _, other_ids in _neighbours(ids, -(edge_width // 2), (edge_width + 1) // 2):
+        edges |= other_ids != ids
+    hit = ids >= 0
+    if depth_jump is not None:
+        for _, _, other_depth in _neighbours(depth, 0, 1):
+            edges |= hit & (np.abs(other_depth - depth) > depth_jump * np.minimum(other_depth, depth))
+    if crease_cos is not None:
+        for _, _, other_normals in _neighbours(normals, 0, 1):
+            edges |= hit & (np.sum(other_normals * normals, axis=-1) < crease_cos)
+    return edges
+
+
+def _outline(edges):
+    """Pixels that aren't edges but touch one (4-neighbourhood)"""
+    touching = np.zeros(edges.shape, dtype=bool)
+    for dy, dx, other_edges in _neighbours(edges, -1, 1):
+        if not (dy and dx):
+            touching |= other_edges
+    return touching & ~edges
+
+
+def trace_gbuffer(scene, width, height, eye_location, max_bounces=1, cel_shaded=False, rows_per_batch=16, seed=0,
+                  primary=None):
+    """One ray through every pixel center; returns the (height, width) colors (as floats), object ids
+    (BatchScene.parent_id, -1 for the background), depths (t of hit) and normals. primary as in BatchScene.trace"""
+    colors = np.zeros((height, width, 3))
+    ids = np.full((height, width), -1, dtype=np.int64)
+    depth = np.full((height, width), FAR_AWAY)
+    normals = np.zeros((height, width, 3))
+    for row_start in range(0, height, rows_per_batch):
+        row_stop = min(row_start + rows_per_batch, height)
+        rows = slice(row_start, row_stop)
+        origins, directions, keys = camera_rays(width, height, eye_location, row_start, row_stop, seed)
+        t, prim = (scene if primary is None else primary).intersect(origins, directions)
+        colors[rows] = scene.trace(origins, directions, keys, num_bounces=0, max_bounces=max_bounces,
+                                   cel_shaded=cel_shaded, first_hits=(t, prim)).reshape(-1, width, 3)
+        hit = np.nonzero(prim >= 0)[0]
+        points = origins[hit] + t[hit, None] * directions[hit]
+        ids[rows].reshape(-1)[hit] = scene.column("parent_id", prim[hit])
+        depth[rows].reshape(-1)[hit] = t[hit]
+        normals[rows].reshape(-1, 3)[hit] = scene.get_normal(prim[hit], points)
+    return colors, ids, depth, normals
+
+
+def render_scene_gbuffer(scene, width, height, eye_location, max_bounces=1, cel_shaded=False, image_data=None,
+                         silh_thickness=SILH_THICKNESS, depth_jump=None, crease_cos=None, refine_edges=True,
+                         rows_per_batch=16, seed=0, pixels_per_batch=4096, rasterize=False):
+    """render_gbuffer for an already built BatchScene"""
+    if image_data is None:
+        image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    start_time = time.time()
+    primary = RasterVisibility(scene, eye_location) if rasterize else None
+    colors, ids, depth, normals = trace_gbuffer(scene, width, height, eye_location, max_bounces, cel_shaded,
+                                                rows_per_batch, seed, primary)
+    edges = gbuffer_edges(ids, depth, normals, silhouette_width(eye_location, silh_thickness), depth_jump,
+                          crease_cos)
+    colors[edges] = 0.0
+    print(f"G-buffer pass and edges took {round(time.time() - start_time, 3)} seconds, "
+          f"{np.count_nonzero(edges)} edge pixels")
+
+    if refine_edges:
+        # ray_trace's own silhouette rays decide the pixels around the outline, at sub-pixel precision
+        i, j = np.nonzero(_outline(edges))
+        for batch_start in range(0, len(i), pixels_per_batch):
+            batch = slice(batch_start, batch_start + pixels_per_batch)
+            origins, directions, keys = pixel_rays(width, height, eye_location, i[batch], j[batch], seed)
+            colors[i[batch], j[batch]] = scene.trace(origins, directions, keys, num_bounces=0,
+                                                     max_bounces=max_bounces, multiple=True, cel_shaded=cel_shaded,
+                                                     primary=primary)
+        print(f"Refined {len(i)} outline pixels after {round(time.time() - start_time, 3)} seconds")
+    image_data[...] = colors.astype(np.uint8)
+    return image_data
+
+
+def render_gbuffer(objects_list, lights_list, width, height, eye_location, background_color=Vec3(0, 0, 0),
+                   max_bounces=1, cel_shaded=False, image_data=None, silh_thickness=SILH_THICKNESS, depth_jump=None,
+                   crease_cos=None, refine_edges=True, rows_per_batch=16, seed=0, rasterize=False):
+    """render_batched(multiple=True) with G-buffer edges: one ray per pixel plus edges found in image space
+    (see gbuffer_edges for depth_jump and crease_cos); refine_edges re-traces the pixels bordering the edges
+    with ray_trace's eight rays. rasterize as in render_batched"""
+    scene = BatchScene(objects_list, lights_list, background_color)
+    return render_scene_gbuffer(scene, width, height, eye_location, max_bounces, cel_shaded, image_data,
+                                silh_thickness, depth_jump, crease_cos, refine_edges, rows_per_batch, seed,
+                                rasterize=rasterize)
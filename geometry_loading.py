@@ -2,10 +2,12 @@
 import os
 import numpy as np
 from vector import Vec3
-from SceneObjects import Triangle, Sphere, CheckeredSphere
+from SceneObjects import Triangle, Sphere, CheckeredSphere, TriangleMesh
+from instancing import MeshInstance, InstanceGroup
 from math import sin, cos, pi
 import time
 import transformations as transformations
+import render_stats
 
 
 def test_spheres(size, viewing_angle=30):
@@ -85,7 +87,11 @@ def transform_objects(list_of_objects, transform_matrix=transformations.identity
             obj.C = Vec3(transform_matrix.dot(np.asarray([obj.C.x, obj.C.y, obj.C.z, 1]))[:3])
             obj.calc_normal()  # built in method
             obj.normal = -1 * obj.normal
+        elif isinstance(obj, TriangleMesh):
+            obj.transform(transform_matrix)  # all faces at once
+            obj.flip_normals()
     print(f"Transformation of objects took {time.time() - transformation_start_time}s ")
+    render_stats.add_time("transform", time.time() - transformation_start_time)
 
 
 class ObjLoader:
@@ -144,12 +150,164 @@ class ObjLoader:
         self.model = np.array(self.model, dtype='float32')
 
 
+# Record types NumpyObjLoader reads, by their keyword
+OBJ_VERT, OBJ_TEXT, OBJ_NORM, OBJ_FACE = 1, 2, 3, 4
+OBJ_BLOCK_BYTES = 1 << 22  # bytes of the file parsed at once (whole lines); parsing needs ~25x this on top
+
+
+class NumpyObjLoader:
+    """Bulk replacement for ObjLoader: the file is read a block of whole lines at a time and every step works on
+    NumPy arrays of the block's lines and bytes, with no Python loop over lines. Understands v, vt, vn and f
+    records, faces given as v, v/vt, v//vn or v/vt/vn (negative indices too), fan triangulates polygons and skips
+    comments. Results are arrays: vert_coords (V,3), text_coords (T,2), norm_coords (N,3) and one row per triangle
+    of vertex_index/texture_index/normal_index (F,3), zero based with -1 where a face gave no index"""
+    def __init__(self):
+        self.vert_coords = np.zeros((0, 3))
+        self.text_coords = np.zeros((0, 2))
+        self.norm_coords = np.zeros((0, 3))
+
+        self.vertex_index = np.zeros((0, 3), dtype=np.int64)
+        self.texture_index = np.zeros((0, 3), dtype=np.int64)
+        self.normal_index = np.zeros((0, 3), dtype=np.int64)
+
+    def load_model(self, file, block_bytes=OBJ_BLOCK_BYTES):
+        names = ("vert_coords", "text_coords", "norm_coords", "vertex_index", "texture_index", "normal_index")
+        parts = {name: [getattr(self, name)] for name in names}
+        for arrays in self.blocks(file, block_bytes):
+            for name, array in zip(names, arrays):
+                parts[name].append(array)
+        for name in names:
+            setattr(self, name, np.concatenate(parts[name]))
+
+    def blocks(self, file, block_bytes=OBJ_BLOCK_BYTES):
+        """Parses the file a block of whole lines at a time, yielding each block's (vert_coords, text_coords,
+        norm_coords, vertex_index, texture_index, normal_index); face indices count every record before the block.
+        Only one block of the file is in memory at a time"""
+        defined = np.zeros(3, dtype=np.int64)  # v, vt and vn records so far
+        with open(file, "rb") as obj_file:
+            rest = b""
+            while True:
+                data = obj_file.read(block_bytes)
+                if not data:
+                    if rest:
+                        yield self._block(rest + b"\n", defined)
+                    return
+                data = rest + data
+                end = data.rfind(b"\n") + 1
+                rest = data[end:]
+                if end:
+                    yield self._block(data[:end], defined)
+
+    def _block(self, data, defined):
+        """Parses whole lines (data ends with a newline); defined counts the v, vt and vn records before them and
+        is updated"""
+        buf = np.frombuffer(data + b"  ", dtype=np.uint8)  # padded for look-ahead
+        ends = np.flatnonzero(buf == ord("\n"))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        hashes = np.flatnonzero(buf == ord("#"))
+        if hashes.size:
+            # Blank every comment up to the end of its line
+            marks = np.zeros(len(buf) + 1, dtype=np.int8)
+            comment_line = np.unique(np.searchsorted(ends, hashes))
+            marks[hashes[np.searchsorted(hashes, starts[comment_line])]] += 1
+            marks[ends[comment_line]] -= 1
+            buf = np.where(np.cumsum(marks[:-1], dtype=np.int8) > 0, np.uint8(ord(" ")), buf)
+        is_blank = (buf == ord(" ")) | (buf == ord("\t")) | (buf == ord("\r")) | (buf == ord("\n"))
+        token_start = ~is_blank & np.concatenate(([True], is_blank[:-1]))
+        tokens_in_line = np.add.reduceat(token_start, starts, dtype=np.int64)  # the padding has no tokens
+
+        # The first token of a line is its keyword
+        keyword_at = starts.copy()
+        indented = np.flatnonzero(is_blank[keyword_at] & (keyword_at < ends))
+        while indented.size:
+            keyword_at[indented] += 1
+            indented = indented[is_blank[keyword_at[indented]] & (keyword_at[indented] < ends[indented])]
+        line_kind = np.select(
+            [(buf[keyword_at] == ord("v")) & is_blank[keyword_at + 1],
+             (buf[keyword_at] == ord("v")) & (buf[keyword_at + 1] == ord("t")) & is_blank[keyword_at + 2],
+             (buf[keyword_at] == ord("v")) & (buf[keyword_at + 1] == ord("n")) & is_blank[keyword_at + 2],
+             (buf[keyword_at] == ord("f")) & is_blank[keyword_at + 1]],
+            [OBJ_VERT, OBJ_TEXT, OBJ_NORM, OBJ_FACE], 0).astype(np.int8)
+        del is_blank
+
+        line_bytes = ends - starts + 1
+        buf = buf[:len(data)]
+        lines_of_kind = lambda kind: buf[np.repeat(line_kind == kind, line_bytes)]
+        block = [self._records(lines_of_kind(kind), line_kind == kind, tokens_in_line, keyword, width)
+                 for kind, keyword, width in ((OBJ_VERT, b"v", 3), (OBJ_TEXT, b"vt", 2), (OBJ_NORM, b"vn", 3))]
+        block += self._faces(lines_of_kind(OBJ_FACE), line_kind, tokens_in_line, defined)
+        defined += [np.count_nonzero(line_kind == kind) for kind in (OBJ_VERT, OBJ_TEXT, OBJ_NORM)]
+        return block
+
+    @staticmethod
+    def _records(record_bytes, is_record, tokens_in_line, keyword, width):
+        """(lines, width) array of a record type's numbers, from the bytes of its lines; numbers a line doesn't
+        have stay 0, extra ones are dropped"""
+        lines = np.nonzero(is_record)[0]
+        values = np.zeros((len(lines), width))
+        if len(lines) == 0:
+            return values
+        numbers = np.fromstring(record_bytes.tobytes().replace(keyword, b" "), dtype=np.float64, sep=" ")
+        counts = tokens_in_line[lines] - 1
+        if (counts == counts[0]).all() and counts[0] >= width:
+            return numbers.reshape(len(lines), counts[0])[:, :width].copy()
+        row = np.repeat(np.arange(len(lines)), counts)
+        column = np.arange(len(numbers)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = column < width
+        values[row[keep], column[keep]] = numbers[keep]
+        return values
+
+    @staticmethod
+    def _faces(face_bytes, line_kind, tokens_in_line, defined):
+        """[vertex_index, texture_index, normal_index] of the triangles of the face lines, from their bytes"""
+        face_lines = np.nonzero(line_kind == OBJ_FACE)[0]
+        if len(face_lines) == 0:
+            return [np.zeros((0, 3), dtype=np.int64)] * 3
+        sizes = tokens_in_line[face_lines] - 1  # corners of each polygon
+
+        # Corner tokens in file order (every token of a face line but its keyword), with how many slashes (and
+        # empty fields, as in v//vn) each has
+        buf = np.concatenate((face_bytes, [ord(" ")]))
+        is_blank = (buf == ord(" ")) | (buf == ord("\t")) | (buf == ord("\r")) | (buf == ord("\n"))
+        token_starts = np.flatnonzero(~is_blank & np.concatenate(([True], is_blank[:-1])))
+        corner_starts = token_starts[buf[token_starts] != ord("f")]
+        slash_at = np.flatnonzero(buf == ord("/"))
+        double_at = slash_at[buf[slash_at + 1] == ord("/")]
+        corner_of = lambda positions: np.searchsorted(corner_starts, positions, side="right") - 1
+        slashes = np.bincount(corner_of(slash_at), minlength=len(corner_starts))
+        skips_text = np.bincount(corner_of(double_at), minlength=len(corner_starts)) > 0
+
+        numbers = np.fromstring(face_bytes.tobytes().replace(b"f", b" ").replace(b"/", b" "), dtype=np.int64,
+                                sep=" ")
+        field_counts = slashes + 1 - skips_text
+        first_field = np.cumsum(field_counts) - field_counts
+        last = len(numbers) - 1
+        # 0 marks a missing index (OBJ indices start at 1)
+        fields = [numbers[first_field],
+                  np.where((slashes >= 1) & ~skips_text, numbers[np.minimum(first_field + 1, last)], 0),
+                  np.where(slashes >= 2, numbers[np.minimum(first_field + 2 - skips_text, last)], 0)]
+
+        # Negative indices count back from the last element defined before the face (absolute indices are
+        # left as they are, so they can refer to records of other blocks)
+        before = [np.repeat(so_far + np.cumsum(line_kind == kind)[face_lines], sizes)
+                  for kind, so_far in zip((OBJ_VERT, OBJ_TEXT, OBJ_NORM), defined)]
+        fields = [np.where(field > 0, field - 1, np.where(field < 0, count + field, -1))
+                  for field, count in zip(fields, before)]
+
+        # Fan triangulation: corners (0, k + 1, k + 2) of each polygon
+        triangles = np.maximum(sizes - 2, 0)
+        first_corner = np.repeat(np.cumsum(sizes) - sizes, triangles)
+        k = np.arange(triangles.sum()) - np.repeat(np.cumsum(triangles) - triangles, triangles)
+        tri_corners = np.column_stack((first_corner, first_corner + k + 1, first_corner + k + 2))
+        return [field[tri_corners] for field in fields]
+
+
 def load_toon_link():
 
     # obj file should now be in main directory
     # os.chdir(r'Toon_Link/ssbb-toon-link_obj/source')
 
-    new_model = ObjLoader()
+    new_model = NumpyObjLoader()
     model_name = 'DolToonlinkR1_fixed'
     new_model.load_model(f"{model_name}.obj")
 
@@ -159,12 +317,85 @@ def load_toon_link():
     norm_coords = new_model.norm_coords
 
     model_triangles = []
-    for i in range(len(new_model.vertex_index)//3):
-        ptA, ptB, ptC = Vec3(coords[indices[i * 3]]), Vec3(coords[indices[i * 3 + 1]]), Vec3(coords[indices[i * 3 + 2]])
-        norm = Vec3(norm_coords[norm_inds[i * 3]])
+    for i in range(len(new_model.vertex_index)):
+        ptA, ptB, ptC = Vec3(coords[indices[i, 0]]), Vec3(coords[indices[i, 1]]), Vec3(coords[indices[i, 2]])
+        norm = Vec3(norm_coords[norm_inds[i, 0]])
         new_tri = Triangle(ptA, ptB, ptC, input_normal=-1*norm, parent=f"{model_name}")
         model_triangles.append(new_tri)
         # print(new_model.vert_coords[i])
     print(f"Number of triangles in {model_name} file: {len(model_triangles)}")
     # os.chdir(r'../../../')
     return model_triangles
+
+
+def load_toon_link_mesh():
+    """Same model as load_toon_link, but as one TriangleMesh instead of a Triangle per face"""
+    new_model = NumpyObjLoader()
+    model_name = 'DolToonlinkR1_fixed'
+    new_model.load_model(f"{model_name}.obj")
+
+    coords, indices = new_model.vert_coords, new_model.vertex_index
+    model_mesh = TriangleMesh(coords[indices[:, 0]], coords[indices[:, 1]], coords[indices[:, 2]],
+                              normals=-1 * new_model.norm_coords[new_model.normal_index[:, 0]], parent=f"{model_name}")
+    print(f"Number of triangles in {model_name} file: {len(model_mesh)}")
+    return model_mesh
+
+
+def load_toon_link_meshes(angles, placements, reflectiveness=0.0, bvh=None, link_mesh=None):
+    """Link as main.py sets it up: rotated by angles (degrees), then one copy per (scale, offset, color) placement,
+    all merged into one TriangleMesh; bvh = (leaf_size, method) also builds its flat BVH.
+    Takes only plain numbers, so the same arguments can key scene_cache.
+    link_mesh is a mesh load_toon_link_mesh already returned, to start from instead of parsing the .obj again
+    (it is left as it is)"""
+    if link_mesh is None:
+        with render_stats.stage("load"):
+            link_mesh = load_toon_link_mesh()
+    else:
+        link_mesh = link_mesh.copy()
+    trans_mat = transformations.compose_matrix(angles=[angle * pi / 180 for angle in angles])
+    transform_objects([link_mesh], transform_matrix=trans_mat)
+
+    meshes = []
+    with render_stats.stage("transform"):
+        for scale, offset, color in placements:
+            placed_mesh = link_mesh.copy()
+            placed_mesh.move(scale, Vec3(*offset))
+            placed_mesh.flip_normals()
+            placed_mesh.set_material(Vec3(*color), reflectiveness=reflectiveness, shininess=8.0)
+            meshes.append(placed_mesh)
+        print("Number of Tris = ", len(link_mesh))
+        link_meshes = TriangleMesh.merge(meshes)
+
+    if bvh is not None:
+        bounding_start_time = time.time()
+        leaf_size, method = bvh
+        link_meshes.build_bvh(leaf_size=leaf_size, method=method)
+        print(f"Time to put tris in flat BVH = {time.time()- bounding_start_time}")
+        render_stats.add_time("build", time.time() - bounding_start_time)
+    return link_meshes
+
+
+def load_toon_link_instances(angles, placements, reflectiveness=0.0, bvh=None, link_mesh=None):
+    """load_toon_link_meshes, but with every placement a MeshInstance of one shared mesh (one InstanceGroup),
+    so the faces and the BVH are only stored and built once however many Links there are"""
+    if link_mesh is None:
+        with render_stats.stage("load"):
+            link_mesh = load_toon_link_mesh()
+    else:
+        link_mesh = link_mesh.copy()
+    trans_mat = transformations.compose_matrix(angles=[angle * pi / 180 for angle in angles])
+    transform_objects([link_mesh], transform_matrix=trans_mat)
+    link_mesh.flip_normals()  # as load_toon_link_meshes does to each placed copy
+    print("Number of Tris = ", len(link_mesh))
+
+    if bvh is not None:
+        bounding_start_time = time.time()
+        leaf_size, method = bvh
+        link_mesh.build_bvh(leaf_size=leaf_size, method=method)
+        print(f"Time to put tris in flat BVH = {time.time()- bounding_start_time}")
+        render_stats.add_time("build", time.time() - bounding_start_time)
+    instances = [MeshInstance(link_mesh, transformations.compose_matrix(scale=(scale, scale, scale), translate=offset),
+                              input_color=Vec3(*color), reflectiveness=reflectiveness, shininess=8.0,
+                              parent=link_mesh.parent)
+                 for scale, offset, color in placements]
+    return InstanceGroup(instances)
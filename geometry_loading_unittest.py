@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from geometry_loading import ObjLoader, NumpyObjLoader
+
+FACE_FORMS_OBJ = """# every face index form
+v 0 0 0
+v 1 0 0
+v 1 1 0 1.0
+v 0 1 0
+vt 0 0
+vt 1 0
+vt 1 1
+vn 0 0 1
+f 1 2 3
+f 1/1 2/2 3/3 4/1
+f -4//1 -3//1 -2//1
+\tf 1/1/1 2/2/1 3/3/1
+v 5 5 5
+f -1 1 2
+"""
+
+
+class TestNumpyObjLoader(unittest.TestCase):
+
+    def test_face_forms(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "forms.obj")
+            with open(path, "w") as file:
+                file.write(FACE_FORMS_OBJ)
+            loader = NumpyObjLoader()
+            loader.load_model(path)
+        np.testing.assert_array_equal(loader.vert_coords[[2, 4]], [[1, 1, 0], [5, 5, 5]])
+        self.assertEqual(loader.text_coords.shape, (3, 2))
+        # The quad becomes two triangles
+        np.testing.assert_array_equal(loader.vertex_index, [[0, 1, 2], [0, 1, 2], [0, 2, 3], [0, 1, 2], [0, 1, 2],
+                                                            [4, 0, 1]])
+        np.testing.assert_array_equal(loader.texture_index[:5, 2], [-1, 2, 0, -1, 2])
+        np.testing.assert_array_equal(loader.normal_index[:, 0], [-1, -1, -1, 0, 0, -1])
+
+    def test_comments_and_blocks(self):
+        commented = FACE_FORMS_OBJ.replace("v 1 0 0\n", "v 1 0 0 # x axis\n").replace(
+            "f 1 2 3\n", "f 1 2 3#first\n# f 9 9 9\n")
+        loaders = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name, text, block_bytes in (("plain", FACE_FORMS_OBJ, 1 << 20), ("commented", commented, 16)):
+                path = os.path.join(temp_dir, f"{name}.obj")
+                with open(path, "w") as file:
+                    file.write(text.rstrip("\n"))
+                loaders.append(NumpyObjLoader())
+                loaders[-1].load_model(path, block_bytes=block_bytes)
+        for name in ("vert_coords", "text_coords", "norm_coords", "vertex_index", "texture_index", "normal_index"):
+            np.testing.assert_array_equal(getattr(loaders[1], name), getattr(loaders[0], name))
+        self.assertEqual(len(loaders[0].vertex_index), 6)
+
+    def test_matches_obj_loader(self):
+        old, new = ObjLoader(), NumpyObjLoader()
+        old.load_model("DolToonlinkR1_fixed.obj")
+        new.load_model("DolToonlinkR1_fixed.obj")
+        np.testing.assert_array_equal(new.vert_coords, np.array(old.vert_coords, dtype=np.float64))
+        np.testing.assert_array_equal(new.norm_coords, np.array(old.norm_coords, dtype=np.float64))
+        np.testing.assert_array_equal(new.vertex_index, np.reshape(old.vertex_index, (-1, 3)))
+        np.testing.assert_array_equal(new.normal_index, np.reshape(old.normal_index, (-1, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
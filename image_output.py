@@ -0,0 +1,165 @@
+import os
+import struct
+from abc import ABC, abstractmethod
+import zlib
+import numpy as np
+
+"""Frames too big to keep in memory twice: main.py fills an np.zeros frame and Image.fromarray copies all of it to
+save it. Here the frame can live in a file and the image is written a band of rows at a time instead.
+    framebuffer(height, width, path)    the frame as a memory-mapped .npy file (plain np.zeros without a path)
+    open_stream(path, width, height)    PNGStream or PPMStream, by the extension: write_rows() takes the next
+                                        rows from the top down, write_remaining() the rest of a finished frame,
+                                        and close() finishes the file
+    RowBands                            collects finished tiles and tells which rows can be written next
+    write_image(image_data, path)       writes a finished frame band by band
+Only one band of rows is copied at a time (to filter and compress it), so memory use doesn't grow with the image.
+Streams are written to path + ".part" and only renamed to path once complete."""
+
+ROWS_PER_BAND = 64
+IDAT_SIZE = 1 << 20  # bytes of compressed data per PNG IDAT chunk
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def framebuffer(height, width, path=None):
+    """A (height, width, 3) uint8 frame of zeros; memory-mapped from path (an .npy file, created or overwritten)
+    when one is given. Worker processes can open the same file with np.memmap(frame.filename, offset=frame.offset)"""
+    if path is None:
+        return np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+
+
+class ImageStream(ABC):
+    """Base of the streaming writers: checks the rows add up to the image and handles the .part file"""
+
+    def __init__(self, path, width, height):
+        self.path, self.width, self.height = path, width, height
+        self.rows_written = 0
+        self.file = open(path + ".part", "wb")
+        self._begin()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_rows(self, rows):
+        """Appends rows ((count, width, 3) uint8) below the ones already written"""
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.shape[1:] != (self.width, 3) or self.rows_written + len(rows) > self.height:
+            raise ValueError(f"{rows.shape} rows don't fit below row {self.rows_written} of a "
+                             f"{self.width}x{self.height} image")
+        self._write(rows.reshape(len(rows), self.width * 3))
+        self.rows_written += len(rows)
+
+    def write_remaining(self, image_data, rows_per_band=ROWS_PER_BAND):
+        """Writes the rows of image_data below the ones already written, rows_per_band at a time"""
+        for row_start in range(self.rows_written, self.height, rows_per_band):
+            self.write_rows(image_data[row_start:row_start + rows_per_band])
+
+    def close(self):
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written to {self.path}")
+        self._end()
+        self.file.close()
+        os.replace(self.path + ".part", self.path)
+
+    def abort(self):
+        """Stops writing and removes the partial file"""
+        self.file.close()
+        if os.path.exists(self.path + ".part"):
+            os.remove(self.path + ".part")
+
+    def _begin(self):
+        pass
+
+    @abstractmethod
+    def _write(self, rows):
+        """Writes rows, flattened to (count, width * 3)"""
+
+    def _end(self):
+        pass
+
+
+class PPMStream(ImageStream):
+    """Binary PPM (P6): a short header, then the raw RGB rows"""
+
+    def _begin(self):
+        self.file.write(f"P6\n{self.width} {self.height}\n255\n".encode())
+
+    def _write(self, rows):
+        self.file.write(rows.tobytes())
+
+
+class PNGStream(ImageStream):
+    """8-bit RGB PNG. Every row gets the Sub filter (each byte minus the same channel of the pixel to its left),
+    then all rows go through one zlib stream whose output is written as IDAT chunks"""
+
+    def __init__(self, path, width, height, compress_level=6):
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending = []
+        self.pending_size = 0
+        super().__init__(path, width, height)
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    def _begin(self):
+        self.file.write(PNG_SIGNATURE)
+        # 8 bits per channel, color type 2 (RGB), default compression and filtering, no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0))
+
+    def _write(self, rows):
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rows[:, :3]
+        np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])  # wraps around mod 256, as PNG wants
+        self._add(self.compressor.compress(filtered.tobytes()))
+
+    def _add(self, data, flush=False):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE or flush:
+            self._chunk(b"IDAT", b"".join(self.pending))
+            self.pending, self.pending_size = [], 0
+
+    def _end(self):
+        self._add(self.compressor.flush(), flush=True)
+        self._chunk(b"IEND", b"")
+
+
+STREAMS = {".png": PNGStream, ".ppm": PPMStream}
+
+
+def open_stream(path, width, height):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in STREAMS:
+        raise ValueError(f"Can't stream {path}: expected one of {', '.join(STREAMS)}")
+    return STREAMS[extension](path, width, height)
+
+
+class RowBands:
+    """Counts the finished pixels of every row of a width x height image, as tiles finish in any order.
+    finished() returns the rows (start, stop) that just became the next complete ones, so they can be streamed"""
+
+    def __init__(self, width, height):
+        self.pixels_left = np.full(height, width, dtype=np.int64)
+        self.next_row = 0
+
+    def finished(self, row_start, row_stop, col_start, col_stop):
+        self.pixels_left[row_start:row_stop] -= col_stop - col_start
+        start = self.next_row
+        pending = np.nonzero(self.pixels_left[start:])[0]
+        self.next_row = start + pending[0] if pending.size else len(self.pixels_left)
+        return start, self.next_row
+
+
+def write_image(image_data, path, rows_per_band=ROWS_PER_BAND):
+    """Writes a whole frame (e.g. a memory-mapped one) to a .png or .ppm, rows_per_band rows at a time"""
+    height, width = image_data.shape[:2]
+    with open_stream(path, width, height) as stream:
+        stream.write_remaining(image_data, rows_per_band)
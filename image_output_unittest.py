@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+import batch_trace
+from parallel_render import render_parallel
+from image_output import RowBands, framebuffer, open_stream, write_image
+from batch_trace_unittest import small_scene, render_args
+
+
+class TestImageOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def test_streams_read_back(self):
+        image = np.random.default_rng(3).integers(0, 256, (37, 53, 3), dtype=np.uint8)
+        image[10:20] = 7
+        for name in ("image.png", "image.ppm"):
+            write_image(image, self.path(name), rows_per_band=5)
+            np.testing.assert_array_equal(np.asarray(Image.open(self.path(name))), image)
+        with self.assertRaises(ValueError):
+            with open_stream(self.path("short.png"), 53, 37) as stream:
+                stream.write_rows(image[:10])
+        # The unfinished one is removed, not left behind as short.png.part
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ["image.png", "image.ppm"])
+
+    def test_row_bands(self):
+        bands = RowBands(10, 8)
+        self.assertEqual(bands.finished(4, 8, 0, 10), (0, 0))
+        self.assertEqual(bands.finished(0, 4, 0, 5), (0, 0))
+        self.assertEqual(bands.finished(0, 4, 5, 10), (0, 8))
+
+    def test_memmapped_parallel_render_streams(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        kwargs = render_args(size)
+        expected = batch_trace.render_batched(objects_list, lights_list, **kwargs)
+        frame = framebuffer(size, size, self.path("frame.npy"))
+        with open_stream(self.path("image.png"), size, size) as stream:
+            render_parallel(objects_list, lights_list, **kwargs, image_data=frame, workers=2, tile_size=5,
+                            row_writer=stream)
+            self.assertEqual(stream.rows_written, size)
+        np.testing.assert_array_equal(np.load(self.path("frame.npy")), expected)
+        np.testing.assert_array_equal(np.asarray(Image.open(self.path("image.png"))), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
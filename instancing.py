@@ -0,0 +1,289 @@
+import numpy as np
+from vector import from_floats
+from SceneObjects import TriangleMesh, MeshFace, triangle_hits, _dot
+from BHV_BBox import FlatBVH
+
+"""Mesh instancing: any number of copies of one TriangleMesh, each placed by its own 4x4 matrix.
+A MeshInstance holds only its matrix and a material table; rays are moved into the mesh's own space to be tested,
+so every instance shares the mesh's arrays and BVH. InstanceGroup puts a top-level FlatBVH over the instances'
+world boxes, so a crowd of hundreds of copies costs one mesh plus a few hundred matrices.
+Directions are moved into object space without normalizing them, so t (and nearest_hit_distance) mean the same
+distance in both spaces. Use meshes whose BVH was built before instancing them."""
+
+
+def _apply(matrix, vectors):
+    """matrix (3x3, or one per row) times vectors (..., 3), summed in a fixed order so the per-ray and batched
+    paths round the same way"""
+    return np.stack([vectors[..., 0] * matrix[..., row, 0] + vectors[..., 1] * matrix[..., row, 1] +
+                     vectors[..., 2] * matrix[..., row, 2] for row in range(3)], axis=-1)
+
+
+class _ObjectRay:
+    """A Ray moved into an instance's object space (direction not normalized); just what the mesh tests read"""
+    __slots__ = ("origin", "direction", "nearest_hit_distance", "initial_offset")
+
+    def __init__(self, origin, direction, nearest_hit_distance, initial_offset):
+        self.origin = origin
+        self.direction = direction
+        self.nearest_hit_distance = nearest_hit_distance
+        self.initial_offset = initial_offset
+
+
+class MeshInstance:
+    """mesh placed by transform_matrix (4x4, object to world) without copying the mesh. input_color,
+    reflectiveness and shininess replace every material of the mesh when given.
+    parent is what silhouettes compare; by default every instance is its own object"""
+
+    def __init__(self, mesh, transform_matrix, input_color=None, reflectiveness=None, shininess=None, parent=None):
+        self.mesh = mesh
+        self.matrix = np.array(transform_matrix, dtype=np.float64)
+        self.linear, self.translation = self.matrix[:3, :3].copy(), self.matrix[:3, 3].copy()
+        self.inverse = np.linalg.inv(self.linear)
+        self.normal_matrix = self.inverse.T.copy()  # normals move by the inverse transpose
+        materials = len(mesh.diffuse)
+        self.diffuse = mesh.diffuse.copy() if input_color is None else \
+            np.tile([input_color.x, input_color.y, input_color.z], (materials, 1)).astype(np.float64)
+        self.reflectiveness = mesh.reflectiveness.copy() if reflectiveness is None else \
+            np.full(materials, float(reflectiveness))
+        self.shininess = mesh.shininess.copy() if shininess is None else np.full(materials, float(shininess))
+        self.parent = self if parent is None else parent
+
+    def __len__(self):
+        return len(self.mesh)
+
+    def __repr__(self):
+        return f"MeshInstance of {self.mesh}"
+
+    def bounds(self):
+        """World space (min corner, max corner) of the mesh's box, moved by the matrix"""
+        low, high = self.mesh.bounds()
+        corners = np.array([[(low, high)[x][0], (low, high)[y][1], (low, high)[z][2]]
+                            for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+        corners = _apply(self.linear, corners) + self.translation
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def to_object(self, origins, directions):
+        """(N,3) world space rays in object space"""
+        return _apply(self.inverse, origins - self.translation), _apply(self.inverse, directions)
+
+    def world_normals(self, faces):
+        """Normalized world space normals of mesh faces (the zero normals of degenerate faces stay zero)"""
+        normals = _apply(self.normal_matrix, self.mesh.normals[faces])
+        length = np.sqrt(_dot(normals, normals))
+        return normals / np.where(length > 0, length, 1.0)[..., None]
+
+    def _object_ray(self, ray_to_test):
+        o, d = ray_to_test.origin, ray_to_test.direction
+        origin, direction = self.to_object(np.array([o.x, o.y, o.z]), np.array([d.x, d.y, d.z]))
+        return _ObjectRay(from_floats(*origin.tolist()), from_floats(*direction.tolist()),
+                          ray_to_test.nearest_hit_distance, ray_to_test.initial_offset)
+
+    def intersect(self, ray_to_test):
+        """Like TriangleMesh.intersect: the face hit (InstanceFace) or False"""
+        object_ray = self._object_ray(ray_to_test)
+        face = self.mesh.intersect(object_ray)
+        if face is False:
+            return False
+        ray_to_test.nearest_hit_distance = object_ray.nearest_hit_distance
+        return InstanceFace(self, face.index)
+
+    def occluded(self, ray_to_test):
+        return self.mesh.occluded(self._object_ray(ray_to_test))
+
+    def occluder(self, ray_to_test):
+        face = self.mesh.occluder(self._object_ray(ray_to_test))
+        return None if face is None else InstanceFace(self, face.index)
+
+    def intersect_face(self, index, ray_to_test):
+        object_ray = self._object_ray(ray_to_test)
+        if not self.mesh.intersect_face(index, object_ray):
+            return False
+        ray_to_test.nearest_hit_distance = object_ray.nearest_hit_distance
+        return True
+
+    def intersect_batch(self, origins, directions, t_max=None):
+        """TriangleMesh.intersect_batch for world space rays"""
+        return self.mesh.intersect_batch(*self.to_object(origins, directions), t_max=t_max)
+
+    def occluded_batch(self, origins, directions, t_max):
+        return self.mesh.occluded_batch(*self.to_object(origins, directions), t_max)
+
+    def occluder_batch(self, origins, directions, t_max):
+        return self.mesh.occluder_batch(*self.to_object(origins, directions), t_max)
+
+    def face_hits(self, faces, origins, directions, t_current):
+        """Tests ray i against face faces[i] only; returns (hit mask, t of hit)"""
+        origins, directions = self.to_object(origins, directions)
+        mesh = self.mesh
+        return triangle_hits(origins, directions, mesh.A[faces], mesh.edge_ab[faces], mesh.edge_ac[faces],
+                             mesh.normals[faces], t_current)
+
+
+class InstanceFace(MeshFace):
+    """A face of a MeshInstance, handed out as the object hit: the mesh's face, with the instance's
+    material, parent and world space normal"""
+    def __init__(self, instance, index):
+        super().__init__(instance.mesh, index)
+        self.instance = instance
+
+    @property
+    def parent(self):
+        return self.instance.parent
+
+    @property
+    def reflectiveness(self):
+        return float(self.instance.reflectiveness[self.mesh.material_ids[self.index]])
+
+    @property
+    def shininess(self):
+        return float(self.instance.shininess[self.mesh.material_ids[self.index]])
+
+    def get_color(self, point_hit=None):
+        return from_floats(*self.instance.diffuse[self.mesh.material_ids[self.index]].tolist())
+
+    def get_normal(self, pos=None):
+        return from_floats(*self.instance.world_normals(np.array([self.index]))[0].tolist())
+
+    def intersect(self, ray_to_test):
+        return self.instance.intersect_face(self.index, ray_to_test)
+
+    def __repr__(self):
+        return f"Face {self.index} of {self.instance}"
+
+
+class InstanceGroup:
+    """Top-level BVH over MeshInstances (one leaf per leaf_size instances); behaves like a TriangleMesh in
+    objects_list. Where two instances are hit at the same t, the later one in the list wins, as in
+    ray_intersection"""
+
+    def __init__(self, instances, leaf_size=1, method="sah"):
+        self.instances = list(instances)
+        bounds = [instance.bounds() for instance in self.instances]
+        self.bvh = FlatBVH(np.array([low for low, _ in bounds]), np.array([high for _, high in bounds]),
+                           leaf_size=leaf_size, method=method)
+        self._best_instance = -1
+
+    def __len__(self):
+        return len(self.instances)
+
+    def bounds(self):
+        return self.bvh.nodes["min"][0], self.bvh.nodes["max"][0]
+
+    def __repr__(self):
+        meshes = len({id(instance.mesh) for instance in self.instances})
+        return f"InstanceGroup: {len(self)} instances of {meshes} meshes"
+
+    def intersect(self, ray_to_test):
+        self._best_instance = -1
+        return self.bvh.intersect(ray_to_test, self._intersect_leaf)
+
+    def _intersect_leaf(self, first, count, ray_to_test):
+        best = None
+        for index in self.bvh.prim_indices[first:first + count].tolist():
+            nearest_hit_distance = ray_to_test.nearest_hit_distance
+            face = self.instances[index].intersect(ray_to_test)
+            if face is False:
+                continue
+            if ray_to_test.nearest_hit_distance == nearest_hit_distance and index < self._best_instance:
+                continue
+            self._best_instance, best = index, face
+        return best
+
+    def occluded(self, ray_to_test):
+        return self.occluder(ray_to_test) is not None
+
+    def occluder(self, ray_to_test):
+        return self.bvh.occluded(ray_to_test, self._occluder_leaf)
+
+    def _occluder_leaf(self, first, count, ray_to_test):
+        for index in self.bvh.prim_indices[first:first + count].tolist():
+            face = self.instances[index].occluder(ray_to_test)
+            if face is not None:
+                return face
+        return None
+
+    def intersect_batch(self, origins, directions, t_max=None):
+        """Returns (t of nearest hit, instance index or -1, face index or -1) per ray"""
+        t = np.full(len(origins), 1e20) if t_max is None else np.array(t_max, dtype=np.float64)
+        instance_hit = np.full(len(origins), -1, dtype=np.int64)
+        faces = np.full(len(origins), -1, dtype=np.int64)
+        # Instances in order, so an equal t from a later one replaces the earlier
+        for index, rays in self.bvh.primitive_rays(origins, directions, t):
+            t_rays, face_rays = self.instances[index].intersect_batch(origins[rays], directions[rays], t[rays])
+            hit = face_rays >= 0
+            rays = rays[hit]
+            t[rays], instance_hit[rays], faces[rays] = t_rays[hit], index, face_rays[hit]
+        return t, instance_hit, faces
+
+    def occluded_batch(self, origins, directions, t_max):
+        return self.occluder_batch(origins, directions, t_max)[0] >= 0
+
+    def occluder_batch(self, origins, directions, t_max):
+        """(instance index, face index) of something blocking the ray before t_max; -1 where nothing does"""
+        instance_hit = np.full(len(origins), -1, dtype=np.int64)
+        faces = np.full(len(origins), -1, dtype=np.int64)
+        for index, rays in self.bvh.primitive_rays(origins, directions, t_max):
+            rays = rays[instance_hit[rays] < 0]
+            if rays.size:
+                face_rays = self.instances[index].occluder_batch(origins[rays], directions[rays], t_max[rays])
+                hit = face_rays >= 0
+                instance_hit[rays[hit]], faces[rays[hit]] = index, face_rays[hit]
+        return instance_hit, faces
+
+    def face_hits(self, instances, faces, origins, directions, t_current):
+        """Tests ray i against face faces[i] of instance instances[i]; returns (hit mask, t of hit)"""
+        hit, t_hit = np.zeros(len(faces), dtype=bool), np.full(len(faces), 1e20)
+        for index in np.unique(instances).tolist():
+            rows = np.nonzero(instances == index)[0]
+            hit[rows], t_hit[rows] = self.instances[index].face_hits(faces[rows], origins[rows], directions[rows],
+                                                                     t_current[rows])
+        return hit, t_hit
+
+    def face_column(self, name, instances, faces):
+        """Per face values of BatchScene column name ("diffuse", "reflectiveness", "shininess" or "normal")
+        for faces of the given instances"""
+        values = np.empty((len(faces), 3) if name in ("diffuse", "normal") else len(faces))
+        for index in np.unique(instances).tolist():
+            rows = np.nonzero(instances == index)[0]
+            instance = self.instances[index]
+            if name == "normal":
+                values[rows] = instance.world_normals(faces[rows])
+            else:
+                values[rows] = getattr(instance, name)[instance.mesh.material_ids[faces[rows]]]
+        return values
+
+    def to_arrays(self):
+        """Every array of the group by name (each distinct mesh once), for from_arrays"""
+        meshes, mesh_index = {}, []
+        for instance in self.instances:
+            mesh_index.append(meshes.setdefault(id(instance.mesh), (len(meshes), instance.mesh))[0])
+        arrays = {"mesh_index": np.array(mesh_index, dtype=np.int64),
+                  "matrix": np.array([instance.matrix for instance in self.instances]),
+                  "bvh_nodes": self.bvh.nodes, "bvh_prim_indices": self.bvh.prim_indices}
+        for name in ("diffuse", "reflectiveness", "shininess"):
+            arrays[name] = np.concatenate([getattr(instance, name) for instance in self.instances])
+        for index, mesh in meshes.values():
+            arrays.update({f"mesh{index}_{name}": array for name, array in mesh.to_arrays().items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuilds a group from to_arrays output, sharing the mesh arrays (parents aren't kept)"""
+        meshes = {}
+        for index in np.unique(arrays["mesh_index"]).tolist():
+            prefix = f"mesh{index}_"
+            meshes[index] = TriangleMesh.from_arrays({name[len(prefix):]: array for name, array in arrays.items()
+                                                      if name.startswith(prefix)})
+        group = cls.__new__(cls)
+        group.instances, material_start = [], 0
+        for index, matrix in zip(arrays["mesh_index"].tolist(), arrays["matrix"]):
+            instance = MeshInstance(meshes[index], matrix)
+            materials = slice(material_start, material_start + len(instance.diffuse))
+            instance.diffuse = arrays["diffuse"][materials]
+            instance.reflectiveness = arrays["reflectiveness"][materials]
+            instance.shininess = arrays["shininess"][materials]
+            material_start = materials.stop
+            group.instances.append(instance)
+        group.bvh = FlatBVH.from_arrays(arrays["bvh_nodes"], arrays["bvh_prim_indices"])
+        group._best_instance = -1
+        return group
@@ -0,0 +1,72 @@
+import unittest
+import numpy as np
+import transformations
+from ray import Ray, ray_intersection
+from vector import Vec3
+from SceneObjects import PointLight
+from instancing import MeshInstance, InstanceFace, InstanceGroup
+from batch_trace import BatchScene, camera_rays
+from mesh_unittest import random_mesh
+
+
+class TestInstancing(unittest.TestCase):
+
+    def setUp(self):
+        self.mesh = random_mesh(200)
+        self.mesh.build_bvh(leaf_size=4)
+        self.instances = [MeshInstance(self.mesh, transformations.compose_matrix(
+            scale=(scale, scale, scale), angles=(0, angle, 0), translate=(offset, 0, 0)),
+            input_color=Vec3(200, 40, 40) if offset > 0 else None)
+            for scale, angle, offset in [(1.0, 0.0, -12.0), (0.5, 0.7, 0.0), (1.5, 2.0, 14.0)]]
+        self.group = InstanceGroup(self.instances)
+        rng = np.random.default_rng(5)
+        self.origins = np.tile([0.0, 0.0, -60.0], (300, 1))
+        directions = np.column_stack((rng.uniform(-0.5, 0.5, (300, 2)), np.ones(300)))
+        self.directions = directions / np.sqrt((directions ** 2).sum(axis=1))[:, None]
+
+    def test_matches_transformed_copies(self):
+        copies = []
+        for instance in self.instances:
+            copy = self.mesh.copy()
+            copy.transform(instance.matrix)
+            copies.append(copy)
+        t, instance_hit, faces = self.group.intersect_batch(self.origins, self.directions)
+        self.assertTrue((instance_hit >= 0).sum() > 20)
+        for origin, direction, t_hit, index, face in zip(self.origins, self.directions, t, instance_hit, faces):
+            copy_ray, group_ray = Ray(Vec3(origin), Vec3(direction)), Ray(Vec3(origin), Vec3(direction))
+            copy_ray.direction = group_ray.direction = Vec3(direction)
+            copy_hit = ray_intersection(copy_ray, copies)
+            group_hit = ray_intersection(group_ray, [self.group])
+            self.assertEqual(copy_hit is False, group_hit is False)
+            if group_hit is False:
+                self.assertEqual(index, -1)
+                continue
+            self.assertIsInstance(group_hit, InstanceFace)
+            self.assertIs(copy_hit.mesh, copies[self.instances.index(group_hit.instance)])
+            self.assertEqual(copy_hit.index, group_hit.index)
+            self.assertAlmostEqual(copy_ray.nearest_hit_distance, group_ray.nearest_hit_distance, places=6)
+            # The batched and per-ray paths agree exactly
+            self.assertEqual((index, face, t_hit), (self.instances.index(group_hit.instance), group_hit.index,
+                                                    group_ray.nearest_hit_distance))
+            normal, copy_normal = group_hit.get_normal(), copy_hit.get_normal()
+            np.testing.assert_allclose([normal.x, normal.y, normal.z], [copy_normal.x, copy_normal.y, copy_normal.z],
+                                       atol=1e-9)
+
+    def test_batch_scene_shares_the_mesh(self):
+        lights = [PointLight(position=Vec3(40, 40, -60), color=Vec3(255, 255, 255), intensity=1.0)]
+        scene = BatchScene([self.group], lights, Vec3(30, 30, 30))
+        self.assertEqual(scene.primitive_count, 0)  # no per-face rows for instances
+        origins, directions, keys = camera_rays(24, 24, Vec3(0, 0, -60))
+        t, prim = scene.intersect(origins, directions)
+        hit = prim >= 0
+        self.assertTrue(hit.any())
+        red = scene.column("diffuse", prim[hit])
+        self.assertTrue(((red == [200, 40, 40]).all(axis=1) | (red == self.mesh.diffuse[0]).all(axis=1)).all())
+        colors = scene.trace(origins, directions, keys, num_bounces=0, multiple=True, cel_shaded=True)
+        rebuilt = BatchScene.from_arrays(*scene.to_arrays())
+        np.testing.assert_array_equal(rebuilt.trace(origins, directions, keys, num_bounces=0, multiple=True,
+                                                    cel_shaded=True), colors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,543 @@
+import os
+from importlib.util import find_spec
+import numpy as np
+
+"""Optional compiled kernels for the batched tracer's innermost loops, over the same flat arrays:
+    mesh_intersect / mesh_occluder  closest-hit / any-hit walk of a TriangleMesh's FlatBVH, with the slab and
+                                    triangle tests of FlatBVH.intersect and TriangleMesh. Rays go down the tree
+                                    in packets (BHV_BBox.PACKET_SIZE consecutive rays, see ray_packets there)
+                                    and one at a time where a packet's directions are too far apart
+    triangle_hits                   SceneObjects.triangle_hits for one triangle per ray (or one for all rays)
+    sphere_hits                     batch_trace.sphere_hits
+    shade_light                     the diffuse and specular terms of one light in BatchScene.shade
+    raster_triangles                the triangle pass of raster_visibility.RasterVisibility.candidates
+They are compiled with numba when it is installed (pip install numba); otherwise the numpy code they replace is
+used. The arithmetic is done in the same order as the numpy code, so either backend renders the same image.
+The backend is picked at import (RAYTRACER_KERNELS=numpy|numba, default numba when installed) and can be switched
+with use(). numba is only imported once its kernels are asked for, so the numpy backend never loads it. Compiled
+kernels are cached next to this file, so only the first run pays for compiling them."""
+
+BACKENDS = ("numpy", "numba")
+backend = "numpy"
+INITIAL_OFFSET = 0.0001  # Ray.initial_offset
+numba_installed = find_spec("numba") is not None
+_uncompiled = []  # the @_jit functions not yet replaced by their compiled versions, callees first
+
+
+def use(name=None):
+    """Selects the kernels: "numba" (compiled) or "numpy" (the array code); None picks numba when it is installed.
+    Returns the backend now in use"""
+    global backend
+    if name is None:
+        name = "numba" if numba_installed else "numpy"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown kernel backend {name!r}, expected one of {BACKENDS}")
+    if name == "numba" and not numba_installed:
+        print("Warning: numba is not installed, using the numpy kernels")
+        name = "numpy"
+    if name == "numba":
+        _compile()
+    backend = name
+    return backend
+
+
+def _jit(function):
+    _uncompiled.append(function)
+    return function
+
+
+def _compile():
+    """Rebinds each @_jit function to its numba version. numba looks a kernel's callees up when it first compiles
+    it, which is after all of them have been rebound, so kernels call each other's compiled versions"""
+    if not _uncompiled:
+        return
+    from numba import njit
+    for function in _uncompiled:
+        # error_model="numpy": divisions by zero give inf/nan like the array code instead of raising
+        globals()[function.__name__] = njit(cache=True, nogil=True, error_model="numpy")(function)
+    _uncompiled.clear()
+
+
+@_jit
+def _box_entry(node_min, node_max, node, ox, oy, oz, ix, iy, iz):
+    """FlatBVH._entry_function for one node: (hit, distance the ray enters the box at)"""
+    if ix >= 0:
+        t_near, t_far = (node_min[node, 0] - ox) * ix, (node_max[node, 0] - ox) * ix
+    else:
+        t_near, t_far = (node_max[node, 0] - ox) * ix, (node_min[node, 0] - ox) * ix
+    if iy >= 0:
+        t_y_near, t_y_far = (node_min[node, 1] - oy) * iy, (node_max[node, 1] - oy) * iy
+    else:
+        t_y_near, t_y_far = (node_max[node, 1] - oy) * iy, (node_min[node, 1] - oy) * iy
+    if t_y_near > t_near:
+        t_near = t_y_near
+    if t_y_far < t_far:
+        t_far = t_y_far
+    if iz >= 0:
+        t_z_near, t_z_far = (node_min[node, 2] - oz) * iz, (node_max[node, 2] - oz) * iz
+    else:
+        t_z_near, t_z_far = (node_max[node, 2] - oz) * iz, (node_min[node, 2] - oz) * iz
+    if t_z_near > t_near:
+        t_near = t_z_near
+    if t_z_far < t_far:
+        t_far = t_z_far
+    return not (t_near > t_far or t_far < 0), t_near
+
+
+@_jit
+def _triangle_t(pt_a, edge_ab, edge_ac, normals, face, ox, oy, oz, g_, h_, i_, initial_offset, t_current):
+    """TriangleMesh._intersect_leaf for one face: t of the hit, or -1.0 if it misses"""
+    if normals[face, 0] * g_ + normals[face, 1] * h_ + normals[face, 2] * i_ > 0:
+        return -1.0
+    a_, b_, c_ = edge_ab[face, 0], edge_ab[face, 1], edge_ab[face, 2]
+    d_, e_, f_ = edge_ac[face, 0], edge_ac[face, 1], edge_ac[face, 2]
+    j_, k_, l_ = pt_a[face, 0] - ox, pt_a[face, 1] - oy, pt_a[face, 2] - oz
+    ei_min_hf = e_ * i_ - h_ * f_
+    gf_min_di = g_ * f_ - d_ * i_
+    dh_min_eg = d_ * h_ - e_ * g_
+    m_denominator = a_ * ei_min_hf + b_ * gf_min_di + c_ * dh_min_eg
+    if m_denominator == 0.0:
+        return -1.0
+    ak_min_jb = a_ * k_ - j_ * b_
+    jc_min_al = j_ * c_ - a_ * l_
+    bl_min_kc = b_ * l_ - k_ * c_
+    t_of_hit = -(f_ * ak_min_jb + e_ * jc_min_al + d_ * bl_min_kc) / m_denominator
+    if not initial_offset <= t_of_hit <= t_current:
+        return -1.0
+    gamma = (i_ * ak_min_jb + h_ * jc_min_al + g_ * bl_min_kc) / m_denominator
+    if not 0 <= gamma <= 1:
+        return -1.0
+    beta = (j_ * ei_min_hf + k_ * gf_min_di + l_ * dh_min_eg) / m_denominator
+    if not 0 <= beta <= 1 or not 0 <= 1 - gamma - beta <= 1:
+        return -1.0
+    return t_of_hit
+
+
+@_jit
+def _inverse(component):
+    return 1.0 / component if component != 0 else 1e300
+
+
+@_jit
+def _mesh_intersect(node_min, node_max, node_offset, node_count, pt_a, edge_ab, edge_ac, normals,
+                    origins, directions, t, faces, initial_offset):
+    box_tests, triangle_tests = 0, 0
+    # Never more nodes waiting than the tree has
+    stack_t = np.empty(len(node_count) + 1)
+    stack_node = np.empty(len(node_count) + 1, dtype=np.int64)
+    for ray in range(len(origins)):
+        ox, oy, oz = origins[ray, 0], origins[ray, 1], origins[ray, 2]
+        g_, h_, i_ = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+        ix, iy, iz = _inverse(g_), _inverse(h_), _inverse(i_)
+        nearest, best = t[ray], -1
+        box_tests += 1
+        hit, t_entry = _box_entry(node_min, node_max, 0, ox, oy, oz, ix, iy, iz)
+        if not hit:
+            continue
+        stack_t[0], stack_node[0], size = t_entry, 0, 1
+        while size > 0:
+            size -= 1
+            t_entry, node = stack_t[size], stack_node[size]
+            if t_entry > nearest:
+                continue
+            if node_count[node] > 0:
+                first = node_offset[node]
+                triangle_tests += node_count[node]
+                for face in range(first, first + node_count[node]):
+                    t_of_hit = _triangle_t(pt_a, edge_ab, edge_ac, normals, face, ox, oy, oz, g_, h_, i_,
+                                           initial_offset, nearest)
+                    if t_of_hit < 0 or (t_of_hit == nearest and face < best):
+                        continue
+                    nearest, best = t_of_hit, face
+                continue
+            left, right = node + 1, node_offset[node]
+            box_tests += 2
+            left_hit, left_entry = _box_entry(node_min, node_max, left, ox, oy, oz, ix, iy, iz)
+            right_hit, right_entry = _box_entry(node_min, node_max, right, ox, oy, oz, ix, iy, iz)
+            # Push the farther child first so the nearer one is popped next
+            if left_hit and right_hit:
+                if left_entry <= right_entry:
+                    stack_t[size], stack_node[size] = right_entry, right
+                    stack_t[size + 1], stack_node[size + 1] = left_entry, left
+                else:
+                    stack_t[size], stack_node[size] = left_entry, left
+                    stack_t[size + 1], stack_node[size + 1] = right_entry, right
+                size += 2
+            elif left_hit:
+                stack_t[size], stack_node[size] = left_entry, left
+                size += 1
+            elif right_hit:
+                stack_t[size], stack_node[size] = right_entry, right
+                size += 1
+        if best >= 0:
+            t[ray], faces[ray] = nearest, best
+    return box_tests, triangle_tests
+
+
+@_jit
+def _mesh_occluder(node_min, node_max, node_offset, node_count, pt_a, edge_ab, edge_ac, normals,
+                   origins, directions, t_max, faces, initial_offset):
+    box_tests, triangle_tests = 0, 0
+    stack = np.empty(len(node_count) + 1, dtype=np.int64)
+    for ray in range(len(origins)):
+        ox, oy, oz = origins[ray, 0], origins[ray, 1], origins[ray, 2]
+        g_, h_, i_ = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+        ix, iy, iz = _inverse(g_), _inverse(h_), _inverse(i_)
+        t_limit = t_max[ray]
+        stack[0], size = 0, 1
+        while size > 0 and faces[ray] < 0:
+            size -= 1
+            node = stack[size]
+            box_tests += 1
+            hit, t_entry = _box_entry(node_min, node_max, node, ox, oy, oz, ix, iy, iz)
+            if not hit or t_entry > t_limit:
+                continue
+            if node_count[node] > 0:
+                first = node_offset[node]
+                for face in range(first, first + node_count[node]):
+                    triangle_tests += 1
+                    if _triangle_t(pt_a, edge_ab, edge_ac, normals, face, ox, oy, oz, g_, h_, i_,
+                                   initial_offset, t_limit) >= 0:
+                        faces[ray] = face
+                        break
+                continue
+            stack[size], stack[size + 1] = node_offset[node], node + 1
+            size += 2
+    return box_tests, triangle_tests
+
+
+@_jit
+def _packet_bounds(origins, directions, t_max, first, last, spread, padding, inv, bounds):
+    """Puts 1/d of rays first to last - 1 in inv, and their ranges in bounds (rows: origin min, origin max,
+    1/d min, 1/d max, reach min, reach max). Returns whether they make a packet; see BHV_BBox.ray_packets"""
+    coherent = last - first > 1
+    for axis in range(3):
+        d_min, d_max = np.inf, -np.inf
+        bounds[0, axis], bounds[2, axis], bounds[4, axis] = np.inf, np.inf, np.inf
+        bounds[1, axis], bounds[3, axis], bounds[5, axis] = -np.inf, -np.inf, -np.inf
+        for ray in range(first, last):
+            component, origin = directions[ray, axis], origins[ray, axis]
+            end = origin + component * t_max[ray]
+            inverse = _inverse(component)
+            inv[ray - first, axis] = inverse
+            d_min, d_max = min(d_min, component), max(d_max, component)
+            bounds[0, axis], bounds[1, axis] = min(bounds[0, axis], origin), max(bounds[1, axis], origin)
+            bounds[2, axis], bounds[3, axis] = min(bounds[2, axis], inverse), max(bounds[3, axis], inverse)
+            bounds[4, axis] = min(bounds[4, axis], origin - padding, end - padding)
+            bounds[5, axis] = max(bounds[5, axis], origin + padding, end + padding)
+        if not (d_min >= 0 or d_max < 0) or d_max - d_min > spread:
+            coherent = False
+    return coherent
+
+
+@_jit
+def _packet_entry(node_min, node_max, node, bounds):
+    """BHV_BBox.packet_slab_entry and the reach test for one node: (whether any ray of the packet can hit it,
+    a t no ray enters it before)"""
+    t_near, t_far = -np.inf, np.inf
+    for axis in range(3):
+        if node_min[node, axis] > bounds[5, axis] or node_max[node, axis] < bounds[4, axis]:
+            return False, t_near
+        low_min, low_max = node_min[node, axis] - bounds[1, axis], node_min[node, axis] - bounds[0, axis]
+        high_min, high_max = node_max[node, axis] - bounds[1, axis], node_max[node, axis] - bounds[0, axis]
+        inv_min, inv_max = bounds[2, axis], bounds[3, axis]
+        corners = (low_min * inv_min, low_min * inv_max, low_max * inv_min, low_max * inv_max,
+                   high_min * inv_min, high_min * inv_max, high_max * inv_min, high_max * inv_max)
+        t_near, t_far = max(t_near, min(corners)), min(t_far, max(corners))
+    return not (t_near > t_far or t_far < 0), t_near
+
+
+@_jit
+def _mesh_intersect_packets(node_min, node_max, node_offset, node_count, pt_a, edge_ab, edge_ac, normals,
+                            origins, directions, t, faces, initial_offset, packet_size, spread, padding):
+    """_mesh_intersect by packets: interior nodes are tested once per packet, leaves once per ray of a packet
+    that reaches them. The nearest hit doesn't depend on the order leaves are visited in, so the results are the
+    same"""
+    box_tests, triangle_tests = 0, 0
+    stack_t = np.empty(len(node_count) + 1)
+    stack_node = np.empty(len(node_count) + 1, dtype=np.int64)
+    inv, bounds = np.empty((packet_size, 3)), np.empty((6, 3))
+    nearest, best = np.empty(packet_size), np.empty(packet_size, dtype=np.int64)
+    for first in range(0, len(origins), packet_size):
+        last = min(first + packet_size, len(origins))
+        if not _packet_bounds(origins, directions, t, first, last, spread, padding, inv, bounds):
+            ray_box_tests, ray_triangle_tests = _mesh_intersect(
+                node_min, node_max, node_offset, node_count, pt_a, edge_ab, edge_ac, normals, origins[first:last],
+                directions[first:last], t[first:last], faces[first:last], initial_offset)
+            box_tests, triangle_tests = box_tests + ray_box_tests, triangle_tests + ray_triangle_tests
+            continue
+        farthest = -np.inf  # the farthest nearest hit so far in the packet
+        for ray in range(first, last):
+            nearest[ray - first], best[ray - first] = t[ray], -1
+            farthest = max(farthest, t[ray])
+        box_tests += 1
+        hit, t_entry = _packet_entry(node_min, node_max, 0, bounds)
+        if not hit:
+            continue
+        stack_t[0], stack_node[0], size = t_entry, 0, 1
+        while size > 0:
+            size -= 1
+            t_entry, node = stack_t[size], stack_node[size]
+            if t_entry > farthest:
+                continue
+            if node_count[node] > 0:
+                start = node_offset[node]
+                farthest = -np.inf
+                for ray in range(first, last):
+                    slot = ray - first
+                    ox, oy, oz = origins[ray, 0], origins[ray, 1], origins[ray, 2]
+                    box_tests += 1
+                    hit, t_entry = _box_entry(node_min, node_max, node, ox, oy, oz, inv[slot, 0], inv[slot, 1],
+                                              inv[slot, 2])
+                    if hit and t_entry <= nearest[slot]:
+                        g_, h_, i_ = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+                        triangle_tests += node_count[node]
+                        for face in range(start, start + node_count[node]):
+                            t_of_hit = _triangle_t(pt_a, edge_ab, edge_ac, normals, face, ox, oy, oz, g_, h_, i_,
+                                                   initial_offset, nearest[slot])
+                            if t_of_hit < 0 or (t_of_hit == nearest[slot] and face < best[slot]):
+                                continue
+                            nearest[slot], best[slot] = t_of_hit, face
+                    farthest = max(farthest, nearest[slot])
+                continue
+            left, right = node + 1, node_offset[node]
+            box_tests += 2
+            left_hit, left_entry = _packet_entry(node_min, node_max, left, bounds)
+            right_hit, right_entry = _packet_entry(node_min, node_max, right, bounds)
+            if left_hit and right_hit:
+                if left_entry <= right_entry:
+                    stack_t[size], stack_node[size] = right_entry, right
+                    stack_t[size + 1], stack_node[size + 1] = left_entry, left
+                else:
+                    stack_t[size], stack_node[size] = left_entry, left
+                    stack_t[size + 1], stack_node[size + 1] = right_entry, right
+                size += 2
+            elif left_hit:
+                stack_t[size], stack_node[size] = left_entry, left
+                size += 1
+            elif right_hit:
+                stack_t[size], stack_node[size] = right_entry, right
+                size += 1
+        for ray in range(first, last):
+            if best[ray - first] >= 0:
+                t[ray], faces[ray] = nearest[ray - first], best[ray - first]
+    return box_tests, triangle_tests
+
+
+@_jit
+def _mesh_occluder_packets(node_min, node_max, node_offset, node_count, pt_a, edge_ab, edge_ac, normals,
+                           origins, directions, t_max, faces, initial_offset, packet_size, spread, padding):
+    """_mesh_occluder by packets, until every ray of the packet is blocked or the tree is done. Which face
+    blocks a ray can differ from _mesh_occluder's, whether one does can't"""
+    box_tests, triangle_tests = 0, 0
+    stack = np.empty(len(node_count) + 1, dtype=np.int64)
+    inv, bounds = np.empty((packet_size, 3)), np.empty((6, 3))
+    for first in range(0, len(origins), packet_size):
+        last = min(first + packet_size, len(origins))
+        if not _packet_bounds(origins, directions, t_max, first, last, spread, padding, inv, bounds):
+            ray_box_tests, ray_triangle_tests = _mesh_occluder(
+                node_min, node_max, node_offset, node_count, pt_a, edge_ab, edge_ac, normals, origins[first:last],
+                directions[first:last], t_max[first:last], faces[first:last], initial_offset)
+            box_tests, triangle_tests = box_tests + ray_box_tests, triangle_tests + ray_triangle_tests
+            continue
+        t_limit = -np.inf
+        for ray in range(first, last):
+            t_limit = max(t_limit, t_max[ray])
+        unblocked = last - first
+        stack[0], size = 0, 1
+        while size > 0 and unblocked > 0:
+            size -= 1
+            node = stack[size]
+            box_tests += 1
+            hit, t_entry = _packet_entry(node_min, node_max, node, bounds)
+            if not hit or t_entry > t_limit:
+                continue
+            if node_count[node] > 0:
+                start = node_offset[node]
+                for ray in range(first, last):
+                    if faces[ray] >= 0:
+                        continue
+                    slot = ray - first
+                    ox, oy, oz = origins[ray, 0], origins[ray, 1], origins[ray, 2]
+                    box_tests += 1
+                    hit, t_entry = _box_entry(node_min, node_max, node, ox, oy, oz, inv[slot, 0], inv[slot, 1],
+                                              inv[slot, 2])
+                    if not hit or t_entry > t_max[ray]:
+                        continue
+                    g_, h_, i_ = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+                    for face in range(start, start + node_count[node]):
+                        triangle_tests += 1
+                        if _triangle_t(pt_a, edge_ab, edge_ac, normals, face, ox, oy, oz, g_, h_, i_,
+                                       initial_offset, t_max[ray]) >= 0:
+                            faces[ray] = face
+                            unblocked -= 1
+                            break
+                continue
+            stack[size], stack[size + 1] = node_offset[node], node + 1
+            size += 2
+    return box_tests, triangle_tests
+
+
+def mesh_intersect(mesh, origins, directions, t, faces, initial_offset=INITIAL_OFFSET):
+    """TriangleMesh.intersect_batch for a mesh with a BVH: updates t and faces in place where a face is nearer.
+    Returns (box tests, triangle tests), a packet's test of a box counting as one"""
+    from BHV_BBox import PACKET_SIZE, PACKET_SPREAD, BOX_PADDING
+    arrays = (*mesh.bvh.node_fields(), mesh.A, mesh.edge_ab, mesh.edge_ac, mesh.normals,
+              np.ascontiguousarray(origins), np.ascontiguousarray(directions), t, faces, initial_offset)
+    if PACKET_SIZE <= 1:
+        return _mesh_intersect(*arrays)
+    return _mesh_intersect_packets(*arrays, PACKET_SIZE, PACKET_SPREAD, BOX_PADDING)
+
+
+def mesh_occluder(mesh, origins, directions, t_max, initial_offset=INITIAL_OFFSET):
+    """TriangleMesh.occluder_batch for a mesh with a BVH; returns (faces, box tests, triangle tests)"""
+    from BHV_BBox import PACKET_SIZE, PACKET_SPREAD, BOX_PADDING
+    faces = np.full(len(origins), -1, dtype=np.int64)
+    arrays = (*mesh.bvh.node_fields(), mesh.A, mesh.edge_ab, mesh.edge_ac, mesh.normals,
+              np.ascontiguousarray(origins), np.ascontiguousarray(directions),
+              np.ascontiguousarray(t_max, dtype=np.float64), faces, initial_offset)
+    if PACKET_SIZE <= 1:
+        box_tests, triangle_tests = _mesh_occluder(*arrays)
+    else:
+        box_tests, triangle_tests = _mesh_occluder_packets(*arrays, PACKET_SIZE, PACKET_SPREAD, BOX_PADDING)
+    return faces, box_tests, triangle_tests
+
+
+@_jit
+def _triangle_hits(origins, directions, pt_a, edge_ab, edge_ac, normal, t_current, initial_offset, hit, t_of_hit):
+    for ray in range(len(origins)):
+        a_, b_, c_ = edge_ab[ray, 0], edge_ab[ray, 1], edge_ab[ray, 2]
+        d_, e_, f_ = edge_ac[ray, 0], edge_ac[ray, 1], edge_ac[ray, 2]
+        g_, h_, i_ = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+        j_ = pt_a[ray, 0] - origins[ray, 0]
+        k_ = pt_a[ray, 1] - origins[ray, 1]
+        l_ = pt_a[ray, 2] - origins[ray, 2]
+        ei_min_hf = e_ * i_ - h_ * f_
+        gf_min_di = g_ * f_ - d_ * i_
+        dh_min_eg = d_ * h_ - e_ * g_
+        ak_min_jb = a_ * k_ - j_ * b_
+        jc_min_al = j_ * c_ - a_ * l_
+        bl_min_kc = b_ * l_ - k_ * c_
+        m_denominator = a_ * ei_min_hf + b_ * gf_min_di + c_ * dh_min_eg
+        t_of_hit[ray] = t = -(f_ * ak_min_jb + e_ * jc_min_al + d_ * bl_min_kc) / m_denominator
+        if not (normal[ray, 0] * g_ + normal[ray, 1] * h_ + normal[ray, 2] * i_ <= 0 and m_denominator != 0.0 and
+                initial_offset <= t <= t_current[ray]):
+            continue
+        gamma = (i_ * ak_min_jb + h_ * jc_min_al + g_ * bl_min_kc) / m_denominator
+        beta = (j_ * ei_min_hf + k_ * gf_min_di + l_ * dh_min_eg) / m_denominator
+        alpha = 1 - gamma - beta
+        hit[ray] = 0 <= gamma <= 1 and 0 <= beta <= 1 and 0 <= alpha <= 1
+
+
+def triangle_hits(origins, directions, pt_a, edge_ab, edge_ac, normal, t_current, initial_offset):
+    """SceneObjects.triangle_hits for (N,3) rays against one triangle each, or the same one for all"""
+    count = len(origins)
+    hit, t_of_hit = np.zeros(count, dtype=bool), np.empty(count)
+
+    def rows(array):
+        return np.broadcast_to(np.asarray(array, dtype=np.float64), (count, 3))
+    _triangle_hits(np.ascontiguousarray(origins), np.ascontiguousarray(directions), rows(pt_a), rows(edge_ab),
+                   rows(edge_ac), rows(normal), np.broadcast_to(np.asarray(t_current, dtype=np.float64), (count,)),
+                   initial_offset, hit, t_of_hit)
+    return hit, t_of_hit
+
+
+@_jit
+def _sphere_hits(origins, directions, center, radius, t_current, hit, t_of_hit):
+    for ray in range(len(origins)):
+        e_x = origins[ray, 0] - center[ray, 0]
+        e_y = origins[ray, 1] - center[ray, 1]
+        e_z = origins[ray, 2] - center[ray, 2]
+        d_x, d_y, d_z = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+        d_dot_e_min_c = d_x * e_x + d_y * e_y + d_z * e_z
+        d_dot_d = d_x * d_x + d_y * d_y + d_z * d_z
+        discriminant = d_dot_e_min_c * d_dot_e_min_c - d_dot_d * ((e_x * e_x + e_y * e_y + e_z * e_z) -
+                                                                  radius[ray] * radius[ray])
+        rest_of_equ = -d_dot_e_min_c / d_dot_d
+        sqrt_disc = np.sqrt(discriminant)
+        smaller_t = rest_of_equ - sqrt_disc
+        larger_t = rest_of_equ + sqrt_disc
+        t_of_hit[ray] = larger_t
+        if not discriminant >= 0:
+            continue
+        if discriminant < 0.0000001:
+            if rest_of_equ < t_current[ray]:
+                hit[ray], t_of_hit[ray] = True, rest_of_equ
+        elif INITIAL_OFFSET < smaller_t < t_current[ray]:
+            hit[ray], t_of_hit[ray] = True, smaller_t
+        elif INITIAL_OFFSET < larger_t < t_current[ray]:
+            hit[ray] = True
+
+
+def sphere_hits(origins, directions, center, radius, t_current):
+    """batch_trace.sphere_hits; center, radius and t_current may be one value for every ray"""
+    count = len(origins)
+    hit, t_of_hit = np.zeros(count, dtype=bool), np.empty(count)
+    _sphere_hits(np.ascontiguousarray(origins), np.ascontiguousarray(directions),
+                 np.broadcast_to(np.asarray(center, dtype=np.float64), (count, 3)),
+                 np.broadcast_to(np.asarray(radius, dtype=np.float64), (count,)),
+                 np.broadcast_to(np.asarray(t_current, dtype=np.float64), (count,)), hit, t_of_hit)
+    return hit, t_of_hit
+
+
+@_jit
+def _shade_light(colors, normals, e_vec, l_vec, shininess, intensity, light_color, diffuse, specular):
+    for point in range(len(colors)):
+        l_x, l_y, l_z = l_vec[point, 0], l_vec[point, 1], l_vec[point, 2]
+        n_x, n_y, n_z = normals[point, 0], normals[point, 1], normals[point, 2]
+        l_dot_n = l_x * n_x + l_y * n_y + l_z * n_z
+        # np.maximum(x, 0) keeps -0.0 and nan
+        lambert = l_dot_n if l_dot_n >= 0 or l_dot_n != l_dot_n else 0.0
+        for axis in range(3):
+            diffuse[point, axis] += colors[point, axis] * intensity * lambert
+        twice = 2 * l_dot_n
+        e_dot_r = (e_vec[point, 0] * (n_x * twice - l_x) + e_vec[point, 1] * (n_y * twice - l_y) +
+                   e_vec[point, 2] * (n_z * twice - l_z))
+        e_dot_r = e_dot_r if e_dot_r >= 0 or e_dot_r != e_dot_r else 0.0
+        highlight = e_dot_r ** shininess[point]
+        for axis in range(3):
+            specular[point, axis] += light_color[axis] * intensity * highlight
+
+
+def shade_light(colors, normals, e_vec, l_vec, shininess, intensity, light_color, diffuse, specular):
+    """Adds one light's diffuse and specular terms (BatchScene.shade) to diffuse and specular in place"""
+    _shade_light(colors, normals, e_vec, l_vec, np.ascontiguousarray(shininess, dtype=np.float64),
+                 float(intensity), np.ascontiguousarray(light_color, dtype=np.float64), diffuse, specular)
+
+
+@_jit
+def _raster_triangles(screen, cell_low, cell_high, plane, normals, pids, directions, points, rays, low, high,
+                      order, cell_starts, best_t, best):
+    columns = high[0] - low[0] + 1
+    for tri in range(len(screen)):
+        x_0, y_0 = screen[tri, 0, 0], screen[tri, 0, 1]
+        x_1, y_1 = screen[tri, 1, 0], screen[tri, 1, 1]
+        x_2, y_2 = screen[tri, 2, 0], screen[tri, 2, 1]
+        for y in range(max(cell_low[tri, 1], low[1]), min(cell_high[tri, 1], high[1]) + 1):
+            for x in range(max(cell_low[tri, 0], low[0]), min(cell_high[tri, 0], high[0]) + 1):
+                cell = (y - low[1]) * columns + x - low[0]
+                for slot in range(cell_starts[cell], cell_starts[cell + 1]):
+                    index = order[slot]
+                    p_x, p_y = points[index, 0], points[index, 1]
+                    edge_0 = (x_1 - x_0) * (p_y - y_0) - (y_1 - y_0) * (p_x - x_0)
+                    edge_1 = (x_2 - x_1) * (p_y - y_1) - (y_2 - y_1) * (p_x - x_1)
+                    edge_2 = (x_0 - x_2) * (p_y - y_2) - (y_0 - y_2) * (p_x - x_2)
+                    if not ((edge_0 >= 0 and edge_1 >= 0 and edge_2 >= 0) or
+                            (edge_0 <= 0 and edge_1 <= 0 and edge_2 <= 0)):
+                        continue
+                    ray = rays[index]
+                    t = plane[tri] / (normals[tri, 0] * directions[ray, 0] + normals[tri, 1] * directions[ray, 1] +
+                                      normals[tri, 2] * directions[ray, 2])
+                    if 0 < t < best_t[ray]:
+                        best_t[ray], best[ray] = t, pids[tri]
+
+
+def raster_triangles(screen, cell_low, cell_high, plane, normals, pids, directions, points, rays, low, high, order,
+                     cell_starts, best_t, best):
+    """Depth-tests every projected triangle against the rays whose image-plane points are in its cells, keeping
+    the nearest (t, primitive id) per ray in best_t and best"""
+    _raster_triangles(screen, cell_low, cell_high, plane, normals, pids, np.ascontiguousarray(directions), points,
+                      rays, low, high, order, cell_starts, best_t, best)
+
+
+use(os.environ.get("RAYTRACER_KERNELS") or None)
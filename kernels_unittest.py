@@ -0,0 +1,60 @@
+import unittest
+import numpy as np
+import kernels
+import batch_trace
+from vector import Vec3
+from batch_trace_unittest import small_scene
+from mesh_unittest import random_mesh
+
+
+@unittest.skipIf(not kernels.numba_installed, "numba is not installed")
+class TestKernels(unittest.TestCase):
+    """The compiled kernels against the numpy code they replace"""
+
+    def setUp(self):
+        self.backend = kernels.backend
+        rng = np.random.default_rng(9)
+        self.origins = np.tile([0.0, 0.0, -60.0], (400, 1)) + rng.uniform(-2, 2, (400, 3))
+        directions = np.column_stack((rng.uniform(-0.2, 0.2, (400, 2)), np.ones(400)))
+        directions[:20, 0] = 0.0  # axis-parallel rays take the 1e300 stand-in in the slab test
+        self.directions = directions / np.sqrt((directions ** 2).sum(axis=1))[:, None]
+
+    def tearDown(self):
+        kernels.use(self.backend)
+
+    def both(self, function):
+        results = []
+        for backend in kernels.BACKENDS:
+            kernels.use(backend)
+            results.append(function())
+        return results
+
+    def test_mesh(self):
+        mesh = random_mesh(500)
+        mesh.build_bvh(leaf_size=4)
+        t_max = np.full(len(self.origins), 70.0)
+        (numpy_t, numpy_faces), (numba_t, numba_faces) = self.both(
+            lambda: mesh.intersect_batch(self.origins, self.directions, t_max))
+        self.assertTrue((numpy_faces >= 0).sum() > 50)
+        np.testing.assert_array_equal(numba_faces, numpy_faces)
+        np.testing.assert_array_equal(numba_t, numpy_t)
+        numpy_blockers, numba_blockers = self.both(lambda: mesh.occluder_batch(self.origins, self.directions, t_max))
+        np.testing.assert_array_equal(numba_blockers >= 0, numpy_blockers >= 0)
+        self.assertTrue(mesh.occluded_batch(self.origins, self.directions, t_max)[numba_blockers >= 0].all())
+
+    def test_renders_match(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        for cel_shaded in (False, True):
+            numpy_image, numba_image = self.both(lambda: batch_trace.render_batched(
+                objects_list, lights_list, size, size, Vec3(0, 0, -size * 1.5), background_color=Vec3(30, 30, 30),
+                max_bounces=3, multiple=True, cel_shaded=cel_shaded))
+            np.testing.assert_array_equal(numba_image, numpy_image)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            kernels.use("gpu")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,24 @@ import numpy as np
 from PIL import Image
 from ray import *
 import datetime
+import os
 from SceneObjects import  PointLight
 from geometry_loading import *
 from cube import cube_load
 from math import trunc, pi, ceil
-from BHV_BBox import BoundingBox
+from BHV_BBox import BoundingBox, SceneBVH
 from copy import deepcopy
+from batch_trace import render_batched
+from parallel_render import render_parallel
+from progressive_render import render_progressive
+from gbuffer_render import render_gbuffer
+from adaptive_render import render_adaptive
+from scene_cache import cached_mesh, cache_key
+from occluder_cache import OccluderCache
+from mesh_store import store_mesh, open_store
+from image_output import framebuffer, open_stream
+import render_stats
+import kernels
 
 """Note: The coordinate system used dictates that clockwise triangles be used, not counterclockwise"""
 if __name__ == "__main__":
@@ -17,17 +29,46 @@ if __name__ == "__main__":
     is_silhouetted = True
     is_cel_shaded = True
 
+    # Rendering
+    is_batched = True  # trace whole rows of pixels at once with numpy instead of one Ray at a time
+    render_workers = None  # processes rendering tiles of the batched image (None = one per CPU, 1 = just this one)
+    is_progressive = False  # batched passes from every 8th pixel down to every pixel, writing previews as it goes
+    preview_name = "preview.png"  # .png, or anything else for raw RGB bytes
+    preview_interval = 5.0  # seconds between previews within a pass
+    uses_gbuffer_edges = False  # silhouettes from one ray per pixel and an image-space edge pass (one process)
+    adaptive_samples = None  # e.g. 8: antialias with up to this many samples, only where neighbouring pixels differ
+    kernel_backend = None  # "numba" (compiled, if installed) or "numpy" for the batched tracer; None = fastest there
+    uses_raster_primary = False  # what camera rays hit first by rasterizing (raster_visibility); pays with numpy
+
     # Objects
     is_link = True
+    uses_mesh = True  # load Link as one TriangleMesh (arrays, flat BVH) instead of a Triangle per face
+    uses_instancing = False  # both Links as MeshInstances of one shared mesh and BVH (not scene cached)
     uses_BBox = True
+    bvh_method = "sah"  # or "median" for the original sort-and-halve build
+    bvh_leaf_size = 4
+    uses_scene_cache = True  # keep the prepared Link mesh and BVH in scene_cache/ for the next run
+    mesh_store_dir = None  # e.g. "mesh_store": trace Link memory-mapped from a mesh_store here (batched only)
     model_reflectiveness = 0.0
     is_cube = True
     is_spheres_for_link = True
     is_spheres = True
     is_test_tris = False
+    uses_scene_bvh = True  # put every object above in one top-level BVH instead of testing each in turn
 
     # To save, or not to save?
     is_saved = True
+    collects_stats = False  # count box/triangle/sphere tests, shadow rays, ... and time each stage (render_stats)
+    stats_name = None  # also write the stats to this .json file
+    framebuffer_name = None  # e.g. "frame.npy": keep the frame in this memory-mapped file instead of in memory
+    streamed_name = None  # e.g. "poster.png" (or .ppm): write the image here band by band as rows finish, instead
+    # of the timestamped .png (batched renders stream while rendering; the others write it out once done)
+
+    if mesh_store_dir is not None and not is_batched:
+        raise ValueError("mesh_store_dir needs is_batched: a stored mesh is only traced batched")
+    if collects_stats:
+        render_stats.enable()
+    print(f"Using the {kernels.use(kernel_backend)} kernels")
 
     start_time = time.time()
 
@@ -35,15 +76,43 @@ if __name__ == "__main__":
     background_color = Vec3(30, 30, 30)
     eye_distance = height * 1.5
     viewing_angle = 30
-    image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    image_data = framebuffer(height, width, framebuffer_name)
     eye_location = Vec3(0, 0, -eye_distance)
 
     # Test Triangle
     tri_dist = width * 2
 
     objects_list = checkered_sph_only(size, viewing_angle=viewing_angle, reflectiveness=0.4)
-    if is_link:
-        tris_list = load_toon_link()  # from imported file
+    if is_link and uses_mesh:
+        # Everything that shapes the meshes is in here, since it is also the scene cache key
+        link_setup = {"angles": (15, 180, 0),
+                      # (scale, offset, color) of each Link; the second one is smaller, off to the side
+                      "placements": [(size / 35, (0 * size/4, 1.2 * -size / 3,  0 * -size / 5),
+                                      (67*1.2, 158*1.2, 78*1.2)),
+                                     (size / 50, (1.5 * size / 4, -size / 10, size / 4),
+                                      (67*1.4, 79*1.4, 140*1.4))],
+                      "reflectiveness": model_reflectiveness,
+                      "bvh": (bvh_leaf_size, bvh_method) if uses_BBox else None}
+        if uses_instancing:
+            link_meshes = load_toon_link_instances(**link_setup)
+        elif mesh_store_dir is not None:
+            store_path = os.path.join(mesh_store_dir, cache_key(["DolToonlinkR1_fixed.obj"], link_setup))
+            if not os.path.exists(store_path):
+                store_mesh(load_toon_link_meshes(**dict(link_setup, bvh=None)), store_path,
+                           leaf_size=bvh_leaf_size, method=bvh_method)
+            link_meshes = open_store(store_path)
+        elif uses_scene_cache:
+            link_meshes = cached_mesh(["DolToonlinkR1_fixed.obj"], link_setup,
+                                      lambda: load_toon_link_meshes(**link_setup))
+        else:
+            link_meshes = load_toon_link_meshes(**link_setup)
+        if link_meshes.bvh is not None:
+            print("Link: ", end="")
+            link_meshes.bvh.print_stats()
+        objects_list += [link_meshes]
+    elif is_link:
+        with render_stats.stage("load"):
+            tris_list = load_toon_link()  # from imported file
 
         trans_mat = transformations.compose_matrix(angles=(15*pi/180, 180*pi/180, 0))
         transform_objects(tris_list, transform_matrix=trans_mat)  # transformations.identity_matrix())
@@ -53,6 +122,7 @@ if __name__ == "__main__":
         second_link = deepcopy(tris_list)
 
         # Scale up and move ( and cull back-facing triangles)
+        transform_start_time = time.time()
         tri_offset = Vec3(0 * size/4, 1.2 * -size / 3,  0 * -size / 5)
 
         for tri in tris_list:
@@ -76,20 +146,22 @@ if __name__ == "__main__":
             tri.diffuse = Vec3(67, 79, 140)*1.4 # make brighter
             tri.reflectiveness = model_reflectiveness
             tri.shininess = 8.0
+        render_stats.add_time("transform", time.time() - transform_start_time)
 
         print("Number of Tris = ", len(tris_list))
         if uses_BBox:
             bounding_start_time = time.time()
-            BBox = BoundingBox(tris_list + second_link)
+            BBox = BoundingBox(tris_list + second_link, leaf_size=bvh_leaf_size, method=bvh_method)
             print(f"Time to put tris in bounding box = {time.time()- bounding_start_time}")
+            render_stats.add_time("build", time.time() - bounding_start_time)
             print("Link: ", end="")
-            BBox.get_depth()
-            print(f"Objects inside Link Box: {BBox.object_count}")
+            BBox.print_stats()
             objects_list += [BBox]
         else:
             objects_list += tris_list + second_link
     if is_cube:
-        cube = cube_load(reflectiveness=0.5)
+        with render_stats.stage("load"):
+            cube = cube_load(reflectiveness=0.5)
         # scale_mat = transformations.scale_matrix(size/5)
         rot_mat1 = transformations.compose_matrix(angles=(0, 0, -90 * pi / 180))
         rot_mat2 = transformations.compose_matrix(angles=(0, 65 * pi / 180, 0))
@@ -104,10 +176,11 @@ if __name__ == "__main__":
         #     print(tri)
 
         bounding_start_time = time.time()
-        BBox = BoundingBox(cube)
+        BBox = BoundingBox(cube, leaf_size=bvh_leaf_size, method=bvh_method)
         print(f"Time to put tris in bounding box = {time.time() - bounding_start_time}")
+        render_stats.add_time("build", time.time() - bounding_start_time)
         print("Cube: ", end="")
-        BBox.get_depth()
+        BBox.print_stats()
         objects_list += [BBox]
         # objects_list += cube  # after transformation
     if is_spheres_for_link:
@@ -135,41 +208,93 @@ if __name__ == "__main__":
         print(backwardsTri)
         objects_list += [BoundingBox([forwardsTri, backwardsTri])]
 
+    if uses_scene_bvh:
+        objects_list = [SceneBVH(objects_list)]
+
     lights_list = [PointLight(position=Vec3(size, size, -size * 1.5),
                               color=Vec3(255, 255, 255), intensity=1.0)]
 
     print(f"All object initialization took {time.time() - start_time} seconds")
     start_time = time.time()
 
-    for i in range(height):
-        for j in range(width):
-            sample_point = Vec3(-width / 2 + j + 0.5, height / 2 - i + 0.5, 0)
-            curr_ray = Ray(eye_location, Vec3(-width / 2 + j + 0.5, height / 2 - i + 0.5, 0) - eye_location)
-            color = ray_trace(objects_list, num_bounces=0, max_bounces=depth,
-                              background_color=background_color, list_of_lights=lights_list,
-                              multiple=is_silhouetted, ray_given=curr_ray, cel_shaded=is_cel_shaded)
-
-            image_data[i, j] = [color.x, color.y, color.z]
-            if i == 31:
-                if j == 31:
-                    print(end="")
-        # Show progress in console
-        if i % 10 == 0:
-            print("Finished with row", i, "after ", round(time.time() - start_time, 3), "seconds.")
-    print("Finished with entire image after ", round(time.time() - start_time, 3), "seconds.")
-
-    end_time = time.time()
-
-    image = Image.fromarray(image_data, "RGB")
-    print(end_time)
-    time_taken = end_time - start_time
-    print(f"Total Time: {time_taken}")
-    image.show()
-
-    if is_saved:
+    row_writer = open_stream(streamed_name, width, height) if streamed_name else None
+    try:
+        if is_batched and is_progressive:
+            render_progressive(objects_list, lights_list, width, height, eye_location,
+                               background_color=background_color, max_bounces=depth,
+                               multiple=is_silhouetted, cel_shaded=is_cel_shaded, image_data=image_data,
+                               preview_path=preview_name, preview_interval=preview_interval,
+                               rasterize=uses_raster_primary)
+        elif is_batched and adaptive_samples:
+            # Silhouettes come from the G-buffer here
+            render_adaptive(objects_list, lights_list, width, height, eye_location,
+                            background_color=background_color, max_bounces=depth, cel_shaded=is_cel_shaded,
+                            image_data=image_data, max_samples=adaptive_samples, silhouettes=is_silhouetted,
+                            rasterize=uses_raster_primary)
+        elif is_batched and is_silhouetted and uses_gbuffer_edges:
+            render_gbuffer(objects_list, lights_list, width, height, eye_location,
+                           background_color=background_color, max_bounces=depth,
+                           cel_shaded=is_cel_shaded, image_data=image_data, rasterize=uses_raster_primary)
+        elif is_batched and render_workers != 1:
+            render_parallel(objects_list, lights_list, width, height, eye_location,
+                            background_color=background_color, max_bounces=depth,
+                            multiple=is_silhouetted, cel_shaded=is_cel_shaded, image_data=image_data,
+                            workers=render_workers, row_writer=row_writer, rasterize=uses_raster_primary)
+        elif is_batched:
+            render_batched(objects_list, lights_list, width, height, eye_location,
+                           background_color=background_color, max_bounces=depth,
+                           multiple=is_silhouetted, cel_shaded=is_cel_shaded, image_data=image_data,
+                           row_writer=row_writer, rasterize=uses_raster_primary)
+        else:
+            shadow_cache = OccluderCache()
+            for i in range(height):
+                for j in range(width):
+                    sample_point = Vec3(-width / 2 + j + 0.5, height / 2 - i + 0.5, 0)
+                    curr_ray = Ray(eye_location, Vec3(-width / 2 + j + 0.5, height / 2 - i + 0.5, 0) - eye_location)
+                    color = ray_trace(objects_list, num_bounces=0, max_bounces=depth,
+                                      background_color=background_color, list_of_lights=lights_list,
+                                      multiple=is_silhouetted, ray_given=curr_ray, cel_shaded=is_cel_shaded,
+                                      shadow_cache=shadow_cache)
+
+                    image_data[i, j] = [color.x, color.y, color.z]
+                    if i == 31:
+                        if j == 31:
+                            print(end="")
+                # Show progress in console
+                if i % 10 == 0:
+                    print("Finished with row", i, "after ", round(time.time() - start_time, 3), "seconds.")
+        print("Finished with entire image after ", round(time.time() - start_time, 3), "seconds.")
+        render_stats.add_time("trace", time.time() - start_time)
+
+        end_time = time.time()
+
+        print(end_time)
+        time_taken = end_time - start_time
+        print(f"Total Time: {time_taken}")
+
+        if row_writer is not None:
+            # No Image.fromarray copy of the whole frame
+            with render_stats.stage("save"):
+                row_writer.write_remaining(image_data)
+                row_writer.close()
+            print(f"Saved {streamed_name}")
+        else:
+            image = Image.fromarray(image_data, "RGB")
+            image.show()
+    except BaseException:
+        if row_writer is not None:
+            row_writer.abort()  # no stale .part file
+        raise
+
+    if is_saved and row_writer is None:
         img_name = "Final picture Funnnn"  # input("What do you want to save this image as? ")
-        image.save(f"{img_name} - Bkgrnd = "
-                   f"{size}x{size} - depth {depth} - " +
-                   f"{datetime.datetime.now().strftime('%d-%m-%y__%H-%M-%S')} - {trunc(time_taken)}s.png")
+        with render_stats.stage("save"):
+            image.save(f"{img_name} - Bkgrnd = "
+                       f"{size}x{size} - depth {depth} - " +
+                       f"{datetime.datetime.now().strftime('%d-%m-%y__%H-%M-%S')} - {trunc(time_taken)}s.png")
                     # f"{trunc(background_color.x)}-{trunc(background_color.x)}-{trunc(background_color.x)} - "
 
+    if collects_stats:
+        render_stats.print_summary()
+        if stats_name is not None:
+            render_stats.save_json(stats_name)
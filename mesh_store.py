@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from SceneObjects import TriangleMesh, MESH_ARRAYS
+from BHV_BBox import FlatBVH, BVH_NODE
+from geometry_loading import NumpyObjLoader, OBJ_BLOCK_BYTES
+import render_stats
+
+"""Disk-backed TriangleMeshes, for meshes too big to build or hold in memory.
+A store is a directory of .npy files: the mesh's face arrays (TriangleMesh.to_arrays, edges and normals
+precomputed, as the traversals read them), its FlatBVH nodes, and the node fields split out as the batched
+traversals read them (FlatBVH.node_fields). open_store memory-maps all of them read only, so a render only reads in
+the pages it touches: the nodes near the root, and the faces and subtrees its rays actually reach. Nodes are depth
+first and faces in leaf order, so a subtree is one contiguous run of nodes over one contiguous run of faces, and
+untouched subtrees are never read in at all.
+
+write_store builds one from vertex and index arrays (themselves possibly memory-mapped) without ever holding the
+whole mesh: faces are cut into chunks of at most chunk_faces by median cuts, a BVH is built over each chunk and
+a top tree over the chunks, and each chunk's tree is spliced in under its leaf of the top tree.
+
+    python mesh_store.py model.obj model_store --leaf-size 4
+
+stores an .obj file (store_obj: parsed a block at a time into memory-mapped arrays, so the file's contents are never
+in memory whole either; write_store itself keeps one centroid per face in memory). BatchScene traces a stored mesh
+without copying its faces into its own columns. Stored meshes are only traced batched: the per-ray path would copy
+every face and node into Python tuples."""
+
+STORE_VERSION = 1
+CHUNK_FACES = 1 << 20  # faces whose BVH is built in memory at once
+NODE_FIELDS = ("node_min", "node_max", "node_offset", "node_count")
+
+
+def _chunks(centroids, chunk_faces):
+    """Face indices of chunks of at most chunk_faces faces: halves at the median of the widest axis of their
+    centroids until they fit. Each chunk's indices are in increasing order"""
+    chunks, stack = [], [np.arange(len(centroids))]
+    while stack:
+        indices = stack.pop()
+        if len(indices) <= chunk_faces:
+            chunks.append(np.sort(indices))
+            continue
+        points = centroids[indices]
+        axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+        half = len(indices) // 2
+        order = np.argpartition(points[:, axis], half)
+        stack += [indices[order[half:]], indices[order[:half]]]
+    return chunks
+
+
+def _create(directory, name, shape, dtype=np.float64):
+    return np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+
+
+def write_store(path, vertices, indices, normals=None, material_ids=None, materials=None, parent=None, leaf_size=4,
+                method="sah", chunk_faces=CHUNK_FACES):
+    """Stores the mesh of vertices (V,3) and faces indices (F,3) at path (a directory, replaced via a temporary
+    one, so readers never see half a store). normals (F,3) default to TriangleMesh.calc_normals, material_ids (F)
+    to 0; materials is (diffuse (M,3), reflectiveness (M), shininess (M)), by default one white material.
+    Returns the number of BVH nodes"""
+    start_time = time.time()
+    face_count = len(indices)
+    if materials is None:
+        materials = (np.array([[255.0, 255.0, 255.0]]), np.array([0.0]), np.array([8.0]))
+    parent_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".part-")
+    try:
+        # The faces' centroids decide the chunks; corners are read a chunk's worth at a time
+        centroids = np.empty((face_count, 3))
+        for start in range(0, face_count, chunk_faces):
+            corners = vertices[np.asarray(indices[start:start + chunk_faces])]
+            centroids[start:start + chunk_faces] = corners.sum(axis=1) / 3
+        chunks = _chunks(centroids, chunk_faces)
+        del centroids
+
+        # One BVH per chunk, kept in temporary files until the top tree tells where it goes
+        chunk_min, chunk_max, chunk_nodes = np.empty((len(chunks), 3)), np.empty((len(chunks), 3)), []
+        with render_stats.stage("build"):
+            for index, faces in enumerate(chunks):
+                corners = vertices[np.asarray(indices[faces])]
+                mesh = TriangleMesh(corners[:, 0], corners[:, 1], corners[:, 2],
+                                    normals=None if normals is None else normals[faces],
+                                    material_ids=None if material_ids is None else material_ids[faces])
+                mesh.build_bvh(leaf_size, method)
+                chunk_min[index], chunk_max[index] = mesh.bvh.nodes["min"][0], mesh.bvh.nodes["max"][0]
+                chunk_nodes.append(len(mesh.bvh.nodes))
+                np.save(os.path.join(temp_dir, f"chunk_{index}_nodes.npy"), mesh.bvh.nodes)
+                for name in ("A", "B", "C", "normals", "material_ids"):
+                    np.save(os.path.join(temp_dir, f"chunk_{index}_{name}.npy"), getattr(mesh, name))
+
+        # The chunks' trees replace the leaves of a tree over the chunks; the rest keeps its depth-first order
+        top = FlatBVH(chunk_min, chunk_max, leaf_size=1, method=method)
+        top_leaf = top.nodes["count"] > 0
+        sizes = np.ones(len(top.nodes), dtype=np.int64)
+        sizes[top_leaf] = np.array(chunk_nodes)[top.prim_indices[top.nodes["offset"][top_leaf]]]
+        new_index = np.cumsum(sizes) - sizes
+        node_count = int(sizes.sum())
+
+        nodes = _create(temp_dir, "bvh_nodes", (node_count,), BVH_NODE)
+        arrays = {name: _create(temp_dir, name, (face_count, 3)) for name in ("A", "B", "C", "edge_ab", "edge_ac",
+                                                                              "normals")}
+        arrays["material_ids"] = _create(temp_dir, "material_ids", (face_count,), np.int32)
+        face_base = 0
+        for top_index in range(len(top.nodes)):
+            start = new_index[top_index]
+            if not top_leaf[top_index]:
+                nodes[start] = top.nodes[top_index]
+                nodes["offset"][start] = new_index[top.nodes["offset"][top_index]]
+                continue
+            chunk = top.prim_indices[top.nodes["offset"][top_index]]
+            chunk_file = os.path.join(temp_dir, f"chunk_{chunk}_")
+            spliced = np.load(chunk_file + "nodes.npy")
+            leaves = spliced["count"] > 0
+            spliced["offset"] += np.where(leaves, face_base, start)
+            nodes[start:start + len(spliced)] = spliced
+            faces = slice(face_base, face_base + len(chunks[chunk]))
+            for name in ("A", "B", "C", "normals", "material_ids"):
+                arrays[name][faces] = np.load(chunk_file + f"{name}.npy")
+                os.remove(chunk_file + f"{name}.npy")
+            os.remove(chunk_file + "nodes.npy")
+            arrays["edge_ab"][faces] = arrays["A"][faces] - arrays["B"][faces]
+            arrays["edge_ac"][faces] = arrays["A"][faces] - arrays["C"][faces]
+            face_base += len(chunks[chunk])
+
+        for name, array in zip(("diffuse", "reflectiveness", "shininess"), materials):
+            np.save(os.path.join(temp_dir, f"{name}.npy"), np.asarray(array, dtype=np.float64))
+        prim_indices = _create(temp_dir, "bvh_prim_indices", (face_count,), np.int64)
+        prim_indices[:] = np.arange(face_count)
+        for name, field in zip(NODE_FIELDS, ("min", "max", "offset", "count")):
+            split = _create(temp_dir, name, nodes[field].shape, np.float64 if field in ("min", "max") else np.int64)
+            split[:] = nodes[field]
+            split.flush()
+        for array in [nodes, prim_indices] + list(arrays.values()):
+            array.flush()
+        del nodes, prim_indices, arrays
+        with open(os.path.join(temp_dir, "store.json"), "w") as file:
+            json.dump({"version": STORE_VERSION, "parent": parent, "faces": face_count, "nodes": node_count,
+                       "chunks": len(chunks), "leaf_size": leaf_size, "method": method}, file)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_dir, path)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    print(f"Stored {face_count} faces in {len(chunks)} chunks ({node_count} BVH nodes) at {path} in "
+          f"{time.time() - start_time}s")
+    return node_count
+
+
+def store_mesh(mesh, path, **kwargs):
+    """write_store for a TriangleMesh already in memory (its materials and normals kept)"""
+    vertices = np.stack((mesh.A, mesh.B, mesh.C), axis=1).reshape(-1, 3)
+    return write_store(path, vertices, np.arange(len(vertices)).reshape(-1, 3), normals=mesh.normals,
+                       material_ids=mesh.material_ids, materials=(mesh.diffuse, mesh.reflectiveness, mesh.shininess),
+                       parent=mesh.parent, **kwargs)
+
+
+def store_obj(obj_path, path, flip_normals=False, block_bytes=OBJ_BLOCK_BYTES, **kwargs):
+    """write_store for an .obj file, read with NumpyObjLoader.blocks into raw files next to the store and handed
+    to write_store memory-mapped. Faces take the normal of their first corner (as load_toon_link_mesh does) when
+    every face gives one, otherwise TriangleMesh.calc_normals; flip_normals negates them"""
+    parent_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".obj-")
+    dtypes = {"vertices": np.float64, "norm_coords": np.float64, "indices": np.int64, "normal_index": np.int64}
+    files = {name: os.path.join(temp_dir, f"{name}.raw") for name in dtypes}
+    try:
+        counts = dict.fromkeys(dtypes, 0)
+        every_face_has_normal = True
+        outputs = {name: open(files[name], "wb") for name in dtypes}
+        try:
+            for vertices, _, norm_coords, indices, _, normal_index in NumpyObjLoader().blocks(obj_path, block_bytes):
+                for name, array in zip(dtypes, (vertices, norm_coords, indices, normal_index)):
+                    outputs[name].write(np.ascontiguousarray(array, dtype=dtypes[name]).tobytes())
+                    counts[name] += len(array)
+                every_face_has_normal &= bool((normal_index[:, 0] >= 0).all())
+        finally:
+            for output in outputs.values():
+                output.close()
+        arrays = {name: np.memmap(files[name], mode="r", dtype=dtype, shape=(counts[name], 3))
+                  if counts[name] else np.zeros((0, 3), dtype=dtype) for name, dtype in dtypes.items()}
+
+        normals = None
+        file_normals = every_face_has_normal and counts["norm_coords"] > 0
+        if file_normals or flip_normals:
+            normals = np.memmap(os.path.join(temp_dir, "normals.raw"), mode="w+", dtype=np.float64,
+                                shape=(counts["indices"], 3))
+            for start in range(0, len(normals), CHUNK_FACES):
+                stop = min(start + CHUNK_FACES, len(normals))
+                if file_normals:
+                    normals[start:stop] = arrays["norm_coords"][arrays["normal_index"][start:stop, 0]]
+                else:
+                    corners = arrays["vertices"][arrays["indices"][start:stop]]
+                    normals[start:stop] = TriangleMesh(corners[:, 0], corners[:, 1], corners[:, 2]).normals
+                if flip_normals:
+                    normals[start:stop] *= -1
+        node_count = write_store(path, arrays["vertices"], arrays["indices"], normals=normals, **kwargs)
+        del arrays, normals
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return node_count
+
+
+def open_store(path):
+    """The TriangleMesh stored at path, every array memory-mapped read only (its store_path set to path)"""
+    with open(os.path.join(path, "store.json")) as file:
+        info = json.load(file)
+    if info.get("version") != STORE_VERSION:
+        raise ValueError(f"{path} is a version {info.get('version')} mesh store, expected {STORE_VERSION}")
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+              for name in MESH_ARRAYS + ("bvh_nodes", "bvh_prim_indices") + NODE_FIELDS}
+    mesh = TriangleMesh.from_arrays(arrays, parent=info["parent"])
+    mesh.bvh = FlatBVH.from_arrays(arrays["bvh_nodes"], arrays["bvh_prim_indices"],
+                                   node_fields=tuple(arrays[name] for name in NODE_FIELDS))
+    mesh.store_path = os.path.abspath(path)
+    return mesh
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Store an .obj file's faces and BVH for memory-mapped rendering")
+    parser.add_argument("obj")
+    parser.add_argument("store", help="directory to write (replaced if it exists)")
+    parser.add_argument("--leaf-size", type=int, default=4)
+    parser.add_argument("--method", default="sah", choices=("sah", "median"))
+    parser.add_argument("--chunk-faces", type=int, default=CHUNK_FACES)
+    parser.add_argument("--flip-normals", action="store_true")
+    args = parser.parse_args(argv)
+
+    store_obj(args.obj, args.store, flip_normals=args.flip_normals, leaf_size=args.leaf_size, method=args.method,
+              chunk_faces=args.chunk_faces)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import batch_trace
+from parallel_render import render_parallel
+from batch_trace_unittest import small_scene, render_args
+from mesh_unittest import random_mesh
+from mesh_store import open_store, store_mesh, store_obj
+from ray import Ray
+from vector import Vec3
+
+
+class TestMeshStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.mesh = random_mesh(400)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def stored(self, **kwargs):
+        path = os.path.join(self.temp_dir.name, "store")
+        store_mesh(self.mesh, path, **kwargs)
+        return open_store(path)
+
+    def test_one_chunk_is_build_bvh(self):
+        stored = self.stored(leaf_size=4)
+        self.mesh.build_bvh(leaf_size=4)
+        for name, array in self.mesh.to_arrays().items():
+            np.testing.assert_array_equal(stored.to_arrays()[name], array)
+        self.assertEqual(stored.parent, "Mesh")
+
+    def test_chunks_trace_the_same(self):
+        stored = self.stored(leaf_size=4, chunk_faces=50)
+        self.mesh.build_bvh(leaf_size=4)
+        self.assertEqual(len(stored.bvh.prim_indices), len(self.mesh))
+        rng = np.random.default_rng(5)
+        origins = np.tile([0.0, 0.0, -40.0], (2000, 1))
+        directions = np.column_stack((rng.uniform(-0.3, 0.3, (2000, 2)), np.ones(2000)))
+        t, faces = self.mesh.intersect_batch(origins, directions)
+        stored_t, stored_faces = stored.intersect_batch(origins, directions)
+        np.testing.assert_array_equal(stored_t, t)
+        np.testing.assert_array_equal(stored.A[stored_faces[faces >= 0]], self.mesh.A[faces[faces >= 0]])
+        t_max = np.full(len(origins), 45.0)
+        np.testing.assert_array_equal(stored.occluder_batch(origins, directions, t_max) >= 0,
+                                      self.mesh.occluder_batch(origins, directions, t_max) >= 0)
+
+    def test_obj_store_matches_store_mesh(self):
+        obj_path = os.path.join(self.temp_dir.name, "mesh.obj")
+        corners = np.stack((self.mesh.A, self.mesh.B, self.mesh.C), axis=1).tolist()
+        with open(obj_path, "w") as file:
+            for face, normal in zip(corners, self.mesh.normals.tolist()):
+                file.write("".join(f"v {x!r} {y!r} {z!r}\n" for x, y, z in face))
+                file.write(f"vn {normal[0]!r} {normal[1]!r} {normal[2]!r}  # of the face below\n")
+                file.write("f -3//-1 -2//-1 -1//-1\n")
+        from_obj = os.path.join(self.temp_dir.name, "from_obj")
+        store_obj(obj_path, from_obj, block_bytes=1000, leaf_size=4, chunk_faces=100)
+        stored = self.stored(leaf_size=4, chunk_faces=100)
+        for name, array in open_store(from_obj).to_arrays().items():
+            np.testing.assert_array_equal(array, stored.to_arrays()[name])
+
+    def test_renders_without_rows(self):
+        size = 16
+        objects_list, lights_list = small_scene(size)
+        stored = self.stored(leaf_size=4, chunk_faces=100)
+        self.mesh.build_bvh(leaf_size=4)
+        scene = batch_trace.BatchScene(objects_list + [stored], lights_list)
+        self.assertEqual(scene.primitive_count, batch_trace.BatchScene(objects_list, lights_list).primitive_count)
+        kwargs = render_args(size)
+        expected = batch_trace.render_batched(objects_list + [self.mesh], lights_list, **kwargs)
+        self.assertTrue((expected != batch_trace.render_batched(objects_list, lights_list, **kwargs)).any())
+        np.testing.assert_array_equal(batch_trace.render_batched(objects_list + [stored], lights_list, **kwargs),
+                                      expected)
+        np.testing.assert_array_equal(render_parallel(objects_list + [stored], lights_list, **kwargs, workers=2,
+                                                      tile_size=5), expected)
+
+    def test_not_traced_per_ray(self):
+        stored = self.stored(leaf_size=4)
+        ray = Ray(Vec3(0, 0, -40), Vec3(0, 0, 1))
+        for trace in (stored.intersect, stored.occluder):
+            with self.assertRaises(ValueError):
+                trace(ray)
+        self.assertIsNone(stored.bvh._node_list)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+from ray import Ray, ray_intersection
+from vector import Vec3
+from SceneObjects import Triangle, TriangleMesh, MeshFace
+
+
+def random_mesh(count, seed=3):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, 10, (count, 3))
+    pt_a, pt_b, pt_c = (centers + rng.uniform(-2, 2, (count, 3)) for _ in range(3))
+    return TriangleMesh(pt_a, pt_b, pt_c, parent="Mesh")
+
+
+class TestTriangleMesh(unittest.TestCase):
+
+    def setUp(self):
+        self.mesh = random_mesh(200)
+        self.triangles = [Triangle(Vec3(a), Vec3(b), Vec3(c), input_normal=Vec3(n))
+                          for a, b, c, n in zip(self.mesh.A, self.mesh.B, self.mesh.C, self.mesh.normals)]
+        rng = np.random.default_rng(5)
+        self.origins = np.tile([0.0, 0.0, -40.0], (300, 1))
+        directions = np.column_stack((rng.uniform(-0.3, 0.3, (300, 2)), np.ones(300)))
+        # Normalized the way Ray does it, so single and batched rays are identical
+        rays = [Ray(Vec3(0, 0, -40), Vec3(direction)) for direction in directions]
+        self.directions = np.array([(r.direction.x, r.direction.y, r.direction.z) for r in rays])
+
+    def test_normals_match_triangle(self):
+        for tri, normal in zip(self.triangles[:10], self.mesh.normals):
+            tri.calc_normal()
+            np.testing.assert_allclose([tri.normal.x, tri.normal.y, tri.normal.z], normal)
+
+    def test_intersect_matches_triangle_list(self):
+        for origin, direction in zip(self.origins, self.directions):
+            tri_ray, mesh_ray = Ray(Vec3(origin), Vec3(direction)), Ray(Vec3(origin), Vec3(direction))
+            tri_hit = ray_intersection(tri_ray, self.triangles)
+            mesh_hit = ray_intersection(mesh_ray, [self.mesh])
+            if tri_hit is False:
+                self.assertIs(mesh_hit, False)
+                continue
+            self.assertIsInstance(mesh_hit, MeshFace)
+            self.assertIs(self.triangles[mesh_hit.index], tri_hit)
+            self.assertEqual(tri_ray.nearest_hit_distance, mesh_ray.nearest_hit_distance)
+
+    def test_batch_matches_single_rays(self):
+        t, faces = self.mesh.intersect_batch(self.origins, self.directions, max_tests=1000)
+        self.assertTrue((faces >= 0).any())
+        for origin, direction, t_hit, face in zip(self.origins, self.directions, t, faces):
+            mesh_ray = Ray(Vec3(origin), Vec3(direction))
+            mesh_ray.direction = Vec3(direction)  # skip normalizing twice
+            mesh_hit = self.mesh.intersect(mesh_ray)
+            self.assertEqual(face, -1 if mesh_hit is False else mesh_hit.index)
+            self.assertEqual(t_hit, mesh_ray.nearest_hit_distance)
+
+    def test_merge_keeps_materials(self):
+        other = random_mesh(5, seed=4)
+        other.set_material(Vec3(10, 20, 30), reflectiveness=0.5)
+        merged = TriangleMesh.merge([self.mesh, other])
+        self.assertEqual(len(merged), 205)
+        self.assertEqual(merged.face(204).reflectiveness, 0.5)
+        self.assertEqual(merged.face(0).get_color().x, 255)
+
+
+if __name__ == '__main__':
+    unittest.main()
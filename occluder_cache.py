@@ -0,0 +1,44 @@
+import render_stats
+
+"""Shadow-ray occluder caches.
+Neighbouring points almost always have their shadow ray toward a light blocked by the same object, so the object
+that blocked the last one is tested first, and the full scene query only runs when it no longer blocks.
+Whether a shadow ray is blocked doesn't depend on the order things are tested in, so the image never changes.
+ray.shade keeps the last blocker (a Triangle, Sphere or mesh face) per light in the cache ray_trace is given, one
+per render, since a blocker only means something for the objects it was found among;
+BatchScene.shade keeps the primitive ids that blocked the most rays of the last batch, per light, in
+scene.occluder_cache. Every BatchScene has its own, so each parallel_render worker process does too.
+tests counts the shadow rays checked against a cached blocker and hits the ones it blocked; with render_stats
+enabled, they are counted there too (occluder_cache_tests, occluder_cache_hits)."""
+
+BATCH_BLOCKERS = 4  # primitive ids kept per light by BatchScene
+
+
+class OccluderCache:
+    def __init__(self):
+        self.blockers = {}  # light -> what blocked its last shadow ray(s)
+        self.tests = 0
+        self.hits = 0
+
+    def __repr__(self):
+        return f"OccluderCache: {self.hits:,} of {self.tests:,} shadow rays blocked by a cached blocker " \
+               f"({self.hit_rate():.1%})"
+
+    def clear(self):
+        """Forgets the blockers (e.g. when the scene changes), keeping the counts"""
+        self.blockers.clear()
+
+    def reset(self):
+        self.blockers.clear()
+        self.tests = 0
+        self.hits = 0
+
+    def hit_rate(self):
+        return self.hits / self.tests if self.tests else 0.0
+
+    def record(self, tests, hits):
+        self.tests += tests
+        self.hits += hits
+        if render_stats.enabled:
+            render_stats.count("occluder_cache_tests", tests)
+            render_stats.count("occluder_cache_hits", hits)
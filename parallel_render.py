@@ -0,0 +1,132 @@
+import os
+import time
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from vector import Vec3
+from batch_trace import BatchScene, camera_rays
+from image_output import RowBands
+from raster_visibility import RasterVisibility
+import kernels
+
+"""Multi-process version of batch_trace.render_batched.
+The image is cut into tiles that a process pool renders as workers free up. The scene's arrays and the
+framebuffer live in shared memory, so workers get views of them instead of pickled copies of every object;
+a framebuffer that is already a memory-mapped file (image_output.framebuffer) is mapped by the workers instead.
+Jitter is keyed on the pixel, so the image is the same as render_batched's for any worker count or tile size."""
+
+ALIGNMENT = 64  # bytes; keeps every array in the block aligned
+
+
+class SharedArrays:
+    """Named arrays copied into one shared memory block. Pass name and layout to another process and
+    SharedArrays.attach gives it views of the same memory"""
+
+    def __init__(self, arrays):
+        self.layout, size = {}, 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            self.layout[name] = (size, array.dtype, array.shape)
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self.shm.name
+        self.arrays = self._views(self.shm, self.layout)
+        for name, array in arrays.items():
+            self.arrays[name][...] = array
+
+    @staticmethod
+    def _views(shm, layout):
+        return {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+                for name, (offset, dtype, shape) in layout.items()}
+
+    @staticmethod
+    def attach(name, layout):
+        """(shared memory handle, arrays) in another process; keep the handle alive while using the arrays"""
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, SharedArrays._views(shm, layout)
+
+    def release(self):
+        """Frees the block; only the process that created it should call this"""
+        self.arrays = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Per worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(scene_name, scene_layout, array_layout, frame, render_args, kernel_backend):
+    """frame: (name, layout) of the SharedArrays, or (filename, offset, shape) of a memory-mapped framebuffer"""
+    kernels.use(kernel_backend)
+    scene_shm, scene_arrays = SharedArrays.attach(scene_name, array_layout)
+    if len(frame) == 3:
+        filename, offset, shape = frame
+        frame_shm, image = None, np.memmap(filename, dtype=np.uint8, mode="r+", offset=offset, shape=shape)
+    else:
+        frame_shm, frame_arrays = SharedArrays.attach(*frame)
+        image = frame_arrays["image"]
+    scene = BatchScene.from_arrays(scene_arrays, scene_layout)
+    eye, rasterize = render_args[2], render_args[-1]
+    primary = RasterVisibility(scene, Vec3(*eye)) if rasterize else None
+    _worker.update(scene=scene, primary=primary, image=image, handles=(scene_shm, frame_shm), args=render_args)
+
+
+def _render_tile(tile):
+    row_start, row_stop, col_start, col_stop = tile
+    width, height, eye, max_bounces, multiple, cel_shaded, seed, _ = _worker["args"]
+    origins, directions, keys = camera_rays(width, height, Vec3(*eye), row_start, row_stop, seed, col_start, col_stop)
+    colors = _worker["scene"].trace(origins, directions, keys, num_bounces=0, max_bounces=max_bounces,
+                                    multiple=multiple, cel_shaded=cel_shaded, primary=_worker["primary"])
+    _worker["image"][row_start:row_stop, col_start:col_stop] = \
+        colors.reshape(row_stop - row_start, col_stop - col_start, 3).astype(np.uint8)
+    return tile
+
+
+def image_tiles(width, height, tile_size):
+    """(row_start, row_stop, col_start, col_stop) of every tile, row by row"""
+    return [(row, min(row + tile_size, height), col, min(col + tile_size, width))
+            for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+
+def render_parallel(objects_list, lights_list, width, height, eye_location, background_color=Vec3(0, 0, 0),
+                    max_bounces=1, multiple=False, cel_shaded=False, image_data=None, workers=None, tile_size=32,
+                    seed=0, row_writer=None, rasterize=False):
+    """Same arguments and result as render_batched, rendered by workers processes (None = one per CPU).
+    Rows go to row_writer as soon as every tile they're in is finished"""
+    if image_data is None:
+        image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    workers = os.cpu_count() if workers is None else max(int(workers), 1)
+    scene_arrays, scene_layout = BatchScene(objects_list, lights_list, background_color).to_arrays()
+    tiles = image_tiles(width, height, tile_size)
+
+    start_time = time.time()
+    scene_shared = SharedArrays(scene_arrays)
+    memmapped = isinstance(image_data, np.memmap)
+    frame_shared = None if memmapped else SharedArrays({"image": image_data})
+    frame = (image_data.filename, image_data.offset, image_data.shape) if memmapped else \
+        (frame_shared.name, frame_shared.layout)
+    frame_view = image_data if memmapped else frame_shared.arrays["image"]
+    bands = RowBands(width, height)
+    try:
+        render_args = (width, height, (eye_location.x, eye_location.y, eye_location.z), max_bounces, multiple,
+                       cel_shaded, seed, rasterize)
+        with Pool(workers, initializer=_init_worker,
+                  initargs=(scene_shared.name, scene_layout, scene_shared.layout, frame, render_args,
+                            kernels.backend)) as pool:
+            # chunksize 1: a worker takes the next tile as soon as it finishes one
+            for done, tile in enumerate(pool.imap_unordered(_render_tile, tiles, chunksize=1), start=1):
+                row_start, row_stop = bands.finished(*tile)
+                if row_writer is not None and row_stop > row_start:
+                    row_writer.write_rows(frame_view[row_start:row_stop])
+                if done % max(len(tiles) // 10, 1) == 0 or done == len(tiles):
+                    print(f"Finished {done} of {len(tiles)} tiles after ", round(time.time() - start_time, 3),
+                          "seconds.")
+        if memmapped:
+            image_data.flush()
+        else:
+            image_data[...] = frame_shared.arrays["image"]
+    finally:
+        scene_shared.release()
+        if frame_shared is not None:
+            frame_shared.release()
+    return image_data
@@ -0,0 +1,86 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from vector import Vec3
+from batch_trace import BatchScene, pixel_rays
+from raster_visibility import RasterVisibility
+
+"""Progressive version of batch_trace.render_batched.
+A coarse pass renders every 8th pixel of every 8th row, then each pass fills in the pixels of a finer grid.
+Between passes the partial image is upsampled (each missing pixel copies the nearest rendered one above-left of it)
+and written out as a preview, so a bad render can be stopped after the first pass.
+Every pixel is still traced once, with its own jitter, so the finished image is the same as render_batched's."""
+
+PASS_STEPS = (8, 4, 2, 1)
+
+
+def pass_pixels(width, height, step, earlier_steps=()):
+    """Rows and columns of the pixels a pass renders: every step-th pixel of every step-th row,
+    minus those the earlier passes already did"""
+    i, j = np.mgrid[0:height:step, 0:width:step]
+    i, j = i.reshape(-1), j.reshape(-1)
+    new = np.ones(len(i), dtype=bool)
+    for earlier in earlier_steps:
+        new &= (i % earlier != 0) | (j % earlier != 0)
+    return i[new], j[new]
+
+
+def upsampled(image_data, rendered, steps):
+    """Preview of a partly rendered image: pixels take the color at the corner of their block on the
+    finest grid (of steps, coarse to fine) whose corner has been rendered"""
+    height, width = rendered.shape
+    i, j = np.mgrid[0:height, 0:width]
+    preview = np.zeros_like(image_data)
+    for step in steps:
+        corner_i, corner_j = i - i % step, j - j % step
+        done = rendered[corner_i, corner_j]
+        preview[done] = image_data[corner_i[done], corner_j[done]]
+    return preview
+
+
+def save_preview(preview, preview_path):
+    """.png through Image.fromarray, anything else as raw RGB bytes (height x width x 3).
+    Written to a temporary file first, so a viewer never opens a half written preview"""
+    temp_path = preview_path + ".part"
+    if preview_path.lower().endswith(".png"):
+        Image.fromarray(preview, "RGB").save(temp_path, format="PNG")
+    else:
+        preview.tofile(temp_path)
+    os.replace(temp_path, preview_path)
+
+
+def render_progressive(objects_list, lights_list, width, height, eye_location, background_color=Vec3(0, 0, 0),
+                       max_bounces=1, multiple=False, cel_shaded=False, image_data=None, steps=PASS_STEPS,
+                       preview_path=None, preview_interval=5.0, pixels_per_batch=4096, seed=0, rasterize=False):
+    """render_batched in passes (steps, coarse to fine; a last pass of 1 is added if missing).
+    A preview goes to preview_path after every pass, and also mid-pass once preview_interval seconds
+    have gone by since the last one. rasterize as in render_batched"""
+    if image_data is None:
+        image_data = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+    steps = sorted(set(steps) | {1}, reverse=True)
+    scene = BatchScene(objects_list, lights_list, background_color)
+    primary = RasterVisibility(scene, eye_location) if rasterize else None
+    rendered = np.zeros((height, width), dtype=bool)
+
+    start_time = last_preview = time.time()
+    for pass_number, step in enumerate(steps):
+        i, j = pass_pixels(width, height, step, steps[:pass_number])
+        for batch_start in range(0, len(i), pixels_per_batch):
+            batch = slice(batch_start, batch_start + pixels_per_batch)
+            batch_i, batch_j = i[batch], j[batch]
+            origins, directions, keys = pixel_rays(width, height, eye_location, batch_i, batch_j, seed)
+            colors = scene.trace(origins, directions, keys, num_bounces=0, max_bounces=max_bounces,
+                                 multiple=multiple, cel_shaded=cel_shaded, primary=primary)
+            image_data[batch_i, batch_j] = colors.astype(np.uint8)
+            rendered[batch_i, batch_j] = True
+            if preview_path is not None and time.time() - last_preview >= preview_interval:
+                save_preview(upsampled(image_data, rendered, steps), preview_path)
+                last_preview = time.time()
+
+        print(f"Finished pass {pass_number + 1} of {len(steps)} (every {step} pixels) after ",
+              round(time.time() - start_time, 3), "seconds.")
+        if preview_path is not None:
+            save_preview(upsampled(image_data, rendered, steps), preview_path)
+            last_preview = time.time()
+    return image_data
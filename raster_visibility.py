@@ -0,0 +1,157 @@
+import numpy as np
+from SceneObjects import _dot
+from batch_trace import FAR_AWAY, SPHERE, TRIANGLE, sphere_hits
+import kernels
+import render_stats
+
+"""Primary visibility by rasterizing instead of traversing.
+Every camera ray starts at the eye, so the first thing it hits is what a z-buffer would show at its point on the
+image plane (z = 0). RasterVisibility projects a BatchScene's triangles and spheres there once per eye; for a batch
+of rays it bins their image-plane points into pixel cells and keeps, per ray, the nearest primitive covering it
+(by the depth of the triangle's plane, or the sphere, along the ray) - a depth / object id buffer over the rays.
+Projection and edge functions don't round like the ray-triangle test, so that primitive is only a candidate: its
+exact t (BatchScene.primitive_hits) becomes the ray's t_max, and BatchScene.intersect then only has to look in
+front of it, skipping every box behind the visible surface. The result is intersect's (t, primitive) bit for bit,
+ties included; rays the raster misses (or that start anywhere but the eye) are intersected in full.
+Faces without rows (of MeshInstances and stored meshes) aren't rasterized; the bounded intersect still finds them."""
+
+RASTER_PAIRS = 1 << 20  # (triangle, pixel cell) pairs rasterized at once
+
+
+def _ranges(counts):
+    """(owner, index) for every item of consecutive ranges of counts items: owner is the range it is in,
+    index its position there"""
+    owner = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return owner, np.arange(counts.sum()) - starts[owner]
+
+
+class RasterVisibility:
+    """The projected primitives of scene as seen from eye_location (a camera looking toward +z, eye behind the
+    image plane). intersect() is a drop-in for scene.intersect on the primary rays (BatchScene.trace's primary)"""
+
+    def __init__(self, scene, eye_location):
+        self.scene = scene
+        self.eye = np.array([eye_location.x, eye_location.y, eye_location.z])
+        self.distance = -self.eye[2]  # from the eye to the image plane
+        if self.distance <= 0:
+            print("Warning: the eye isn't behind the image plane (z = 0), so nothing is rasterized")
+        kinds = scene.kind[:scene.primitive_count]
+
+        # Only triangles wholly in front of the eye and facing it (triangle_hits doesn't hit back faces)
+        tris = np.nonzero(kinds == TRIANGLE)[0]
+        pt_a = scene.pt_a[tris]
+        corners = np.stack((pt_a, pt_a - scene.edge_ab[tris], pt_a - scene.edge_ac[tris]), axis=1)
+        plane = _dot(scene.normal[tris], pt_a - self.eye)
+        kept = (corners[..., 2] > self.eye[2]).all(axis=1) & (plane < 0) & (self.distance > 0)
+        self.tris, self.plane, self.normals = tris[kept], plane[kept], scene.normal[tris[kept]]
+        self.screen = self.project(corners[kept].reshape(-1, 3)).reshape(-1, 3, 2)
+        self.cell_low = np.floor(self.screen.min(axis=1)).astype(np.int64)
+        self.cell_high = np.floor(self.screen.max(axis=1)).astype(np.int64)
+
+        # A sphere wholly in front of the eye projects inside its box's projected corners; any other may cover
+        # the whole image
+        self.spheres = np.nonzero(kinds == SPHERE)[0] if self.distance > 0 else np.zeros(0, dtype=np.int64)
+        self.sphere_cells = []
+        for pid in self.spheres:
+            center, radius = scene.center[pid], scene.radius[pid]
+            if center[2] - radius <= self.eye[2]:
+                self.sphere_cells.append(None)
+                continue
+            box = center + radius * np.array([(x, y, z) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)])
+            screen = self.project(box)
+            self.sphere_cells.append((np.floor(screen.min(axis=0)).astype(np.int64),
+                                      np.floor(screen.max(axis=0)).astype(np.int64)))
+
+    def project(self, points):
+        """(x, y) on the image plane of points in front of the eye"""
+        scale = self.distance / (points[:, 2] - self.eye[2])
+        return self.eye[:2] + (points[:, :2] - self.eye[:2]) * scale[:, None]
+
+    def candidates(self, directions):
+        """The primitive id nearest along each ray from the eye by rasterization, or -1"""
+        best_t = np.full(len(directions), np.inf)
+        best = np.full(len(directions), -1, dtype=np.int64)
+        rays = np.nonzero(directions[:, 2] > 0)[0] if self.distance > 0 else np.zeros(0, dtype=np.int64)
+        if rays.size == 0:
+            return best
+        points = self.eye[:2] + directions[rays, :2] * (self.distance / directions[rays, 2])[:, None]
+        cells = np.floor(points).astype(np.int64)
+        low, high = cells.min(axis=0), cells.max(axis=0)
+        columns = high[0] - low[0] + 1
+        # The rays sorted by cell, and where each cell's run of them starts
+        cell_ids = (cells[:, 1] - low[1]) * columns + cells[:, 0] - low[0]
+        order = np.argsort(cell_ids, kind="stable")
+        cell_starts = np.searchsorted(cell_ids[order], np.arange((high[1] - low[1] + 1) * columns + 1))
+
+        def rays_in(cell_low, cell_high):
+            """(owner, ray index into rays) for every ray in the cells of the boxes [cell_low, cell_high]"""
+            cell_low, cell_high = np.maximum(cell_low, low), np.minimum(cell_high, high)
+            sizes = np.maximum(cell_high - cell_low + 1, 0)
+            owner, index = _ranges(sizes[:, 0] * sizes[:, 1])
+            cell = ((cell_low[owner, 1] + index // sizes[owner, 0] - low[1]) * columns +
+                    cell_low[owner, 0] + index % sizes[owner, 0] - low[0])
+            owner_of_cell, index = _ranges(cell_starts[cell + 1] - cell_starts[cell])
+            return owner[owner_of_cell], order[cell_starts[cell[owner_of_cell]] + index]
+
+        if kernels.backend == "numba":
+            kernels.raster_triangles(self.screen, self.cell_low, self.cell_high, self.plane, self.normals, self.tris,
+                                     directions, points, rays, low, high, order, cell_starts, best_t, best)
+        else:
+            self._raster_triangles(directions, points, rays, low, high, rays_in, best_t, best)
+        for pid, sphere_cells in zip(self.spheres, self.sphere_cells):
+            ray = np.arange(len(rays)) if sphere_cells is None else rays_in(sphere_cells[0][None],
+                                                                            sphere_cells[1][None])[1]
+            hit, t = sphere_hits(np.tile(self.eye, (len(ray), 1)), directions[rays[ray]], self.scene.center[pid],
+                                 self.scene.radius[pid], np.full(len(ray), FAR_AWAY))
+            self._keep_nearest(best_t, best, rays[ray[hit]], t[hit], np.full(np.count_nonzero(hit), pid))
+        return best
+
+    def _raster_triangles(self, directions, points, rays, low, high, rays_in, best_t, best):
+        """kernels.raster_triangles in numpy, RASTER_PAIRS (triangle, cell) pairs at a time"""
+        on_screen = np.nonzero((self.cell_high >= low).all(axis=1) & (self.cell_low <= high).all(axis=1))[0]
+        cell_counts = np.prod(np.minimum(self.cell_high[on_screen], high) -
+                              np.maximum(self.cell_low[on_screen], low) + 1, axis=1)
+        chunk_of = (np.cumsum(cell_counts) - cell_counts) // RASTER_PAIRS
+        for chunk in np.split(on_screen, np.flatnonzero(np.diff(chunk_of)) + 1):
+            owner, ray = rays_in(self.cell_low[chunk], self.cell_high[chunk])
+            tri = chunk[owner]
+            inside = self._covers(self.screen[tri], points[ray])
+            tri, ray = tri[inside], ray[inside]
+            with np.errstate(divide="ignore"):
+                t = self.plane[tri] / _dot(self.normals[tri], directions[rays[ray]])
+            ahead = t > 0
+            self._keep_nearest(best_t, best, rays[ray[ahead]], t[ahead], self.tris[tri[ahead]])
+
+    @staticmethod
+    def _covers(screen, points):
+        """Whether each projected triangle (n, 3, 2) covers its point (n, 2), edges included, either winding"""
+        edges = []
+        for start, end in ((0, 1), (1, 2), (2, 0)):
+            edge, to_point = screen[:, end] - screen[:, start], points - screen[:, start]
+            edges.append(edge[:, 0] * to_point[:, 1] - edge[:, 1] * to_point[:, 0])
+        edges = np.array(edges)
+        return (edges >= 0).all(axis=0) | (edges <= 0).all(axis=0)
+
+    @staticmethod
+    def _keep_nearest(best_t, best, rays, t, pids):
+        """Depth test of fragments (ray, t, primitive id) against the buffer, nearer t winning (which of equally
+        near ones wins doesn't matter, RasterVisibility.intersect resolves ties)"""
+        np.minimum.at(best_t, rays, t)
+        nearest = t == best_t[rays]
+        best[rays[nearest]] = pids[nearest]
+
+    def intersect(self, origins, directions):
+        """scene.intersect(origins, directions), with what the raster sees first bounding each ray from the eye"""
+        if not (origins == self.eye).all():
+            return self.scene.intersect(origins, directions)
+        with render_stats.stage("raster"):
+            candidates = self.candidates(directions)
+        t_max = np.full(len(origins), FAR_AWAY)
+        ids = np.nonzero(candidates >= 0)[0]
+        hit, t_hit = self.scene.primitive_hits(candidates[ids], origins[ids], directions[ids], t_max[ids])
+        # Just past the candidate, so it (or whatever ties with it) is found again and ties resolve as usual
+        t_max[ids[hit]] = np.nextafter(t_hit[hit], np.inf)
+        t, prim = self.scene.intersect(origins, directions, t_max)
+        t[prim < 0] = FAR_AWAY
+        return t, prim
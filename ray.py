@@ -1,7 +1,11 @@
-from SceneObjects import Triangle, Sphere, CheckeredSphere, PointLight
-from BHV_BBox import BoundingBox
-from vector import Vec3
+from SceneObjects import Triangle, Sphere, CheckeredSphere, PointLight, TriangleMesh, MeshFace
+from BHV_BBox import BoundingBox, SceneBVH
+from instancing import MeshInstance, InstanceFace, InstanceGroup
+from vector import Vec3, point_along, reflect
+from occluder_cache import OccluderCache
+import render_stats
 from random import uniform
+from time import perf_counter
 
 class Ray:
     def __init__(self, ray_origin, ray_direction, nearest_hit_distance=1e20):
@@ -29,8 +33,7 @@ class Ray:
         if dir_dot_n > 0:
             return False
         # From book
-        new_direction = self.direction + normal * (2 * -dir_dot_n)
-        return Ray(point, new_direction)
+        return Ray(point, reflect(self.direction, normal))
 
 
 class ShadowRay(Ray):
@@ -42,17 +45,24 @@ class ShadowRay(Ray):
 
 def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_look_at_point=None,
               background_color=Vec3(0, 0, 0), list_of_lights=None,
-              multiple=False, ray_given=None, cel_shaded=False):
+              multiple=False, ray_given=None, cel_shaded=False, shadow_cache=None):
     """Recursively casting rays for reflections
-        (casted ray, list of objects, current number of bounces, max bounces)"""
+        (casted ray, list of objects, current number of bounces, max bounces)
+    shadow_cache is the OccluderCache shade keeps shadow ray blockers in; pass one per render (of one
+    objects_list) so neighbouring pixels share it. A new one is used when None"""
 
 
+    if render_stats.enabled:
+        render_stats.record_depth(num_bounces)
+
     # Really don't need bounces after first few
     if multiple and num_bounces > 3:
         multiple = False
 
     if ray_given is None:
         assert ray_origin is not None and ray_look_at_point is not None
+    if shadow_cache is None:
+        shadow_cache = OccluderCache()
 
     color_rays_list = []
     silhouette_rays_list, silhouette_objects_hit_list = [], []
@@ -111,12 +121,10 @@ def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_loo
     # determining if is edge silhouette
     first_hit_obj = silhouette_objects_hit_list[0]
     if multiple:
-        if not first_hit_obj:
-            return Vec3(0, 0, 0)
-        for hit_obj in silhouette_objects_hit_list[1:]:
-            if not hit_obj:
-                return Vec3(0, 0, 0)
-            if hit_obj.parent is not first_hit_obj.parent:
+        for hit_obj in silhouette_objects_hit_list:
+            if not hit_obj or hit_obj.parent is not first_hit_obj.parent:
+                if render_stats.enabled:
+                    render_stats.count("silhouette_early_outs")
                 return Vec3(0, 0, 0)
 
     # since we know we hit the same object, we can just send in a "list" of that one object to check the rays against
@@ -127,7 +135,8 @@ def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_loo
     object_hit = first_hit_obj
     # Is not edge silhouette
     obj_type = type(object_hit)
-    if obj_type == Triangle or obj_type == Sphere or obj_type == CheckeredSphere:
+    if obj_type == Triangle or obj_type == Sphere or obj_type == CheckeredSphere or obj_type == MeshFace or \
+            obj_type == InstanceFace:
 
         sum_color = Vec3()
 
@@ -135,7 +144,7 @@ def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_loo
             reflected_ray = False
             # only reflect off of things "reasonably" close; this came from some debugging I was doing
             if ray_to_trace.nearest_hit_distance < 1e18:
-                point_hit = ray_to_trace.origin + ray_to_trace.nearest_hit_distance * ray_to_trace.direction
+                point_hit = point_along(ray_to_trace.origin, ray_to_trace.direction, ray_to_trace.nearest_hit_distance)
                 reflected_ray = ray_to_trace.reflect(point_hit, object_hit.get_normal(point_hit))
 
             # Make sure can actually reflect; if cannot, triangle is facing away from ray origin
@@ -144,9 +153,14 @@ def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_loo
             if reflected_ray is False:
                 return background_color
 
+            # Not render_stats.stage: a context manager per shade costs time even with the stats off
+            shade_start = perf_counter() if render_stats.enabled else 0.0
             shaded_color = shade(reflected_ray.origin, object_hit, list_of_lights=list_of_lights,
                                  list_of_objects=objects_list, ray_to_point=ray_to_trace,
-                                 amb_intensity=abs(background_color)/abs(Vec3(255,255,255)) + 0.1, cel_shaded=cel_shaded)
+                                 amb_intensity=abs(background_color)/abs(Vec3(255,255,255)) + 0.1,
+                                 cel_shaded=cel_shaded, shadow_cache=shadow_cache)
+            if render_stats.enabled:
+                render_stats.add_time("shade", perf_counter() - shade_start)
 
             if object_hit.reflectiveness == 0 or num_bounces + 1 > max_bounces:
                 return shaded_color
@@ -154,7 +168,7 @@ def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_loo
             reflected_color = ray_trace(objects_list=objects_list,
                                         num_bounces=num_bounces + 1, max_bounces=max_bounces,
                                         background_color=background_color, list_of_lights=list_of_lights,
-                                        multiple=multiple, ray_given=reflected_ray)
+                                        multiple=multiple, ray_given=reflected_ray, shadow_cache=shadow_cache)
 
             sum_color += (1 - object_hit.reflectiveness) * shaded_color + object_hit.reflectiveness * reflected_color
 
@@ -166,10 +180,14 @@ def ray_trace(objects_list, num_bounces, max_bounces=1, ray_origin=None, ray_loo
         return background_color
 
 
+# Objects whose intersect returns the object hit inside them rather than True
+CONTAINERS = (BoundingBox, TriangleMesh, MeshInstance, InstanceGroup, SceneBVH)
+
+
 def ray_intersection(ray, objects):
     obj_hit = None
     for obj in objects:
-        if type(obj) == BoundingBox:
+        if type(obj) in CONTAINERS:
             new_obj_hit = obj.intersect(ray)
             if new_obj_hit:
                 obj_hit = new_obj_hit
@@ -177,6 +195,10 @@ def ray_intersection(ray, objects):
             b_obj_hit = obj.intersect(ray)
             if b_obj_hit:
                 obj_hit = obj
+    if render_stats.enabled:
+        render_stats.count("intersections")
+        if obj_hit is not None:
+            render_stats.count("hits")
     if obj_hit is not None:
         return obj_hit
     else:
@@ -184,7 +206,11 @@ def ray_intersection(ray, objects):
 
 
 def shade(point_shaded, object_shaded, list_of_lights, list_of_objects, ray_to_point,
-          ambient_color=Vec3(0, 0, 0), amb_intensity=None, cel_shaded=False):
+          ambient_color=Vec3(0, 0, 0), amb_intensity=None, cel_shaded=False, shadow_cache=None):
+    """shadow_cache (an OccluderCache for list_of_objects) keeps what last blocked a shadow ray toward each
+    light, tested before the rest of the objects"""
+    if shadow_cache is None:
+        shadow_cache = OccluderCache()
     if len(list_of_lights) == 0:
         print("No lights for shading")
         return object_shaded.get_color(point_hit=point_shaded)
@@ -193,11 +219,19 @@ def shade(point_shaded, object_shaded, list_of_lights, list_of_objects, ray_to_p
 
     for light in list_of_lights:
         shadow_ray = ShadowRay(point_shaded, light)
-        in_shadow = False
-        for obj in list_of_objects:
-            if obj.intersect(shadow_ray): #and obj is not object_shaded:
-                in_shadow = True
-                break
+        if render_stats.enabled:
+            render_stats.count("shadow_rays")
+        blocker = shadow_cache.blockers.get(light)
+        in_shadow = blocker is not None and blocker.occluded(shadow_ray)
+        if blocker is not None:
+            shadow_cache.record(1, in_shadow)
+        if not in_shadow:
+            for obj in list_of_objects:
+                blocker = obj.occluder(shadow_ray)
+                if blocker is not None: #and obj is not object_shaded:
+                    shadow_cache.blockers[light] = blocker
+                    in_shadow = True
+                    break
 
         if abs(ambient_color) < 0.1:
             assert amb_intensity is not None
@@ -213,9 +247,8 @@ def shade(point_shaded, object_shaded, list_of_lights, list_of_objects, ray_to_p
 
             # Reflected Light (Negative because shadow ray pointing away from surface) Shirley & Marschner pg.238
             # Check if is actually reflecting the correct way
-            r_vec = 2 * l_vec.dot(norm_at_point) * norm_at_point - l_vec
-            e_vec = -1 * ray_to_point.direction  # negative so facing correct way
-            e_dot_r = max(e_vec.dot(r_vec), 0)
+            # e . r with e = -direction and r = -reflect(l); the two negations cancel exactly
+            e_dot_r = max(ray_to_point.direction.dot(reflect(l_vec, norm_at_point)), 0)
             specular_color += light.intensity * light.color * pow(e_dot_r, object_shaded.shininess)
         else:
             return ambient_color / 2
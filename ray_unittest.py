@@ -17,6 +17,27 @@ class TestVectorMethods(unittest.TestCase):
         self.assertEqual(a.y, 2.0)
         self.assertEqual(a.z, 4.0)
 
+    def test_inplace_and_fused(self):
+        a = vector.Vec3(0.1, 0.2, 0.3)
+        b = vector.Vec3(-0.7, 0.5, 0.25)
+        expected = (a + b) * 3
+        c = vector.Vec3(a)
+        c += b
+        c *= 3
+        self.assertEqual((c.x, c.y, c.z), (expected.x, expected.y, expected.z))
+        self.assertEqual((a.x, a.y, a.z), (0.1, 0.2, 0.3))
+
+        along = vector.point_along(a, b, 1.7)
+        expected = a + 1.7 * b
+        self.assertEqual((along.x, along.y, along.z), (expected.x, expected.y, expected.z))
+
+        normal = vector.Vec3(0, -1, 0.5).normalize()
+        reflected = vector.reflect(b, normal)
+        expected = b + normal * (2 * -b.dot(normal))
+        self.assertEqual((reflected.x, reflected.y, reflected.z), (expected.x, expected.y, expected.z))
+        with self.assertRaises(TypeError):
+            a * b
+
 
 if __name__ == '__main__':
     unittest.main()
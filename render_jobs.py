@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import sys
+import time
+from math import pi
+import numpy as np
+import transformations
+from PIL import Image
+from vector import Vec3
+from SceneObjects import PointLight
+from BHV_BBox import BoundingBox
+from cube import cube_load
+from geometry_loading import checkered_sph_only, test_spheres, spheres_for_link, transform_objects, \
+    load_toon_link_mesh, load_toon_link_meshes, load_toon_link_instances
+from scene_cache import cached_mesh
+from batch_trace import BatchScene, render_scene_batched
+from parallel_render import render_parallel
+from gbuffer_render import render_scene_gbuffer
+from adaptive_render import render_scene_adaptive
+import render_stats
+
+"""Many renders in one process, described by a job file instead of main.py's flags.
+Every render in the file runs one after the other in this process, and what doesn't change between them is kept:
+the parsed Link .obj, the objects set up for each size (meshes with their BVHs, the cube's BoundingBox, the
+spheres) and the packed BatchScene for the same objects, lights and background. So renders that only differ in
+depth, cel-shading, silhouettes or renderer start tracing right away.
+
+    python render_jobs.py jobs.json  (or jobs.toml)
+
+A job file has optional "defaults" and a list of "renders"; each render is DEFAULTS, updated with the file's
+defaults and then with its own settings. A list of sizes makes one render per size (named name-size).
+    {"defaults": {"size": 256, "output": "renders/{name}.png"},
+     "renders": [{"name": "cel"},
+                 {"name": "plain", "cel_shaded": false, "silhouettes": false, "size": [256, 512]},
+                 {"name": "spheres", "objects": ["floor", "spheres"], "renderer": "adaptive"}]}"""
+
+DEFAULTS = {"name": "render",
+            "size": 512,
+            "depth": 5,
+            "cel_shaded": True,
+            "silhouettes": True,
+            "renderer": "batched",  # see RENDERERS
+            "workers": None,  # for the parallel renderer (None = one per CPU)
+            "adaptive_samples": 8,  # for the adaptive renderer
+            "seed": 0,
+            "eye_distance": 1.5,  # in image heights, in front of the image plane
+            "viewing_angle": 30,
+            "background": [30, 30, 30],
+            # Positions are in image sizes, like main.py's light at (size, size, -size * 1.5)
+            "lights": [{"position": [1, 1, -1.5], "color": [255, 255, 255], "intensity": 1.0}],
+            "objects": ["floor", "link", "cube", "link_spheres", "spheres"],  # see OBJECTS; in this order
+            "link_copies": 2,
+            "link_reflectiveness": 0.0,
+            "link_instancing": False,  # the Links as MeshInstances of one shared mesh (not scene cached)
+            "bvh_method": "sah",
+            "bvh_leaf_size": 4,
+            "scene_cache": True,  # keep the prepared Link mesh in scene_cache/ for later processes too
+            "output": "{name}.png"}  # formatted with the render's settings
+RENDERERS = ("batched", "parallel", "gbuffer", "adaptive")
+# Settings each kind of object is set up with (besides size); objects are only shared if these are equal
+OBJECTS = {"floor": ("viewing_angle",),
+           "link": ("link_copies", "link_reflectiveness", "link_instancing", "bvh_method", "bvh_leaf_size",
+                    "scene_cache"),
+           "cube": ("viewing_angle", "bvh_method", "bvh_leaf_size"),
+           "link_spheres": ("viewing_angle",),
+           "spheres": ("viewing_angle",)}
+
+
+def load_job_file(path):
+    """The job file's contents, from JSON or (for .toml files) TOML"""
+    if path.lower().endswith(".toml"):
+        import tomllib  # Python 3.11+
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+    with open(path) as file:
+        return json.load(file)
+
+
+def expand_renders(job):
+    """The settings of every render in job (a loaded job file), checked before anything is rendered"""
+    unknown = set(job) - {"defaults", "renders"}
+    if unknown:
+        raise ValueError(f"Unknown job file entries: {', '.join(sorted(unknown))}")
+    if "name" in job.get("defaults", {}):
+        raise ValueError("defaults can't set name: every render needs its own (render<index> if it sets none)")
+    renders = []
+    for index, entry in enumerate(job.get("renders", [])):
+        settings = dict(DEFAULTS, name=f"render{index}")
+        settings.update(job.get("defaults", {}))
+        settings.update(entry)
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Render {settings['name']}: unknown settings {', '.join(sorted(unknown))}")
+        if settings["renderer"] not in RENDERERS:
+            raise ValueError(f"Render {settings['name']}: renderer must be one of {', '.join(RENDERERS)}")
+        unknown = set(settings["objects"]) - set(OBJECTS)
+        if unknown:
+            raise ValueError(f"Render {settings['name']}: unknown objects {', '.join(sorted(unknown))}")
+        if isinstance(settings["size"], list):
+            renders += [dict(settings, name=f"{settings['name']}-{size}", size=size) for size in settings["size"]]
+        else:
+            renders.append(settings)
+    names = [settings["name"] for settings in renders]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Renders named more than once: {', '.join(sorted(duplicates))}")
+    return renders
+
+
+def _object_key(name, settings):
+    return (name, settings["size"]) + tuple(json.dumps(settings[setting]) for setting in OBJECTS[name])
+
+
+class RenderSession:
+    """Runs renders, keeping everything they can share. Objects and scenes are never changed by rendering,
+    so one set serves any number of renders"""
+    def __init__(self):
+        self.link_mesh = None  # the parsed .obj, before any transform
+        self.objects = {}  # _object_key -> list of objects
+        self.scenes = {}  # (object keys, lights, background) -> BatchScene
+        self.reused = {"objects": 0, "scenes": 0}
+
+    def _build(self, name, settings):
+        size, viewing_angle = settings["size"], settings["viewing_angle"]
+        if name == "floor":
+            return checkered_sph_only(size, viewing_angle=viewing_angle, reflectiveness=0.4)
+        if name == "link_spheres":
+            return spheres_for_link(size, viewing_angle=viewing_angle)
+        if name == "spheres":
+            return test_spheres(size, viewing_angle=viewing_angle)
+        if name == "cube":
+            with render_stats.stage("load"):
+                cube = cube_load(reflectiveness=0.5)
+            rot_mat1 = transformations.compose_matrix(angles=(0, 0, -90 * pi / 180))
+            rot_mat2 = transformations.compose_matrix(angles=(0, 65 * pi / 180, 0))
+            scale = size / 4
+            transform_mat = transformations.compose_matrix(scale=(scale, scale, scale),
+                                                           angles=(-viewing_angle * pi / 180, 0, 0),
+                                                           translate=(-size/3, size / 3, size/2))
+            transform_mat = transform_mat.dot(rot_mat2.dot(rot_mat1))
+            transform_objects(cube, transform_matrix=transform_mat)
+            with render_stats.stage("build"):
+                return [BoundingBox(cube, leaf_size=settings["bvh_leaf_size"], method=settings["bvh_method"])]
+        # Link, set up as in main.py (which also keys the scene cache with this)
+        link_setup = {"angles": (15, 180, 0),
+                      "placements": [(size / 35, (0 * size/4, 1.2 * -size / 3,  0 * -size / 5),
+                                      (67*1.2, 158*1.2, 78*1.2)),
+                                     (size / 50, (1.5 * size / 4, -size / 10, size / 4),
+                                      (67*1.4, 79*1.4, 140*1.4))][:settings["link_copies"]],
+                      "reflectiveness": settings["link_reflectiveness"],
+                      "bvh": (settings["bvh_leaf_size"], settings["bvh_method"])}
+
+        def build():
+            if self.link_mesh is None:
+                with render_stats.stage("load"):
+                    self.link_mesh = load_toon_link_mesh()
+            if settings["link_instancing"]:
+                return load_toon_link_instances(**link_setup, link_mesh=self.link_mesh)
+            return load_toon_link_meshes(**link_setup, link_mesh=self.link_mesh)
+        if settings["scene_cache"] and not settings["link_instancing"]:
+            return [cached_mesh(["DolToonlinkR1_fixed.obj"], link_setup, build)]
+        return [build()]
+
+    def objects_for(self, settings):
+        """(object keys, objects list) of a render, built only where no earlier render had them"""
+        keys, objects_list = [], []
+        for name in settings["objects"]:
+            key = _object_key(name, settings)
+            if key in self.objects:
+                self.reused["objects"] += 1
+            else:
+                self.objects[key] = self._build(name, settings)
+            keys.append(key)
+            objects_list += self.objects[key]
+        return tuple(keys), objects_list
+
+    @staticmethod
+    def lights_for(settings):
+        size = settings["size"]
+        return [PointLight(position=Vec3(*[coordinate * size for coordinate in light["position"]]),
+                           color=Vec3(*light["color"]),
+                           intensity=light.get("intensity", 1.0)) for light in settings["lights"]]
+
+    def scene_for(self, settings, keys, objects_list):
+        """The packed BatchScene of a render's objects, lights and background"""
+        scene_key = (keys, json.dumps(settings["lights"]), json.dumps(settings["background"]))
+        if scene_key in self.scenes:
+            self.reused["scenes"] += 1
+        else:
+            self.scenes[scene_key] = BatchScene(objects_list, self.lights_for(settings),
+                                                Vec3(*settings["background"]))
+        return self.scenes[scene_key]
+
+    def render(self, settings):
+        """Renders one job file entry (expanded by expand_renders); returns the image"""
+        size, depth = settings["size"], settings["depth"]
+        cel_shaded, silhouettes = settings["cel_shaded"], settings["silhouettes"]
+        eye_location = Vec3(0, 0, -size * settings["eye_distance"])
+        image_data = np.zeros(shape=(size, size, 3), dtype=np.uint8)
+        keys, objects_list = self.objects_for(settings)
+
+        start_time = time.time()
+        if settings["renderer"] == "parallel":
+            render_parallel(objects_list, self.lights_for(settings), size, size, eye_location,
+                            background_color=Vec3(*settings["background"]), max_bounces=depth,
+                            multiple=silhouettes, cel_shaded=cel_shaded, image_data=image_data,
+                            workers=settings["workers"], seed=settings["seed"])
+        else:
+            scene = self.scene_for(settings, keys, objects_list)
+            if settings["renderer"] == "adaptive":
+                render_scene_adaptive(scene, size, size, eye_location, max_bounces=depth, cel_shaded=cel_shaded,
+                                      image_data=image_data, max_samples=settings["adaptive_samples"],
+                                      silhouettes=silhouettes, seed=settings["seed"])
+            elif settings["renderer"] == "gbuffer" and silhouettes:
+                render_scene_gbuffer(scene, size, size, eye_location, max_bounces=depth, cel_shaded=cel_shaded,
+                                     image_data=image_data, seed=settings["seed"])
+            else:
+                render_scene_batched(scene, size, size, eye_location, max_bounces=depth, multiple=silhouettes,
+                                     cel_shaded=cel_shaded, image_data=image_data, seed=settings["seed"])
+        render_stats.add_time("trace", time.time() - start_time)
+        return image_data
+
+
+def run_jobs(renders, session=None):
+    """Renders and saves every render's image; returns {name: (output path, render seconds)}"""
+    session = RenderSession() if session is None else session
+    results = {}
+    for settings in renders:
+        start_time = time.time()
+        image_data = session.render(settings)
+        elapsed = time.time() - start_time
+        output = settings["output"].format(**settings)
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        with render_stats.stage("save"):
+            Image.fromarray(image_data, "RGB").save(output)
+        results[settings["name"]] = (output, elapsed)
+        print(f"Render {settings['name']} took {round(elapsed, 3)} seconds, saved to {output}")
+    print(f"Reused objects {session.reused['objects']} times and packed scenes {session.reused['scenes']} times")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render every entry of a job file in one process")
+    parser.add_argument("job_file", help=".json or .toml job file")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="render just these (expanded) names")
+    parser.add_argument("--list", action="store_true", help="print the expanded renders instead of rendering")
+    parser.add_argument("--stats", metavar="JSON", help="collect render_stats for all renders and save them here")
+    args = parser.parse_args(argv)
+
+    renders = expand_renders(load_job_file(args.job_file))
+    if args.only:
+        missing = set(args.only) - {settings["name"] for settings in renders}
+        if missing:
+            parser.error(f"no renders named {', '.join(sorted(missing))}")
+        renders = [settings for settings in renders if settings["name"] in args.only]
+    if args.list:
+        for settings in renders:
+            print(json.dumps(settings))
+        return 0
+
+    if args.stats:
+        render_stats.enable()
+    run_jobs(renders)
+    if args.stats:
+        render_stats.print_summary()
+        render_stats.save_json(args.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+import contextlib
+import io
+import unittest
+import numpy as np
+from vector import Vec3
+from SceneObjects import PointLight
+from geometry_loading import checkered_sph_only, test_spheres
+from batch_trace import render_batched
+from render_jobs import expand_renders, RenderSession
+
+
+class TestRenderJobs(unittest.TestCase):
+
+    def test_expand_renders(self):
+        renders = expand_renders({"defaults": {"depth": 2},
+                                  "renders": [{"name": "a", "size": [8, 16]}, {"cel_shaded": False}]})
+        self.assertEqual([settings["name"] for settings in renders], ["a-8", "a-16", "render1"])
+        self.assertEqual([settings["size"] for settings in renders], [8, 16, 512])
+        self.assertTrue(all(settings["depth"] == 2 for settings in renders))
+        for bad_job in [{"renders": [{"sise": 8}]}, {"renders": [{"renderer": "gpu"}]},
+                        {"renders": [{"objects": ["teapot"]}]}, {"renders": [{"name": "a"}, {"name": "a"}]},
+                        {"defaults": {"name": "a"}, "renders": [{}, {}]}]:
+            with self.assertRaises(ValueError):
+                expand_renders(bad_job)
+
+    def test_reuses_objects_and_scenes(self):
+        renders = expand_renders({"defaults": {"size": 12, "objects": ["floor", "spheres"], "depth": 2},
+                                  "renders": [{"name": "a"}, {"name": "b", "cel_shaded": False},
+                                              {"name": "c", "renderer": "gbuffer"}]})
+        session = RenderSession()
+        with contextlib.redirect_stdout(io.StringIO()):
+            images = [session.render(settings) for settings in renders]
+            objects_list = checkered_sph_only(12, viewing_angle=30, reflectiveness=0.4) + \
+                test_spheres(12, viewing_angle=30)
+            lights_list = [PointLight(position=Vec3(12, 12, -18), color=Vec3(255, 255, 255), intensity=1.0)]
+            expected = render_batched(objects_list, lights_list, 12, 12, Vec3(0, 0, -18),
+                                      background_color=Vec3(30, 30, 30), max_bounces=2, multiple=True,
+                                      cel_shaded=True)
+        self.assertTrue(np.array_equal(images[0], expected))
+        self.assertEqual(len(session.objects), 2)
+        self.assertEqual(session.reused, {"objects": 4, "scenes": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import time
+from contextlib import contextmanager
+
+"""Opt-in counters and stage timers for a render.
+Off by default; the hot paths then only pay for checking render_stats.enabled. enable() turns it on (and clears
+what was collected); at the end of the render, print_summary() or save_json() report:
+    counters        box_tests, triangle_tests, sphere_tests, intersections and hits (ray_intersection calls and
+                    the ones that hit something), shadow_rays, silhouette_early_outs, occluder_cache_tests and
+                    occluder_cache_hits (shadow rays checked against a cached blocker and the ones it blocked)
+    depth_histogram rays traced at each reflection depth (0 = from the eye)
+    stage_times     seconds spent in load, transform, build, trace, shade and save (shade is part of trace)
+Stats live in this process only, so worker processes of parallel_render don't add to them."""
+
+enabled = False
+counters = {}
+depth_histogram = {}
+stage_times = {}
+
+
+def reset():
+    counters.clear()
+    depth_histogram.clear()
+    stage_times.clear()
+
+
+def enable():
+    global enabled
+    reset()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def count(name, amount=1):
+    counters[name] = counters.get(name, 0) + int(amount)
+
+
+def record_depth(depth, amount=1):
+    depth_histogram[depth] = depth_histogram.get(depth, 0) + int(amount)
+
+
+def counted(name, function):
+    """function, counting a name every time it is called"""
+    def wrapper(*args):
+        counters[name] = counters.get(name, 0) + 1
+        return function(*args)
+    return wrapper
+
+
+def add_time(name, seconds):
+    if enabled:
+        stage_times[name] = stage_times.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    """Adds the time spent in the with block to stage_times[name] (nothing when disabled)"""
+    if not enabled:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start_time)
+
+
+def summary():
+    return {"counters": dict(sorted(counters.items())),
+            "depth_histogram": {str(depth): depth_histogram[depth] for depth in sorted(depth_histogram)},
+            "stage_times": dict(stage_times)}
+
+
+def print_summary():
+    print("Render stats:")
+    for name, value in sorted(counters.items()):
+        print(f"\t{name:24}{value:>14,}")
+    if counters.get("occluder_cache_tests"):
+        print(f"\t{'occluder cache hit rate':24}{counters['occluder_cache_hits'] / counters['occluder_cache_tests']:>14.1%}")
+    for depth in sorted(depth_histogram):
+        print(f"\t{f'rays at depth {depth}':24}{depth_histogram[depth]:>14,}")
+    for name, seconds in stage_times.items():
+        print(f"\t{name + ' time':24}{seconds:>14.3f}s")
+
+
+def save_json(path):
+    with open(path, "w") as file:
+        json.dump(summary(), file, indent=2)
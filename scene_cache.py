@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from SceneObjects import TriangleMesh
+import render_stats
+
+"""On-disk cache of prepared meshes, so warm starts skip parsing the .obj, transforming and building the BVH.
+An entry is a directory of .npy files (one per TriangleMesh.to_arrays array, BVH nodes included) that is
+memory-mapped back in. Entries are keyed by the source files' contents and the parameters used to prepare them,
+so changing either one just misses the cache."""
+
+CACHE_DIR = "scene_cache"
+CACHE_VERSION = 1  # bump when the stored arrays or the way meshes are prepared change
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(source_paths, params):
+    """Hash of the source files' contents and the (JSON-able) parameters they are prepared with"""
+    digest = hashlib.sha256(f"version {CACHE_VERSION}".encode())
+    for path in source_paths:
+        digest.update(file_hash(path).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def save_mesh(mesh, key, cache_dir=CACHE_DIR):
+    """Writes the mesh's arrays to cache_dir/key (via a temporary directory, so readers never see half an entry)"""
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".part-")
+    arrays = mesh.to_arrays()
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_dir, f"{name}.npy"), array)
+    with open(os.path.join(temp_dir, "mesh.json"), "w") as file:
+        json.dump({"parent": mesh.parent, "arrays": list(arrays)}, file)
+    entry = os.path.join(cache_dir, key)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(temp_dir, entry)
+
+
+def load_mesh(key, cache_dir=CACHE_DIR):
+    """The mesh saved under key with its arrays memory-mapped (read only), or None if there is no such entry"""
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, "mesh.json")) as file:
+            info = json.load(file)
+        arrays = {name: np.load(os.path.join(entry, f"{name}.npy"), mmap_mode="r") for name in info["arrays"]}
+    except (OSError, ValueError, KeyError):
+        return None
+    return TriangleMesh.from_arrays(arrays, parent=info["parent"])
+
+
+def cached_mesh(source_paths, params, build, cache_dir=CACHE_DIR):
+    """The TriangleMesh build() makes from source_paths with params; loaded from the cache when an entry for the
+    same file contents and params exists, otherwise built and saved"""
+    start_time = time.time()
+    key = cache_key(source_paths, params)
+    with render_stats.stage("load"):
+        mesh = load_mesh(key, cache_dir)
+    if mesh is not None:
+        print(f"Loaded {len(mesh)} faces from scene cache {key} in {time.time() - start_time}s")
+        return mesh
+    mesh = build()
+    save_mesh(mesh, key, cache_dir)
+    print(f"Saved {len(mesh)} faces to scene cache {key}")
+    return mesh
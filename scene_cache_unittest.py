@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from ray import Ray
+from vector import Vec3
+from mesh_unittest import random_mesh
+from scene_cache import cache_key, cached_mesh
+
+
+class TestSceneCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        self.source = os.path.join(self.temp_dir.name, "model.obj")
+        with open(self.source, "w") as file:
+            file.write("v 0 0 0\n")
+        self.builds = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def build(self):
+        self.builds += 1
+        mesh = random_mesh(50)
+        mesh.build_bvh()
+        return mesh
+
+    def test_warm_start_skips_build(self):
+        built = cached_mesh([self.source], {"scale": 2}, self.build, self.cache_dir)
+        loaded = cached_mesh([self.source], {"scale": 2}, self.build, self.cache_dir)
+        self.assertEqual(self.builds, 1)
+        np.testing.assert_array_equal(loaded.A, built.A)
+        np.testing.assert_array_equal(loaded.bvh.nodes, built.bvh.nodes)
+        self.assertEqual(loaded.parent, built.parent)
+        built_ray, loaded_ray = Ray(Vec3(0, 0, -40), Vec3(0.05, 0.02, 1)), Ray(Vec3(0, 0, -40), Vec3(0.05, 0.02, 1))
+        self.assertEqual(built.intersect(built_ray) is False, loaded.intersect(loaded_ray) is False)
+        self.assertEqual(built_ray.nearest_hit_distance, loaded_ray.nearest_hit_distance)
+
+    def test_changed_inputs_miss(self):
+        key = cache_key([self.source], {"scale": 2})
+        self.assertNotEqual(cache_key([self.source], {"scale": 3}), key)
+        with open(self.source, "a") as file:
+            file.write("v 1 0 0\n")
+        self.assertNotEqual(cache_key([self.source], {"scale": 2}), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,12 @@ import numpy as np
 
 class Vec3:
     """Holds 3-elements tuple that represents a 3-dimensional vector"""
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, x=0.0, y=0.0, z=0.0):
-        if isinstance(x, Vec3):
+        if type(x) is float and type(y) is float and type(z) is float:
+            (self.x, self.y, self.z) = (x, y, z)
+        elif isinstance(x, Vec3):
             (self.x, self.y, self.z) = (float(x.x), float(x.y), float(x.z))
         elif isinstance(x, tuple):
             (self.x, self.y, self.z) = (float(x[0]), float(x[1]), float(x[2]))
@@ -28,24 +32,49 @@ class Vec3:
         return f"Vec3 Object: <{rounded.x}, {rounded.y}, {rounded.z}>"
 
     def __add__(self, other):
-        return Vec3(self.x + other.x, self.y + other.y, self.z + other.z)
+        return from_floats(self.x + other.x, self.y + other.y, self.z + other.z)
 
     def __sub__(self, other):
-        return Vec3(self.x - other.x, self.y - other.y, self.z - other.z)
+        return from_floats(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __neg__(self):
+        return from_floats(-self.x, -self.y, -self.z)
 
     def __mul__(self, scalar):
-        assert not isinstance(scalar, Vec3)
+        if type(scalar) is float:
+            return from_floats(self.x * scalar, self.y * scalar, self.z * scalar)
+        if isinstance(scalar, Vec3):
+            raise TypeError("Vec3 * Vec3 is ambiguous; use dot or cross")
         return Vec3(self.x * scalar, self.y * scalar, self.z * scalar)
 
     def __rmul__(self, scalar):
         return self.__mul__(scalar)
 
     def __truediv__(self, other):
+        if type(other) is float:
+            return from_floats(self.x / other, self.y / other, self.z / other)
         if isinstance(other, Vec3):
-            return Vec3((self.x / other.x), (self.y / other.y), (self.z / other.z))
-        else:
-            assert isinstance(other, int) or isinstance(other, float)
-            return Vec3((self.x / other), (self.y / other), (self.z / other))
+            return from_floats(self.x / other.x, self.y / other.y, self.z / other.z)
+        return Vec3(self.x / other, self.y / other, self.z / other)
+
+    # In-place versions change the vector itself, so only use them on vectors nothing else holds on to
+    def __iadd__(self, other):
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        return self
+
+    def __isub__(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        self.z -= other.z
+        return self
+
+    def __imul__(self, scalar):
+        if isinstance(scalar, Vec3):
+            raise TypeError("Vec3 * Vec3 is ambiguous; use dot or cross")
+        self.x, self.y, self.z = float(self.x * scalar), float(self.y * scalar), float(self.z * scalar)
+        return self
 
     def dot(self, other):
         # assert isinstance(other, Vec3) # Caused issues with recursion?
@@ -80,3 +109,22 @@ class Vec3:
             return self / magnitude
 
 
+_new_vec3 = object.__new__
+
+
+def from_floats(x, y, z):
+    """Vec3 straight from three Python floats, skipping the type checks in Vec3.__init__"""
+    vec = _new_vec3(Vec3)
+    vec.x, vec.y, vec.z = x, y, z
+    return vec
+
+
+def point_along(origin, direction, t):
+    """origin + t * direction, without the temporary t * direction vector"""
+    return from_floats(origin.x + direction.x * t, origin.y + direction.y * t, origin.z + direction.z * t)
+
+
+def reflect(direction, normal):
+    """direction mirrored about normal: direction - 2 * (direction . normal) * normal"""
+    scale = 2 * -(direction.x * normal.x + direction.y * normal.y + direction.z * normal.z)
+    return from_floats(direction.x + normal.x * scale, direction.y + normal.y * scale, direction.z + normal.z * scale)